@@ -0,0 +1,253 @@
+"""
+Headless batch runner: meshes every NIfTI volume of a directory or manifest with
+`pipeline.full_pipeline` on a pool of warm worker processes (see jobs.JobScheduler).
+
+    python batch.py /data/studies --output-dir meshes --report meshes/report.jsonl
+    python batch.py manifest.txt --workers 4 --formats glb --multi-label
+
+A manifest lists one volume per line, either as a path (relative to the manifest) or as a JSON
+object {"path": ..., "id": ...}; blank lines and lines starting with # are ignored. Outputs are
+written as `<output-dir>/<id>_mesh.<ext>`, where the id defaults to the volume's path relative to
+the directory or manifest.
+
+Every finished volume is appended to the JSONL report at once. Running the same command again
+skips the volumes the report lists as completed, so an interrupted batch resumes where it
+stopped; failed volumes are retried unless --skip-failed is given.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from jobs import CANCELLED, COMPLETED, FAILED, JOB_MEMORY_LIMIT_MB, JOB_STALL_TIMEOUT, PIPELINE_WORKERS, JobScheduler
+from pipeline_options import DECIMATION_METHODS, DEFAULT_FORMATS, MESH_FORMATS, SMOOTHING_PRESETS
+
+NIFTI_SUFFIXES = (".nii.gz", ".nii")
+
+
+class BatchReport:
+    """
+    Append-only JSONL report of a batch, one entry per finished volume. When a volume appears
+    several times (it was retried), its last entry counts.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # A line cut off by an interrupted run
+                    self.entries[entry["id"]] = entry
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a+", encoding="utf-8")
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() > 0:
+            self._file.seek(self._file.tell() - 1)
+            if self._file.read(1) != "\n":
+                self._file.write("\n")  # Never continue a cut-off line
+
+    def is_done(self, item_id: str, retry_failed: bool = True) -> bool:
+        status = self.entries.get(item_id, {}).get("status")
+        return status == COMPLETED or (status == FAILED and not retry_failed)
+
+    def write(self, entry: Dict[str, Any]):
+        """Appends an entry and flushes it to disk, so it survives the process being killed."""
+        self.entries[entry["id"]] = entry
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def _volume_id(relative_path: str) -> str:
+    name = relative_path
+    for suffix in NIFTI_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", name).strip("_") or "volume"
+
+
+def collect_volumes(source) -> List[Dict[str, str]]:
+    """
+    The volumes of a directory (every .nii/.nii.gz below it) or a manifest file, as
+    [{"id", "path"}] with unique ids.
+    """
+    source = Path(source)
+    if source.is_dir():
+        paths = sorted(path for path in source.rglob("*") if path.is_file() and path.name.endswith(NIFTI_SUFFIXES))
+        items = [{"id": _volume_id(path.relative_to(source).as_posix()), "path": str(path)} for path in paths]
+    else:
+        items = []
+        with open(source, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                entry = json.loads(line) if line.startswith("{") else {"path": line}
+                path = Path(entry["path"])
+                if not path.is_absolute():
+                    path = source.parent / path
+                items.append({"id": entry.get("id") or _volume_id(entry["path"]), "path": str(path)})
+
+    seen: Dict[str, int] = {}
+    for item in items:  # Volumes with the same name in different folders must not overwrite each other
+        count = seen[item["id"]] = seen.get(item["id"], 0) + 1
+        if count > 1:
+            item["id"] = f"{item['id']}-{count}"
+    return items
+
+
+def _report_entry(job) -> Dict[str, Any]:
+    entry = {
+        "id": job.file_id,
+        "input": job.input_path,
+        "status": job.status,
+        "seconds": round(job.finished_at - job.started_at, 2) if job.started_at else None,
+        "finished_at": job.finished_at,
+    }
+    if job.status == COMPLETED:
+        result = job.result
+        entry["mesh_path"] = result["mesh_path"]
+        entry["artifacts"] = [{key: artifact[key] for key in ("format", "encoding", "path", "bytes")}
+                              for artifact in result["artifacts"]]
+        entry["memory_mb"] = result.get("memory_mb", {})
+        if result.get("cleaning"):
+            entry["removed_triangles"] = result["cleaning"]["triangles_before"] - result["cleaning"]["triangles_after"]
+        if result.get("decimation"):
+            entry["decimation"] = result["decimation"]
+        if "labels" in result:
+            entry["labels"] = [{key: label[key] for key in ("label", "voxels", "triangles")}
+                               for label in result["labels"]]
+    elif job.error:
+        entry["error"] = job.error
+    return entry
+
+
+async def run_batch(items, output_dir, report: BatchReport, params: Dict[str, Any], workers=PIPELINE_WORKERS,
+                    memory_limit_mb=JOB_MEMORY_LIMIT_MB, retry_failed=True) -> Dict[str, int]:
+    """
+    Runs `full_pipeline(**params)` on every item the report does not list as done, feeding them
+    to the scheduler as its queue drains. Returns the number of volumes per final status.
+    """
+    todo = [item for item in items if not report.is_done(item["id"], retry_failed)]
+    print(f"{len(items)} volumes: {len(items) - len(todo)} already done, {len(todo)} to process")
+    counts = {COMPLETED: 0, FAILED: 0, CANCELLED: 0}
+    if not todo:
+        return counts
+
+    all_done = asyncio.Event()
+    started = time.perf_counter()
+
+    async def ignore_progress(file_id, data):
+        pass
+
+    async def record(job):
+        counts[job.status] += 1
+        if job.status != CANCELLED:  # Cancelled volumes have not run; they are picked up on resume
+            report.write(_report_entry(job))
+        finished = counts[COMPLETED] + counts[FAILED]
+        icon = {COMPLETED: "✅", FAILED: "❌"}.get(job.status, "⚠️")
+        detail = f"{job.finished_at - job.started_at:.1f}s" if job.started_at else job.status
+        if job.error:
+            detail += f": {job.error}"
+        print(f"{icon} [{finished}/{len(todo)}] {job.file_id} ({detail})")
+        if sum(counts.values()) == len(todo):
+            all_done.set()
+
+    scheduler = JobScheduler(output_dir, ignore_progress, workers=workers, queue_size=2 * workers,
+                             memory_limit_mb=memory_limit_mb, stall_timeout=JOB_STALL_TIMEOUT, log_progress=False)
+    await scheduler.start()
+    try:
+        for item in todo:
+            await scheduler.wait_for_room()
+            await scheduler.submit(item["id"], item["path"], on_done=record, **params)
+        await all_done.wait()
+    finally:
+        await scheduler.shutdown()
+    elapsed = time.perf_counter() - started
+    print(f"Batch finished in {elapsed:.1f}s: {counts[COMPLETED]} completed, {counts[FAILED]} failed "
+          f"({counts[COMPLETED] / max(elapsed, 1e-9) * 3600:.0f} volumes/hour)")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="Directory of .nii/.nii.gz volumes, or a manifest file")
+    parser.add_argument("--output-dir", default="batch_outputs")
+    parser.add_argument("--report", help="JSONL report (default: <output-dir>/report.jsonl)")
+    parser.add_argument("--workers", type=int, default=PIPELINE_WORKERS, help="Worker processes")
+    parser.add_argument("--memory-limit-mb", type=int, default=JOB_MEMORY_LIMIT_MB, help="Per-job budget (0: none)")
+    parser.add_argument("--skip-failed", action="store_true", help="Do not retry volumes that failed before")
+    parser.add_argument("--threshold", type=float, default=1)
+    parser.add_argument("--smoothing-iterations", type=int)
+    parser.add_argument("--feature-angle", type=float)
+    parser.add_argument("--relaxation-factor", type=float)
+    parser.add_argument("--smoothing-preset", choices=SMOOTHING_PRESETS)
+    parser.add_argument("--target-reduction", type=float, default=0.1)
+    parser.add_argument("--target-triangles", type=int, help="Decimate to at most this many triangles")
+    parser.add_argument("--target-bytes", type=int, help="Decimate until every output file fits in this size")
+    parser.add_argument("--decimation", choices=DECIMATION_METHODS, default="quadric",
+                        help="Decimation method of the budgets")
+    parser.add_argument("--formats", default=",".join(DEFAULT_FORMATS),
+                        help=f"Comma-separated list of {', '.join(MESH_FORMATS)}")
+    parser.add_argument("--no-precompress", action="store_true", help="Skip the .gz/.br copies of every file")
+    parser.add_argument("--lods", action="store_true", help="Also write the coarse preview meshes")
+    parser.add_argument("--multi-label", action="store_true", help="One mesh per label value")
+    parser.add_argument("--no-crop", action="store_true", help="Do not crop volumes to their foreground")
+    parser.add_argument("--out-of-core", choices=["auto", "on", "off"], default="auto")
+    args = parser.parse_args()
+
+    smoothing_params = {
+        name: value for name, value in (
+            ("iterations", args.smoothing_iterations),
+            ("feature_angle", args.feature_angle),
+            ("relaxation_factor", args.relaxation_factor),
+            ("preset", args.smoothing_preset),
+        ) if value is not None
+    }
+    params = {
+        "threshold": args.threshold,
+        "smoothing_params": smoothing_params,
+        "target_reduction": args.target_reduction,
+        "target_triangles": args.target_triangles,
+        "target_bytes": args.target_bytes,
+        "decimation": args.decimation,
+        "output_formats": [fmt.strip().lower() for fmt in args.formats.split(",") if fmt.strip()],
+        "precompress": not args.no_precompress,
+        "lods": args.lods,
+        "multi_label": args.multi_label,
+        "crop": not args.no_crop,
+        "out_of_core": {"auto": None, "on": True, "off": False}[args.out_of_core],
+    }
+
+    unsupported = [fmt for fmt in params["output_formats"] if fmt not in MESH_FORMATS]
+    if unsupported or not params["output_formats"]:
+        parser.error(f"Unsupported output formats: {args.formats}")
+
+    items = collect_volumes(args.source)
+    os.makedirs(args.output_dir, exist_ok=True)
+    report = BatchReport(args.report or os.path.join(args.output_dir, "report.jsonl"))
+    try:
+        counts = asyncio.run(run_batch(items, args.output_dir, report, params, workers=args.workers,
+                                       memory_limit_mb=args.memory_limit_mb, retry_failed=not args.skip_failed))
+    except KeyboardInterrupt:
+        print("⚠️ Interrupted; run the same command again to resume.")
+        raise SystemExit(130)
+    finally:
+        report.close()
+    raise SystemExit(1 if counts[FAILED] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""
+End-to-end benchmark of the NIfTI-to-mesh pipeline on synthetic volumes (see phantoms.py).
+
+    python benchmark_pipeline.py [--sizes 64 128 256] [--phantoms sphere noisy_ct] [--output results.json]
+    python benchmark_pipeline.py --compare baseline.json results.json
+
+Two measurements are taken for every phantom and size:
+
+- "stages": each stage of the file-based pipeline called on its own (process_nifti, the
+  orientation fix, nii_to_dicom, load_dicom_image, dicom_to_mesh, compute_smoothing_params,
+  smooth_mesh, save_mesh_as_stl). Label maps are skipped here, since binarizing merges the labels.
+- "pipeline": `full_pipeline` as the API runs it, with the time of every progress step.
+
+Every entry records wall time, CPU time (all threads of the process), peak RSS and, where it
+applies, triangle counts and output bytes. The results are written as JSON together with the
+commit and library versions, so two runs can be compared with `--compare`.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import vtk
+
+from dicomtomesh import compute_smoothing_params, dicom_to_mesh, load_dicom_image, save_mesh_as_stl, smooth_mesh
+from isoto1 import process_nifti
+from memstats import peak_rss_mb, reset_peak_rss
+from niitodicom import fix_nifti_orientation_nibabel, nii_to_dicom
+from phantoms import PHANTOMS, write_phantom
+from pipeline import SMOOTHING_PARAM_MAX_SAMPLES, full_pipeline, not_affine_aligned
+
+DEFAULT_SIZES = (64, 128)
+# Entries whose wall time changed by more than this fraction are flagged by --compare.
+REGRESSION_TOLERANCE = 0.15
+
+
+class Measurement:
+    """Wall time, CPU time and peak RSS of the code run inside the `with` block."""
+
+    def __enter__(self):
+        reset_peak_rss()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall_s = time.perf_counter() - self._wall
+        self.cpu_s = time.process_time() - self._cpu
+        self.peak_rss_mb = round(peak_rss_mb(), 1)
+        return False
+
+    def as_dict(self, **extra):
+        return {"wall_s": round(self.wall_s, 4), "cpu_s": round(self.cpu_s, 4), "peak_rss_mb": self.peak_rss_mb,
+                **extra}
+
+
+def _stl_triangles(path):
+    """Triangle count of a binary STL, read from its size (84 byte header, 50 bytes per triangle)."""
+    return (os.path.getsize(path) - 84) // 50
+
+
+def benchmark_stages(input_path, workdir):
+    """Runs the file-based pipeline one stage at a time. Returns {stage: measurement dict}."""
+    stages = {}
+    processed_path = workdir / "processed.nii"
+    fixed_path = workdir / "fixed.nii"
+    dicom_dir = workdir / "dicom"
+
+    with Measurement() as m:
+        process_nifti(str(input_path), str(processed_path))
+    stages["process_nifti"] = m.as_dict(bytes=processed_path.stat().st_size)
+
+    with Measurement() as m:
+        needs_fix = not_affine_aligned(str(processed_path))
+        if needs_fix:
+            fix_nifti_orientation_nibabel(str(processed_path), str(fixed_path))
+    nii_path = fixed_path if needs_fix else processed_path
+    stages["fix_orientation"] = m.as_dict(fixed=needs_fix, bytes=nii_path.stat().st_size)
+
+    with Measurement() as m:
+        dicom_stats = nii_to_dicom(str(nii_path), str(dicom_dir))
+    stages["nii_to_dicom"] = m.as_dict(slices=dicom_stats["slices"], bytes=dicom_stats["bytes"])
+
+    with Measurement() as m:
+        volume = load_dicom_image(str(dicom_dir))
+    stages["load_dicom_image"] = m.as_dict(voxels=int(np.prod(volume.GetDimensions())))
+
+    with Measurement() as m:
+        mesh = dicom_to_mesh(volume, 1)
+    stages["dicom_to_mesh"] = m.as_dict(triangles=mesh.GetNumberOfCells())
+    del volume
+    if mesh.GetNumberOfCells() == 0:
+        return stages
+
+    with Measurement() as m:
+        iterations, angle, factor = compute_smoothing_params(mesh, max_samples=SMOOTHING_PARAM_MAX_SAMPLES)
+    stages["compute_smoothing_params"] = m.as_dict(iterations=iterations, feature_angle=angle,
+                                                   relaxation_factor=factor)
+
+    with Measurement() as m:
+        timings = smooth_mesh(mesh, iterations, angle, factor)
+    stages["smooth_mesh"] = m.as_dict(triangles=mesh.GetNumberOfCells(),
+                                      filters_s={name: round(seconds, 4) for name, seconds in timings.items()})
+
+    stl_path = workdir / "mesh.stl"
+    with Measurement() as m:
+        save_mesh_as_stl(mesh, str(stl_path))
+    stages["save_mesh_as_stl"] = m.as_dict(triangles=_stl_triangles(stl_path), bytes=stl_path.stat().st_size)
+    return stages
+
+
+def benchmark_pipeline(input_path, workdir, multi_label):
+    """Runs `full_pipeline` once. Returns the overall measurement with the duration of every step."""
+    steps = []
+
+    def on_progress(step, percent, **extra):
+        steps.append((step, time.perf_counter()))
+
+    with Measurement() as m:
+        result = full_pipeline(str(input_path), output_dir=str(workdir / "outputs"), progress_callback=on_progress,
+                               multi_label=multi_label)
+    finished = time.perf_counter()
+    step_s = {}
+    for (step, started), (_, ended) in zip(steps, steps[1:] + [(None, finished)]):
+        step_s[step] = round(step_s.get(step, 0.0) + ended - started, 4)
+
+    artifacts = [artifact for artifact in result["artifacts"]
+                 if artifact.get("encoding") is None and artifact["format"] != "json"]
+    output_bytes = {}
+    for artifact in artifacts:  # Summed over the label meshes in multi-label mode
+        output_bytes[artifact["format"]] = output_bytes.get(artifact["format"], 0) + artifact["bytes"]
+    if multi_label:
+        triangles = sum(label["triangles"] for label in result["labels"])
+    else:
+        stl = next((artifact["path"] for artifact in artifacts if artifact["format"] == "stl"), None)
+        triangles = _stl_triangles(stl) if stl else None
+    return m.as_dict(
+        triangles=triangles,
+        bytes=output_bytes,
+        lods=[lod["triangles"] for lod in result.get("lods", [])],
+        steps_s=step_s,
+        step_peak_rss_mb=result.get("memory_mb", {}),
+    )
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, phantoms, modes, workdir):
+    results = []
+    for name in phantoms:
+        _, is_label_map = PHANTOMS[name]
+        for size in sizes:
+            case_dir = Path(workdir) / f"{name}_{size}"
+            case_dir.mkdir(parents=True, exist_ok=True)
+            input_path = write_phantom(name, size, case_dir / "input.nii.gz")
+            entry = {"phantom": name, "size": size, "voxels": size ** 3, "input_bytes": input_path.stat().st_size}
+            print(f"--- {name} {size}^3 ---")
+            if "stages" in modes and not is_label_map:
+                entry["stages"] = benchmark_stages(input_path, case_dir)
+            if "pipeline" in modes:
+                entry["pipeline"] = benchmark_pipeline(input_path, case_dir, multi_label=is_label_map)
+            results.append(entry)
+    return {
+        "commit": _commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "versions": {"numpy": np.__version__, "vtk": vtk.vtkVersion.GetVTKVersion()},
+        "results": results,
+    }
+
+
+def _wall_times(report):
+    """{(phantom, size, stage): wall seconds} of a report, with "pipeline" for the full run."""
+    times = {}
+    for entry in report["results"]:
+        key = (entry["phantom"], entry["size"])
+        for stage, stats in entry.get("stages", {}).items():
+            times[key + (stage,)] = stats["wall_s"]
+        if "pipeline" in entry:
+            times[key + ("pipeline",)] = entry["pipeline"]["wall_s"]
+    return times
+
+
+def compare(baseline_path, current_path, tolerance=REGRESSION_TOLERANCE):
+    """Prints the wall time of every entry of two reports side by side. Returns the number of regressions."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+    before, after = _wall_times(baseline), _wall_times(current)
+    print(f"{baseline.get('commit')} -> {current.get('commit')}")
+    regressions = 0
+    for key in sorted(set(before) & set(after)):
+        ratio = after[key] / before[key] if before[key] > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag, regressions = "  ⚠️ slower", regressions + 1
+        elif ratio < 1 - tolerance:
+            flag = "  ✅ faster"
+        phantom, size, stage = key
+        print(f"{phantom:>10} {size:>4}^3 {stage:<26} {before[key]:8.3f}s -> {after[key]:8.3f}s  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES))
+    parser.add_argument("--phantoms", nargs="+", default=list(PHANTOMS), choices=list(PHANTOMS))
+    parser.add_argument("--modes", nargs="+", default=["stages", "pipeline"], choices=["stages", "pipeline"])
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the JSON report")
+    parser.add_argument("--workdir", help="Keep the generated volumes and outputs here (default: a temp dir)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="Compare two reports instead of running the benchmark")
+    args = parser.parse_args()
+
+    if args.compare:
+        raise SystemExit(1 if compare(*args.compare) else 0)
+
+    if args.workdir:
+        report = run(args.sizes, args.phantoms, args.modes, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory(prefix="spartis-bench-") as workdir:
+            report = run(args.sizes, args.phantoms, args.modes, workdir)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Benchmark results saved at: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Cold-start benchmark of the API: how long a fresh process takes to import, to answer its first
+request and to run its first job.
+
+    python benchmark_startup.py [--runs 3] [--output startup_results.json]
+    python benchmark_startup.py --compare baseline.json startup_results.json
+
+Every run starts a new Python process that imports `main`, enters the application lifespan
+(progress store, scheduler) and measures, from the moment the process started:
+
+- "import_s": `import main`, and which heavy imaging modules it loaded (there should be none);
+- "ready_s": the first answer of GET /api/progress/{id};
+- "workers_warm_s": the worker processes started and warmed up (see jobs.WORKER_WARM_UP);
+- "first_job_s": one small phantom uploaded once the API is ready and, with warm-up, its workers
+  are warm, until its progress reports "Completed" (the latency the first user sees).
+
+Runs are made with worker warm-up on ("warm") and off ("cold"). The slowest direct imports of
+`main` are listed from `python -X importtime`. Blob storage and Redis are not configured in the
+measured processes (KV_URL / BLOB_CONNECTION_STRING are cleared).
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent
+# Modules the API process is expected to leave to the worker processes.
+HEAVY_MODULES = ("vtk", "vtkmodules", "SimpleITK", "nibabel", "pydicom", "skimage", "scipy")
+PHANTOM_SIZE = 48
+METRICS = ("import_s", "ready_s", "workers_warm_s", "first_job_s")
+# Entries whose time changed by more than this fraction are flagged by --compare.
+REGRESSION_TOLERANCE = 0.15
+
+
+def probe(input_path):
+    """Runs in the measured process: prints one JSON line with the timings of this start."""
+    started = time.perf_counter()
+    import main
+    timings = {"import_s": time.perf_counter() - started,
+               "heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules]}
+
+    from fastapi.testclient import TestClient
+
+    with TestClient(main.app) as client:
+        client.get("/api/progress/benchmark")
+        timings["ready_s"] = time.perf_counter() - started
+
+        if getattr(main.scheduler, "warm_up", False):  # Older versions start workers on demand
+            while main.scheduler.warm_up_seconds is None:
+                time.sleep(0.01)
+            timings["workers_warm_s"] = time.perf_counter() - started
+
+        submitted = time.perf_counter()
+        with open(input_path, "rb") as f:
+            response = client.post("/api/process-nifti/?output_format=stl&lods=false",
+                                   files={"file": ("phantom.nii.gz", f)})
+        file_id = response.json()["file_id"]
+        while True:
+            progress = client.get(f"/api/progress/{file_id}").json()
+            if progress["step"] in ("Completed", "Error"):
+                break
+            time.sleep(0.01)
+        timings["first_job_s"] = time.perf_counter() - submitted
+        timings["first_job_step"] = progress["step"]
+
+    print(json.dumps({key: round(value, 4) if isinstance(value, float) else value
+                      for key, value in timings.items()}))
+
+
+def _write_input(path):
+    """A sphere phantom with a random origin, so that no run is answered from the result cache."""
+    import nibabel as nib
+    import numpy as np
+    from phantoms import phantom_affine, sphere_mask
+
+    affine = phantom_affine()
+    affine[:3, 3] = np.random.default_rng().uniform(-100, 100, 3)
+    nib.save(nib.Nifti1Image(sphere_mask(PHANTOM_SIZE), affine), str(path))
+    return path
+
+
+def _environment(warm_up):
+    env = {key: value for key, value in os.environ.items() if key not in ("KV_URL", "BLOB_CONNECTION_STRING")}
+    env["WORKER_WARM_UP"] = "1" if warm_up else "0"
+    env["SPAN_LOG"] = "0"
+    return env
+
+
+def run_probe(warm_up, workdir):
+    input_path = _write_input(Path(workdir) / "phantom.nii.gz")
+    result = subprocess.run([sys.executable, __file__, "--probe", str(input_path)], cwd=BACKEND_DIR,
+                            env=_environment(warm_up), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Startup probe failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(count=10):
+    """The direct imports of `main` with the highest cumulative import time, from -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=BACKEND_DIR,
+                            env=_environment(True), capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue  # Header line
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            imports.append({"module": name.strip(), "cumulative_s": int(cumulative) / 1e6})
+    return sorted(imports, key=lambda entry: entry["cumulative_s"], reverse=True)[:count]
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=BACKEND_DIR, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(runs):
+    modes = {}
+    with tempfile.TemporaryDirectory(prefix="spartis-startup-") as workdir:
+        for mode, warm_up in (("warm", True), ("cold", False)):
+            samples = []
+            for index in range(runs):
+                samples.append(run_probe(warm_up, workdir))
+                print(f"--- {mode} run {index + 1}/{runs}: " + ", ".join(
+                    f"{metric} {samples[-1][metric]:.2f}s" for metric in METRICS if metric in samples[-1]))
+            modes[mode] = {
+                "median": {metric: round(statistics.median(sample[metric] for sample in samples), 4)
+                           for metric in METRICS if metric in samples[0]},
+                "heavy_modules": sorted({name for sample in samples for name in sample["heavy_modules"]}),
+                "runs": samples,
+            }
+    return {
+        "commit": _commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "modes": modes,
+        "slowest_imports": slowest_imports(),
+    }
+
+
+def compare(baseline_path, current_path, tolerance=REGRESSION_TOLERANCE):
+    """Prints the median timings of two reports side by side. Returns the number of regressions."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+    print(f"{baseline.get('commit')} -> {current.get('commit')}")
+    regressions = 0
+    for mode in sorted(set(baseline["modes"]) & set(current["modes"])):
+        before, after = baseline["modes"][mode]["median"], current["modes"][mode]["median"]
+        for metric in METRICS:
+            if metric not in before or metric not in after:
+                continue
+            ratio = after[metric] / before[metric] if before[metric] > 0 else float("inf")
+            flag = ""
+            if ratio > 1 + tolerance:
+                flag, regressions = "  ⚠️ slower", regressions + 1
+            elif ratio < 1 - tolerance:
+                flag = "  ✅ faster"
+            print(f"{mode:>5} {metric:<15} {before[metric]:8.3f}s -> {after[metric]:8.3f}s  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="Fresh processes started per mode")
+    parser.add_argument("--output", default="startup_results.json", help="Where to write the JSON report")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="Compare two reports instead of running the benchmark")
+    parser.add_argument("--probe", metavar="INPUT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe:
+        probe(args.probe)
+        return
+    if args.compare:
+        raise SystemExit(1 if compare(*args.compare) else 0)
+
+    report = run(args.runs)
+    for mode, stats in report["modes"].items():
+        print(f"{mode}: " + ", ".join(f"{metric} {value:.2f}s" for metric, value in stats["median"].items()))
+        if stats["heavy_modules"]:
+            print(f"⚠️ The API process imported {', '.join(stats['heavy_modules'])}")
+    print("Slowest imports of main: " + ", ".join(
+        f"{entry['module']} {entry['cumulative_s']:.2f}s" for entry in report["slowest_imports"][:5]))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Startup benchmark results saved at: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Times the surface extraction backends of dicom_to_mesh on synthetic volumes.
+
+    python benchmark_surface.py [--sizes 128 256] [--threads 1 4] [--repeat 3]
+
+Every backend meshes the same volumes (a binary sphere mask at iso 1, like the pipeline's
+binarized volumes, and a noisy smooth field at a fractional iso value), and the table lists the
+best wall time of `--repeat` runs, the triangle count and the speedup over vtkMarchingCubes.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from dicomtomesh import SURFACE_BACKENDS, configure_threads, dicom_to_mesh, volume_to_image_data
+from phantoms import noisy_field, sphere_mask
+
+
+PHANTOMS = {"sphere mask": (sphere_mask, 1), "noisy field": (noisy_field, 0.3)}
+
+
+def time_backend(image_data, threshold, backend, compute_normals, threads, repeat):
+    best, triangles = float("inf"), 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        mesh = dicom_to_mesh(image_data, threshold, backend=backend, compute_normals=compute_normals,
+                             threads=threads)
+        best = min(best, time.perf_counter() - started)
+        triangles = mesh.GetNumberOfCells()
+    return best, triangles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[128, 256])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1])
+    parser.add_argument("--backends", nargs="+", default=list(SURFACE_BACKENDS), choices=SURFACE_BACKENDS)
+    parser.add_argument("--no-normals", action="store_true", help="Benchmark without point normals")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = []
+    for name, (make_volume, threshold) in PHANTOMS.items():
+        for size in args.sizes:
+            image_data = volume_to_image_data(make_volume(size), np.eye(4), verbose=False)
+            for threads in args.threads:
+                configure_threads(threads)
+                timings = {}
+                for backend in args.backends:
+                    try:
+                        timings[backend] = time_backend(image_data, threshold, backend, not args.no_normals,
+                                                        threads, args.repeat)
+                    except ImportError as e:
+                        print(f"⚠️ Skipping {backend}: {e}")
+                reference = timings.get("marching_cubes", (None, 0))[0]
+                for backend, (seconds, triangles) in timings.items():
+                    speedup = f"{reference / seconds:.2f}x" if reference else "-"
+                    rows.append((name, f"{size}^3", threads, backend, f"{seconds:.3f}", triangles, speedup))
+
+    header = ("phantom", "size", "threads", "backend", "seconds", "triangles", "vs MC")
+    widths = [max(len(str(row[i])) for row in rows + [header]) for i in range(len(header))]
+    print()
+    for row in [header] + rows:
+        print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import asyncio
+import base64
+import hashlib
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+# The Azure SDK is imported by `BlobStorage.start`, only when a connection string is configured.
+
+# Size of the blocks staged by StagedBlobUpload. Azure allows up to 50,000 blocks per blob,
+# so 8 MB blocks cover volumes of up to ~400 GB.
+BLOB_BLOCK_SIZE = int(os.environ.get("BLOB_BLOCK_SIZE", 8 * 1024 * 1024))
+# How many blocks may be in flight at once for a single upload.
+BLOB_MAX_CONCURRENCY = int(os.environ.get("BLOB_MAX_CONCURRENCY", 4))
+# Retries of failed requests, with exponential backoff starting at BLOB_RETRY_BACKOFF seconds.
+BLOB_RETRY_TOTAL = int(os.environ.get("BLOB_RETRY_TOTAL", 5))
+BLOB_RETRY_BACKOFF = float(os.environ.get("BLOB_RETRY_BACKOFF", 1.0))
+
+
+class TransferMetrics:
+    """Running totals of blob transfers: count, bytes, latency and throughput."""
+
+    def __init__(self):
+        self.uploads = 0
+        self.failures = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.last_latency = 0.0
+        self.last_bytes_per_second = 0.0
+
+    def record(self, nbytes: int, seconds: float):
+        self.uploads += 1
+        self.bytes += nbytes
+        self.seconds += seconds
+        self.last_latency = seconds
+        self.last_bytes_per_second = nbytes / seconds if seconds > 0 else 0.0
+
+    def record_failure(self):
+        self.failures += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "uploads": self.uploads,
+            "failures": self.failures,
+            "bytes": self.bytes,
+            "mean_latency_s": self.seconds / self.uploads if self.uploads else 0.0,
+            "mean_bytes_per_s": self.bytes / self.seconds if self.seconds > 0 else 0.0,
+            "last_latency_s": self.last_latency,
+            "last_bytes_per_s": self.last_bytes_per_second,
+        }
+
+
+def block_id(prefix: str, index: int) -> str:
+    """Block ids of a blob must all have the same length, so the index is zero-padded."""
+    return base64.b64encode(f"{prefix}-{index:08d}".encode("ascii")).decode("ascii")
+
+
+class StagedBlobUpload:
+    """
+    Uploads a blob as a series of staged blocks while the data is still arriving.
+
+    `write` buffers incoming chunks and stages every full block with `stage_block`, with at most
+    `max_concurrency` blocks in flight (it waits when that many are pending, which throttles the
+    producer). `commit` stages the remainder and commits the block list in order.
+
+    Block ids start with a prefix of their own (a random UUID), so concurrent uploads to the same
+    blob name never commit each other's uncommitted blocks; the last commit wins as a whole.
+
+    Blob storage is best effort here, like the rest of the backend: the first failure is printed,
+    later writes are ignored and `commit` returns None, so the local ingest is never interrupted.
+    """
+
+    def __init__(self, blob_client, block_size: int = BLOB_BLOCK_SIZE, max_concurrency: int = BLOB_MAX_CONCURRENCY,
+                 metrics: Optional[TransferMetrics] = None):
+        self.blob_client = blob_client
+        self.block_size = block_size
+        self.metrics = metrics
+        self._started_at = time.perf_counter()
+        self._slots = asyncio.Semaphore(max(1, max_concurrency))
+        self._buffer = bytearray()
+        self._block_prefix = uuid.uuid4().hex
+        self._block_ids: List[str] = []
+        self._tasks: List[asyncio.Task] = []
+        self.error: Optional[Exception] = None
+        self.bytes_staged = 0
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    async def write(self, chunk: bytes):
+        if self.failed:
+            return
+        self._buffer.extend(chunk)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            await self._stage(block)
+
+    async def commit(self) -> Optional[str]:
+        """Stages the buffered remainder, commits the block list and returns the blob URL."""
+        try:
+            if self._buffer and not self.failed:
+                await self._stage(bytes(self._buffer))
+                self._buffer.clear()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            if self.failed:
+                return None
+            await self.blob_client.commit_block_list(self._block_ids)
+            if self.metrics is not None:
+                self.metrics.record(self.bytes_staged, time.perf_counter() - self._started_at)
+            return self.blob_client.url
+        except Exception as e:
+            self._fail(e)
+            return None
+
+    async def abort(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _stage(self, block: bytes):
+        await self._slots.acquire()
+        if self.failed:
+            self._slots.release()
+            return
+        block_name = block_id(self._block_prefix, len(self._block_ids))
+        self._block_ids.append(block_name)
+        self._tasks.append(asyncio.create_task(self._stage_block(block_name, block)))
+
+    async def _stage_block(self, block_name: str, block: bytes):
+        try:
+            await self.blob_client.stage_block(block_id=block_name, data=block, length=len(block))
+            self.bytes_staged += len(block)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._slots.release()
+
+    def _fail(self, error: Exception):
+        if self.error is None:
+            self.error = error
+            if self.metrics is not None:
+                self.metrics.record_failure()
+            print(f"❌ Failed to upload {self.blob_client.blob_name} to Azure Blob Storage: {error}")
+
+
+class BlobStorage:
+    """
+    Application-lifetime access to one blob container.
+
+    A single BlobServiceClient (one connection pool, one TLS session) is created by `start`
+    and shared by every upload and download until `close`. Uploads use `block_size` blocks
+    with up to `max_concurrency` parallel requests, failed requests are retried with
+    exponential backoff, and every transfer is recorded in `metrics`.
+
+    Without a connection string the storage is disabled and uploads are skipped. A
+    pre-built `service_client` (e.g. pointing at Azurite or a test stub) can be passed instead.
+    """
+
+    def __init__(self, connection_string: Optional[str], container_name: str,
+                 max_concurrency: int = BLOB_MAX_CONCURRENCY, block_size: int = BLOB_BLOCK_SIZE,
+                 retry_total: int = BLOB_RETRY_TOTAL, retry_backoff: float = BLOB_RETRY_BACKOFF,
+                 service_client=None):
+        self.connection_string = connection_string
+        self.container_name = container_name
+        self.max_concurrency = max(1, max_concurrency)
+        self.block_size = block_size
+        self.retry_total = retry_total
+        self.retry_backoff = retry_backoff
+        self.service_client = service_client
+        self.metrics = TransferMetrics()
+
+    @property
+    def enabled(self) -> bool:
+        return self.service_client is not None
+
+    async def start(self):
+        if self.service_client is not None or not self.connection_string:
+            return
+        from azure.storage.blob.aio import BlobServiceClient, ExponentialRetry
+
+        self.service_client = BlobServiceClient.from_connection_string(
+            self.connection_string,
+            max_block_size=self.block_size,
+            max_single_put_size=self.block_size,
+            retry_policy=ExponentialRetry(initial_backoff=self.retry_backoff, increment_base=2,
+                                          retry_total=self.retry_total),
+        )
+        print(f"✅ Blob storage client ready (block size {self.block_size}, concurrency {self.max_concurrency})")
+
+    async def close(self):
+        if self.service_client is not None:
+            await self.service_client.close()
+            self.service_client = None
+
+    def blob_client(self, blob_name: str):
+        return self.service_client.get_blob_client(self.container_name, blob_name)
+
+    def staged_upload(self, blob_name: str) -> Optional[StagedBlobUpload]:
+        """A block-by-block upload on the shared client, or None when storage is disabled."""
+        if not self.enabled:
+            return None
+        return StagedBlobUpload(self.blob_client(blob_name), block_size=self.block_size,
+                                max_concurrency=self.max_concurrency, metrics=self.metrics)
+
+    async def upload_file(self, file_path: str, blob_name: str, content_type: Optional[str] = None,
+                          content_encoding: Optional[str] = None) -> str:
+        """
+        Uploads a local file with parallel block uploads and returns the blob URL.
+        `content_type`/`content_encoding` are stored on the blob and sent back as HTTP headers on download.
+        """
+        blob_client = self.blob_client(blob_name)
+        size = os.path.getsize(file_path)
+        content_settings = None
+        if content_type or content_encoding:
+            from azure.storage.blob import ContentSettings
+
+            content_settings = ContentSettings(content_type=content_type, content_encoding=content_encoding)
+        started = time.perf_counter()
+        try:
+            with open(file_path, "rb") as data:
+                await blob_client.upload_blob(data, length=size, overwrite=True, max_concurrency=self.max_concurrency,
+                                              content_settings=content_settings)
+        except Exception:
+            self.metrics.record_failure()
+            raise
+        elapsed = time.perf_counter() - started
+        self.metrics.record(size, elapsed)
+        print(f"Uploaded {blob_name}: {size} bytes in {elapsed:.2f}s ({size / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+        return blob_client.url
+
+    async def upload_bytes(self, blob_name: str, data: bytes) -> str:
+        blob_client = self.blob_client(blob_name)
+        started = time.perf_counter()
+        try:
+            await blob_client.upload_blob(data, overwrite=True)
+        except Exception:
+            self.metrics.record_failure()
+            raise
+        self.metrics.record(len(data), time.perf_counter() - started)
+        return blob_client.url
+
+    async def download_bytes(self, blob_name: str) -> Optional[bytes]:
+        """Returns the content of a blob, or None if it does not exist."""
+        blob_client = self.blob_client(blob_name)
+        if not await blob_client.exists():
+            return None
+        downloader = await blob_client.download_blob(max_concurrency=self.max_concurrency)
+        return await downloader.readall()
+
+    async def download_file(self, blob_name: str, file_path: str) -> Optional[str]:
+        """
+        Streams a blob into a local file and returns the SHA-256 of its content, or None if the
+        blob does not exist. The file is written and hashed chunk by chunk, like an upload.
+        """
+        blob_client = self.blob_client(blob_name)
+        if not await blob_client.exists():
+            return None
+        hasher = hashlib.sha256()
+        started = time.perf_counter()
+        downloader = await blob_client.download_blob(max_concurrency=self.max_concurrency)
+        with open(file_path, "wb") as f:
+            async for chunk in downloader.chunks():
+                f.write(chunk)
+                hasher.update(chunk)
+        size = os.path.getsize(file_path)
+        elapsed = time.perf_counter() - started
+        print(f"Downloaded {blob_name}: {size} bytes in {elapsed:.2f}s ({size / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+        return hasher.hexdigest()
@@ -1,8 +1,55 @@
 import vtk
+import os
 import sys
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import nibabel as nib
+from vtk.util import numpy_support
 
+from pipeline_options import DECIMATION_METHODS, SMOOTHING_PRESETS
+
+# NIfTI affines are RAS+, while SimpleITK / DICOM (and therefore the meshes this
+# backend has always produced) use LPS+. Flipping the first two world axes converts between them.
+RAS_TO_LPS = np.diag([-1.0, -1.0, 1.0])
+
+# Meshes with more faces/points than this get their smoothing parameters estimated from a
+# random sample of that size instead of every edge and point.
+SMOOTHING_PARAM_MAX_SAMPLES = 2_000_000
+
+# Smoothing preset of smooth_mesh when none is given (see pipeline_options.SMOOTHING_PRESETS).
+SMOOTHING_PRESET = os.environ.get("SMOOTHING_PRESET", "quality")
+
+# The coarse preview mesh is extracted from the volume subsampled to at most this many voxels.
+PREVIEW_MAX_VOXELS = 2_000_000
+
+# Surface extraction backend of dicom_to_mesh: "auto", "flying_edges", "marching_cubes" or "skimage".
+SURFACE_BACKEND = os.environ.get("SURFACE_BACKEND", "auto")
+SURFACE_BACKENDS = ("flying_edges", "marching_cubes", "skimage")
+# With "auto", volumes of at least this many voxels use flying edges; smaller ones vtkMarchingCubes.
+FLYING_EDGES_MIN_VOXELS = int(os.environ.get("FLYING_EDGES_MIN_VOXELS", 1_000_000))
+# Threads of VTK's SMP backend, used by flying edges. 0 keeps VTK's default (all cores).
+SURFACE_THREADS = int(os.environ.get("SURFACE_THREADS", 0))
+
+# Relative durations of the smooth_mesh stages (seconds on a 3.5M triangle mesh, 20 iterations),
+# which weight their sub-progress. Measured timings are returned by smooth_mesh, not fed back here:
+# the table is shared by the label worker threads.
+SMOOTHING_STAGE_COSTS = {"triangulate": 0.1, "decimate": 5.8, "orient": 2.1, "laplacian": 5.6,
+                         "windowed_sinc": 3.2, "normals": 4.8}
+
+# clean_mesh merges surface points closer than this fraction of the mesh's bounding box diagonal.
+# Extracted points lie on voxel edges, so nearly coincident ones only come from voxel values at (or
+# next to) the iso value, where they form slivers and zero-length edges.
+MESH_MERGE_TOLERANCE = float(os.environ.get("MESH_MERGE_TOLERANCE", 1e-6))
+# clean_mesh drops connected components with fewer triangles than this (0 keeps all of them): the
+# islands noisy masks produce around the structure. An isolated voxel gives 8 triangles.
+MESH_MIN_COMPONENT_TRIANGLES = int(os.environ.get("MESH_MIN_COMPONENT_TRIANGLES", 100))
+
+# decimate_mesh with "clustering" fits the grid spacing to the target in at most this many passes.
+CLUSTERING_FIT_PASSES = 4
+# surface_deviation projects at most this many vertices of each mesh onto the other one.
+DEVIATION_MAX_SAMPLES = int(os.environ.get("DEVIATION_MAX_SAMPLES", 20_000))
 
 
 def load_dicom_image(dicom_dir):
@@ -33,13 +80,183 @@ def load_dicom_image(dicom_dir):
     return raw_volume_data
 
 
+def volume_to_image_data(data, affine, verbose=True):
+    """
+    Wraps a NIfTI voxel array (x, y, z order, as returned by nibabel) and its
+    4x4 affine into a vtkImageData without copying the voxels.
 
-def dicom_to_mesh(image_data, threshold):
+    Spacing, origin and direction are taken from the affine and expressed in
+    LPS, the same physical frame the DICOM series written by `nii_to_dicom` uses.
+    :return: vtkImageData sharing its scalar buffer with `data`
+    """
+    array = np.asarray(data)
+    while array.ndim > 3 and array.shape[-1] == 1:
+        array = array[..., 0]
+    if array.ndim != 3:
+        raise ValueError(f"Expected a 3D volume, got shape {array.shape}")
+    if array.dtype == np.bool_:
+        array = array.view(np.uint8)
+
+    # VTK expects x to vary fastest, which is Fortran order for an (x, y, z) array.
+    # nibabel arrays are Fortran-ordered already, so this is a view and not a copy.
+    flat = np.ascontiguousarray(array.reshape(-1, order="F"))
+
+    affine = np.asarray(affine, dtype=float)
+    linear = affine[:3, :3]
+    spacing = np.linalg.norm(linear, axis=0)
+    spacing[spacing == 0] = 1.0
+    direction = RAS_TO_LPS @ (linear / spacing)
+    origin = RAS_TO_LPS @ affine[:3, 3]
+
+    image_data = vtk.vtkImageData()
+    image_data.SetDimensions(*array.shape)
+    image_data.SetSpacing(*spacing)
+    image_data.SetOrigin(*origin)
+    image_data.SetDirectionMatrix(*direction.ravel())
+
+    # deep=False keeps a reference to `flat` on the VTK array so the buffer stays alive.
+    scalars = numpy_support.numpy_to_vtk(flat, deep=False)
+    scalars.SetName("Scalars")
+    image_data.GetPointData().SetScalars(scalars)
+
+    if verbose:
+        print(f"In-memory volume spacing: {tuple(spacing)}")
+        print(f"Volume dimensions: {array.shape}")
+        print(f"Volume origin: {tuple(origin)}")
+    return image_data
+
+
+def downsample_volume(image_data, max_voxels=PREVIEW_MAX_VOXELS):
+    """
+    Keeps every n-th voxel along each axis, with n chosen so the result has at most
+    `max_voxels` voxels. Spacing grows by n; origin and direction are unchanged.
+    :return: (vtkImageData, n). n == 1 means the volume was already small enough and is returned as is.
     """
-    Converts a DICOM volume (vtkImageData) into a 3D mesh using Marching Cubes.
+    dims = image_data.GetDimensions()
+    voxels = dims[0] * dims[1] * dims[2]
+    factor = 1
+    while voxels / factor ** 3 > max_voxels:
+        factor += 1
+    if factor == 1:
+        return image_data, 1
+
+    shrink = vtk.vtkImageShrink3D()
+    shrink.SetInputData(image_data)
+    shrink.SetShrinkFactors(factor, factor, factor)
+    shrink.AveragingOff()  # Subsample: averaging would move the isosurface of a binary mask
+    shrink.Update()
+    return shrink.GetOutput(), factor
+
+
+def decimate_mesh(mesh, target_reduction, progress=None, method="quadric"):
+    """
+    Returns a decimated copy of the mesh with `target_reduction` of its triangles removed. The
+    input mesh is left untouched. `progress(fraction)` is called as the decimation advances
+    (see watch_progress).
+
+    :param method: "quadric" (vtkQuadricDecimation, reaches the target exactly) or "clustering"
+                   (vtkQuadricClustering, see _cluster_mesh; at most the target, usually a little less)
+    """
+    if method not in DECIMATION_METHODS:
+        raise ValueError(f"Unknown decimation method: {method}")
+    if method == "clustering":
+        return _cluster_mesh(mesh, int(mesh.GetNumberOfCells() * (1.0 - target_reduction)), progress)
+
+    decimate = vtk.vtkQuadricDecimation()
+    decimate.SetInputData(mesh)
+    decimate.SetTargetReduction(target_reduction)
+    decimate.VolumePreservationOn()
+    raise_progress_error = watch_progress(progress, [decimate])
+    decimate.Update()
+    raise_progress_error()
+
+    decimated = vtk.vtkPolyData()
+    decimated.ShallowCopy(decimate.GetOutput())
+    return decimated
+
+
+def _cluster_mesh(mesh, target_triangles, progress=None):
+    """
+    Quadric clustering of the mesh to at most `target_triangles`: all points in a cell of a regular
+    grid are merged into one, placed where it minimizes the quadric error of their triangles.
+
+    The output has about twice as many triangles as grid cells crossed by the surface, so the cell
+    size starts at sqrt(2 * area / target) and is corrected from the count of every pass
+    (at most CLUSTERING_FIT_PASSES). The largest result within the target is returned.
+    """
+    points = numpy_support.vtk_to_numpy(mesh.GetPoints().GetData()).astype(np.float64)
+    faces = numpy_support.vtk_to_numpy(mesh.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    first = points[faces[:, 0]]
+    area = 0.5 * np.linalg.norm(np.cross(points[faces[:, 1]] - first, points[faces[:, 2]] - first), axis=1).sum()
+    bounds = mesh.GetBounds()
+    extents = [bounds[1] - bounds[0], bounds[3] - bounds[2], bounds[5] - bounds[4]]
+    spacing = np.sqrt(2.0 * area / max(target_triangles, 1))
+
+    best = None
+    for index in range(CLUSTERING_FIT_PASSES):
+        cluster = vtk.vtkQuadricClustering()
+        cluster.SetInputData(mesh)
+        cluster.AutoAdjustNumberOfDivisionsOff()
+        cluster.SetNumberOfDivisions(*(max(1, int(np.ceil(extent / spacing))) for extent in extents))
+        cluster.UseInputPointsOff()
+        cluster.CopyCellDataOff()
+        pass_progress = None if progress is None else (
+            lambda fraction, index=index: progress((index + fraction) / CLUSTERING_FIT_PASSES))
+        raise_progress_error = watch_progress(pass_progress, [cluster])
+        cluster.Update()
+        raise_progress_error()
+
+        triangles = cluster.GetOutput().GetNumberOfCells()
+        if triangles <= target_triangles and (best is None or triangles > best.GetNumberOfCells()):
+            best = vtk.vtkPolyData()
+            best.ShallowCopy(cluster.GetOutput())
+        if best is not None and best.GetNumberOfCells() >= 0.95 * target_triangles:
+            break
+        # Aim a little below the target, so that a pass overshooting by a few triangles is rare
+        spacing *= np.sqrt(max(triangles, 1) / (0.97 * target_triangles))
+
+    if best is None:
+        best = vtk.vtkPolyData()
+        best.ShallowCopy(cluster.GetOutput())
+    if progress is not None:
+        progress(1.0)
+    return best
+
+
+def surface_deviation(reference, mesh, max_samples=DEVIATION_MAX_SAMPLES, seed=0):
+    """
+    Sampled symmetric distance between two surfaces, e.g. an extracted mesh and its decimated and
+    smoothed version: up to `max_samples` vertices of each mesh are projected onto the triangles of
+    the other one (vtkImplicitPolyDataDistance). Sampling vertices can miss the farthest point, so
+    "hausdorff" is a lower bound of the true Hausdorff distance.
+    :return: {"hausdorff", "mean", "rms", "p95", "samples"}, distances in mesh units (mm)
+    """
+    rng = np.random.default_rng(seed)
+    distances = []
+    for source, target in ((reference, mesh), (mesh, reference)):
+        points = numpy_support.vtk_to_numpy(source.GetPoints().GetData())
+        sample = points[_sample_indices(len(points), max_samples, rng)].astype(np.float64)
+        implicit = vtk.vtkImplicitPolyDataDistance()
+        implicit.SetInput(target)
+        values = vtk.vtkDoubleArray()
+        implicit.FunctionValue(numpy_support.numpy_to_vtk(sample, deep=True), values)
+        distances.append(np.abs(numpy_support.vtk_to_numpy(values)))
+    distances = np.concatenate(distances)
+    return {"hausdorff": float(distances.max()), "mean": float(distances.mean()),
+            "rms": float(np.sqrt(np.mean(distances ** 2))), "p95": float(np.percentile(distances, 95)),
+            "samples": int(len(distances))}
+
+
+def dicom_to_mesh(image_data, threshold, backend=None, compute_normals=True, threads=None, progress=None):
+    """
+    Converts a DICOM volume (vtkImageData) into a 3D isosurface mesh.
 
     :param image_data: vtkImageData object containing the loaded DICOM volume
     :param threshold: Lower threshold for mesh generation
+    :param backend: "flying_edges", "marching_cubes", "skimage" or "auto" (default: SURFACE_BACKEND)
+    :param compute_normals: Whether to compute point normals (smooth_mesh recomputes them anyway)
+    :param threads: SMP threads for flying edges (default: SURFACE_THREADS)
+    :param progress: optional `progress(fraction)` called as the extraction advances (see watch_progress)
     :param use_upper_threshold: Whether to apply an upper threshold
     :param upper_threshold: Upper threshold value if enabled
     :return: vtkPolyData object containing the generated mesh
@@ -59,22 +276,288 @@ def dicom_to_mesh(image_data, threshold):
         image_data.DeepCopy(image_threshold.GetOutput())
     else:
     '''
-    print(f"Creating surface mesh with iso value = {threshold}")
+    backend = select_surface_backend(image_data, backend)
+    print(f"Creating surface mesh with iso value = {threshold} ({backend})")
+    mesh = _extract_surface(image_data, threshold, backend, compute_normals,
+                            SURFACE_THREADS if threads is None else threads, progress)
+    print("Mesh generation complete.")
+    return mesh
+
 
-    # Apply Marching Cubes algorithm
-    surface_extractor = vtk.vtkMarchingCubes()
+def _extract_surface(image_data, threshold, backend, compute_normals=True, threads=0, progress=None):
+    """Runs one surface extraction backend and returns a vtkPolyData it does not share with a filter."""
+    if backend == "skimage":
+        mesh = _skimage_surface(image_data, threshold, compute_normals)
+        if progress is not None:
+            progress(1.0)
+        return mesh
+
+    if backend == "flying_edges":
+        configure_threads(threads)
+        surface_extractor = vtk.vtkFlyingEdges3D()
+    else:
+        surface_extractor = vtk.vtkMarchingCubes()
     surface_extractor.SetInputData(image_data)
-    surface_extractor.ComputeNormalsOn()
+    surface_extractor.SetComputeNormals(compute_normals)
     surface_extractor.SetValue(0, threshold)  # Set isovalue
-    surface_extractor.Update()
+    output_port = surface_extractor.GetOutputPort()
+    algorithms, weights = [surface_extractor], [3.0]
+
+    if backend == "flying_edges":
+        # Flying edges does not merge coincident vertices, which it creates when the iso value equals
+        # voxel values (e.g. 1 on a binary mask). Welding them gives the same mesh as vtkMarchingCubes.
+        weld = _exact_weld()
+        weld.SetInputConnection(output_port)
+        output_port = weld.GetOutputPort()
+        algorithms.append(weld)
+        weights.append(1.0)
+
+    raise_progress_error = watch_progress(progress, algorithms, weights)
+    output_port.GetProducer().Update()
+    raise_progress_error()
 
     # Extract mesh
     mesh = vtk.vtkPolyData()
-    mesh.DeepCopy(surface_extractor.GetOutput())
+    mesh.ShallowCopy(output_port.GetProducer().GetOutput())
+    return mesh
+
+
+def _skimage_surface(image_data, threshold, compute_normals=True):
+    """
+    Marching cubes of scikit-image on the NumPy view of the volume. Vertices are mapped to world
+    coordinates with the volume's spacing, direction and origin, like the VTK backends. Its Lewiner
+    case tables triangulate binary masks differently (more, smaller triangles), but the surface
+    encloses the same volume.
+    """
+    from skimage import measure  # Optional: only needed for this backend
+
+    dims = image_data.GetDimensions()
+    scalars = image_data.GetPointData().GetScalars()
+    volume = numpy_support.vtk_to_numpy(scalars).reshape(dims[::-1])  # (z, y, x) view, no copy
+    low, high = volume.min(), volume.max()
+    if not low < threshold <= high:
+        return vtk.vtkPolyData()
+    # skimage needs the level strictly inside the data range; VTK treats the maximum as inside too.
+    level = float(threshold) if threshold < high else float(np.nextafter(threshold, low))
+    vertices, faces, normals, _ = measure.marching_cubes(volume, level=level)
+
+    spacing = np.array(image_data.GetSpacing())
+    direction = np.array([image_data.GetDirectionMatrix().GetElement(i, j)
+                          for i in range(3) for j in range(3)]).reshape(3, 3)
+    points = (vertices[:, ::-1] * spacing) @ direction.T + np.array(image_data.GetOrigin())
+    mesh = _polydata_from_arrays(points, faces)
+    if compute_normals:
+        world_normals = (normals[:, ::-1] / spacing) @ direction.T
+        world_normals /= np.maximum(np.linalg.norm(world_normals, axis=1, keepdims=True), 1e-12)
+        normal_array = numpy_support.numpy_to_vtk(np.ascontiguousarray(world_normals, dtype=np.float32), deep=True)
+        normal_array.SetName("Normals")
+        mesh.GetPointData().SetNormals(normal_array)
+
+    # Like flying edges, skimage leaves coincident vertices when the level sits on voxel values.
+    weld = _exact_weld()
+    weld.SetInputData(mesh)
+    weld.Update()
+    welded = vtk.vtkPolyData()
+    welded.ShallowCopy(weld.GetOutput())
+    return welded
+
+
+def watch_progress(progress, algorithms, weights=None):
+    """
+    Reports the combined progress of VTK algorithms that run one after the other as a single
+    fraction, `progress(fraction)`, each weighted by its expected share of the run time. Filters
+    that emit no ProgressEvents in between (e.g. flying edges, the writers) jump from 0 to 1.
+
+    An exception raised by `progress` (e.g. a cancelled job) aborts the running filter, and every
+    later one at its first ProgressEvent; call the returned function after the update to re-raise it.
+    """
+    errors = []
+    if progress is not None:
+        weights = list(weights) if weights is not None else [1.0] * len(algorithms)
+        total = sum(weights) or 1.0
+        offset = 0.0
+        for algorithm, weight in zip(algorithms, weights):
+            def on_progress(caller, _event, offset=offset / total, share=weight / total):
+                if not errors:
+                    try:
+                        progress(offset + share * caller.GetProgress())
+                    except Exception as e:
+                        errors.append(e)
+                if errors:
+                    caller.AbortExecuteOn()
+
+            algorithm.AddObserver("ProgressEvent", on_progress)
+            offset += weight
+
+    def raise_progress_error():
+        if errors:
+            raise errors[0]
+
+    return raise_progress_error
+
+
+def _exact_weld():
+    """vtkStaticCleanPolyData merging only exactly coincident points and keeping every triangle."""
+    weld = vtk.vtkStaticCleanPolyData()
+    weld.SetTolerance(0.0)
+    weld.ConvertPolysToLinesOff()
+    weld.ConvertLinesToPointsOff()
+    weld.ConvertStripsToPolysOff()
+    return weld
+
+
+def configure_threads(threads=SURFACE_THREADS):
+    """
+    Sets the number of threads VTK's SMP filters (flying edges) may use. Builds whose SMP backend
+    is sequential are switched to std::thread when more than one thread is asked for.
+    """
+    if not threads or threads <= 0:
+        return
+    smp = vtk.vtkSMPTools
+    if threads > 1 and smp.GetBackend() == "Sequential" and hasattr(smp, "SetBackend"):
+        smp.SetBackend("STDThread")
+    smp.Initialize(threads)
+
+
+def select_surface_backend(image_data, backend=None):
+    """Resolves "auto" (or None, meaning SURFACE_BACKEND) to a concrete backend for this volume."""
+    backend = backend or SURFACE_BACKEND
+    if backend == "auto":
+        dims = image_data.GetDimensions()
+        large = dims[0] * dims[1] * dims[2] >= FLYING_EDGES_MIN_VOXELS
+        backend = "flying_edges" if large and hasattr(vtk, "vtkFlyingEdges3D") else "marching_cubes"
+    if backend not in SURFACE_BACKENDS:
+        raise ValueError(f"Unknown surface backend: {backend}")
+    return backend
+
+
+def slabs_to_mesh(slabs, affine, threshold, workers=1, progress=None, backend=None):
+    """
+    Out-of-core counterpart of `dicom_to_mesh`: extracts the isosurface of one Z-slab of the volume
+    at a time and welds the pieces into one mesh.
+
+    :param slabs: iterable of `(z start, (x, y, n) voxel array)` in which consecutive slabs share
+                  one slice (see volume_io.iter_overlapping_slabs), so every cell is in exactly one slab
+    :param affine: 4x4 affine of the whole volume; each slab's origin is shifted to its first slice
+    :param workers: slabs extracted concurrently. At most `workers + 1` slabs are in memory at once.
+    :param progress: optional `progress(z end)` called as slabs are read
+    :param backend: as in `dicom_to_mesh`; "auto" means flying edges, since only large volumes are
+                    meshed out of core
+    :return: vtkPolyData with the same triangles as `dicom_to_mesh` on the whole volume. Only the
+             gradient normals of vertices on the shared slices may differ slightly.
+    """
+    affine = np.asarray(affine, dtype=float)
+    backend = backend or SURFACE_BACKEND
+    if backend == "auto":
+        backend = "flying_edges" if hasattr(vtk, "vtkFlyingEdges3D") else "marching_cubes"
+    if backend not in SURFACE_BACKENDS:
+        raise ValueError(f"Unknown surface backend: {backend}")
+    print(f"Creating surface mesh slab by slab with iso value = {threshold} ({backend})")
+
+    def extract(start, slab):
+        if slab.max() < threshold or slab.min() > threshold:
+            return None  # No isosurface crosses this slab
+        slab_affine = affine.copy()
+        slab_affine[:3, 3] += affine[:3, :3] @ np.array([0.0, 0.0, start])
+        piece = _extract_surface(volume_to_image_data(slab, slab_affine, verbose=False), threshold, backend,
+                                 threads=1 if workers > 1 else SURFACE_THREADS)
+        return piece if piece.GetNumberOfCells() > 0 else None
+
+    pieces, pending = [], collections.deque()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for start, slab in slabs:
+            end = start + slab.shape[-1]
+            pending.append(executor.submit(extract, start, slab))
+            del slab
+            if callable(progress):
+                progress(end)
+            while len(pending) > workers:
+                pieces.append(pending.popleft().result())
+        pieces.extend(future.result() for future in pending)
+    pieces = [piece for piece in pieces if piece is not None]
+    if not pieces:
+        return vtk.vtkPolyData()
+
+    # Vertices on the shared slices were created by both neighbouring slabs: merge exact duplicates.
+    append = vtk.vtkAppendPolyData()
+    for piece in pieces:
+        append.AddInputData(piece)
+    weld = _exact_weld()
+    weld.SetInputConnection(append.GetOutputPort())
+    weld.Update()
+
+    mesh = vtk.vtkPolyData()
+    mesh.ShallowCopy(weld.GetOutput())
+    print(f"Mesh generation complete ({len(pieces)} slabs with surface).")
+    return mesh
+
+
+def extract_label_meshes(image_data, labels, progress=None):
+    """
+    Extracts the surface of every label in `labels` from a label volume in a single pass
+    (discrete flying edges, or discrete marching cubes on VTK builds without it) and splits
+    the result into one mesh per label. Surfaces shared by two labels appear in both meshes.
+    `progress(fraction)` is called as the extraction advances (see watch_progress).
+    :return: {label: vtkPolyData}, without entries for labels that produced no triangles
+    """
+    labels = [int(label) for label in labels]
+    print(f"Creating surface meshes for {len(labels)} labels")
+
+    if hasattr(vtk, "vtkDiscreteFlyingEdges3D"):
+        surface_extractor = vtk.vtkDiscreteFlyingEdges3D()
+    else:
+        surface_extractor = vtk.vtkDiscreteMarchingCubes()
+    surface_extractor.SetInputData(image_data)
+    for index, label in enumerate(labels):
+        surface_extractor.SetValue(index, label)
+    surface_extractor.ComputeScalarsOn()
+    raise_progress_error = watch_progress(progress, [surface_extractor])
+    surface_extractor.Update()
+    raise_progress_error()
+    combined = surface_extractor.GetOutput()
+    if combined.GetNumberOfCells() == 0:
+        return {}
+
+    points = numpy_support.vtk_to_numpy(combined.GetPoints().GetData())
+    faces = numpy_support.vtk_to_numpy(combined.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    # Flying edges labels the points (which are not shared between labels), marching cubes the cells.
+    cell_labels = combined.GetCellData().GetScalars()
+    if cell_labels is not None:
+        face_labels = numpy_support.vtk_to_numpy(cell_labels).ravel()
+    else:
+        face_labels = numpy_support.vtk_to_numpy(combined.GetPointData().GetScalars()).ravel()[faces[:, 0]]
+
+    order = np.argsort(face_labels, kind="stable")
+    sorted_labels = face_labels[order]
+    meshes = {}
+    for label in labels:
+        start, end = np.searchsorted(sorted_labels, [label, label + 1])
+        if start == end:
+            continue
+        label_faces = faces[order[start:end]]
+        used, remapped = np.unique(label_faces, return_inverse=True)
+        meshes[label] = _polydata_from_arrays(points[used], remapped.reshape(-1, 3))
 
     print("Mesh generation complete.")
+    return meshes
+
+
+def _polydata_from_arrays(points, faces):
+    """Builds a triangle vtkPolyData from an (n, 3) point array and an (m, 3) index array."""
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(points), deep=True))
+
+    offsets = np.arange(0, 3 * len(faces) + 1, 3, dtype=np.int64)
+    polys = vtk.vtkCellArray()
+    polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True),
+                  numpy_support.numpy_to_vtkIdTypeArray(faces.astype(np.int64).ravel(), deep=True))
+
+    mesh = vtk.vtkPolyData()
+    mesh.SetPoints(vtk_points)
+    mesh.SetPolys(polys)
     return mesh
 
+
 def apply_affine_transform_to_mesh(mesh, affine_matrix):
     """
     Applies the full 4x4 affine transformation matrix to a vtkPolyData mesh.
@@ -100,7 +583,7 @@ def apply_affine_transform_to_mesh(mesh, affine_matrix):
 
 def save_mesh_as_stl(mesh, output_path):
     """
-    Saves a vtkPolyData mesh as an STL file.
+    Saves a vtkPolyData mesh as a binary STL file.
 
     :param mesh: vtkPolyData object containing the generated mesh
     :param output_path: Path to save the STL file
@@ -108,102 +591,302 @@ def save_mesh_as_stl(mesh, output_path):
     stl_writer = vtk.vtkSTLWriter()
     stl_writer.SetFileName(output_path)
     stl_writer.SetInputData(mesh)
+    stl_writer.SetFileTypeToBinary()
     stl_writer.Write()
     print(f"STL file saved at: {output_path}")
 
-def smooth_mesh(mesh, nbr_of_smoothing_iterations, feature_angle, relaxation_factor):
-    print(f"Mesh smoothing with {nbr_of_smoothing_iterations} iterations.")
+def clean_mesh(mesh, merge_tolerance=None, min_component_triangles=None, progress=None):
+    """
+    Cleans an extracted surface in place before it is smoothed, in passes that are linear in its size:
+
+    1. merges points closer than `merge_tolerance` (relative to the bounding box diagonal, default
+       MESH_MERGE_TOLERANCE) with vtkStaticCleanPolyData; triangles that collapse are dropped;
+    2. drops connected components of fewer than `min_component_triangles` triangles (default
+       MESH_MIN_COMPONENT_TRIANGLES), but never the largest one;
+    3. drops the remaining degenerate (zero-area) triangles.
+
+    Point and cell data are not kept when triangles are dropped (smooth_mesh recomputes the normals).
+    `progress(fraction)` is called as the VTK passes advance (see watch_progress).
+    :return: {"triangles_before", "triangles_after", "points_merged", "collapsed_triangles",
+              "components_removed", "component_triangles", "degenerate_triangles", "seconds": {step: seconds}}
+    """
+    merge_tolerance = MESH_MERGE_TOLERANCE if merge_tolerance is None else merge_tolerance
+    min_component_triangles = (MESH_MIN_COMPONENT_TRIANGLES if min_component_triangles is None
+                               else min_component_triangles)
+    triangles_before, points_before = mesh.GetNumberOfCells(), mesh.GetNumberOfPoints()
+    seconds = {}
+
+    merge = vtk.vtkStaticCleanPolyData()
+    merge.SetTolerance(merge_tolerance)
+    merge.ConvertPolysToLinesOff()  # Collapsed triangles are dropped instead of becoming lines
+    merge.ConvertLinesToPointsOff()
+    merge.ConvertStripsToPolysOff()
+    if _is_triangle_mesh(mesh):
+        merge.SetInputData(mesh)
+    else:
+        triangulate = vtk.vtkTriangleFilter()
+        triangulate.SetInputData(mesh)
+        merge.SetInputConnection(triangulate.GetOutputPort())
+    connectivity = vtk.vtkPolyDataConnectivityFilter()
+    connectivity.SetExtractionModeToAllRegions()
+    connectivity.ColorRegionsOn()
+    raise_progress_error = watch_progress(progress, [merge, connectivity])
+
+    started = time.perf_counter()
+    merge.Update()
+    raise_progress_error()
+    merged = merge.GetOutput()
+    seconds["merge"] = time.perf_counter() - started
+    stats = {"triangles_before": triangles_before,
+             "points_merged": points_before - merged.GetNumberOfPoints(),
+             "collapsed_triangles": triangles_before - merged.GetNumberOfCells(),
+             "components_removed": 0, "component_triangles": 0, "degenerate_triangles": 0}
+
+    if merged.GetNumberOfCells() == 0:
+        result = merged
+    else:
+        started = time.perf_counter()
+        keep = None
+        if min_component_triangles > 0:
+            connectivity.SetInputData(merged)
+            connectivity.Update()
+            raise_progress_error()
+            merged = connectivity.GetOutput()
+        points = numpy_support.vtk_to_numpy(merged.GetPoints().GetData())
+        faces = numpy_support.vtk_to_numpy(merged.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+        if min_component_triangles > 0:
+            # Recent VTK versions only label the points; all points of a triangle are in its region.
+            region_ids = numpy_support.vtk_to_numpy(merged.GetPointData().GetArray("RegionId"))[faces[:, 0]]
+            sizes = np.bincount(region_ids)
+            small = sizes < min_component_triangles
+            small[np.argmax(sizes)] = False  # A small mesh is still better than no mesh
+            keep = ~small[region_ids]
+            stats["components_removed"] = int(small.sum())
+            stats["component_triangles"] = int(len(keep) - keep.sum())
+        seconds["components"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        first = points[faces[:, 0]]
+        doubled_areas = np.linalg.norm(np.cross(points[faces[:, 1]] - first, points[faces[:, 2]] - first), axis=1)
+        degenerate = doubled_areas == 0
+        if keep is not None:
+            degenerate &= keep
+            keep &= ~degenerate
+        else:
+            keep = ~degenerate
+        stats["degenerate_triangles"] = int(degenerate.sum())
+
+        if keep.all():
+            result = merged
+            merged.GetPointData().RemoveArray("RegionId")
+        else:
+            faces = faces[keep]
+            used = np.zeros(len(points), dtype=bool)
+            used[faces] = True
+            new_ids = np.cumsum(used) - 1  # Points no triangle uses anymore are dropped
+            result = _polydata_from_arrays(points[used], new_ids[faces])
+        seconds["degenerate"] = time.perf_counter() - started
+
+    mesh.ShallowCopy(result)
+    stats["triangles_after"] = mesh.GetNumberOfCells()
+    stats["seconds"] = {step: round(value, 4) for step, value in seconds.items()}
+    print(f"Mesh cleaning: {triangles_before} -> {stats['triangles_after']} triangles "
+          f"({stats['points_merged']} points merged, {stats['collapsed_triangles']} collapsed, "
+          f"{stats['components_removed']} islands with {stats['component_triangles']} triangles, "
+          f"{stats['degenerate_triangles']} degenerate) in {sum(seconds.values()):.2f}s.")
+    return stats
+
+
+def smooth_mesh(mesh, nbr_of_smoothing_iterations, feature_angle, relaxation_factor, target_reduction=0.1,
+                preset=None, split_normals=True, progress=None):
+    """
+    Decimates and smooths the mesh in place, then recomputes its normals.
 
-    # Step 1: Ensure the mesh is triangulated
-    triangulate = vtk.vtkTriangleFilter()
-    triangulate.SetInputData(mesh)
-    triangulate.Update()
+    The stages are connected into one VTK pipeline that is updated once, and every intermediate
+    output is released as soon as the next stage has consumed it, so at most two copies of the
+    mesh exist at a time. The result replaces the mesh's data by reference (no deep copy).
 
-    # Step 2: Reduce unnecessary complexity using DecimatePro (Limit reduction)
-    decimate = vtk.vtkDecimatePro()
-    decimate.SetInputData(triangulate.GetOutput())
-    decimate.SetTargetReduction(0.1)  # Reduce only 10% to preserve topology
-    decimate.PreserveTopologyOn()
-    decimate.Update()
+    :param preset: "quality" or "fast" (default: SMOOTHING_PRESET)
+    :param split_normals: Whether to duplicate the points along sharp edges so they shade as creases
+    :param progress: optional `progress(fraction)` called as the stages advance, each weighted by
+                     SMOOTHING_STAGE_COSTS (see watch_progress)
+    :return: {stage: seconds} of the stages that ran
+    """
+    preset = preset or SMOOTHING_PRESET
+    if preset not in SMOOTHING_PRESETS:
+        raise ValueError(f"Unknown smoothing preset: {preset}")
+    print(f"Mesh smoothing with {nbr_of_smoothing_iterations} iterations ({preset}).")
 
-    # Step 3: Compute Normals for accurate smoothing
-    normals = vtk.vtkPolyDataNormals()
-    normals.SetInputData(decimate.GetOutput())
-    normals.ComputePointNormalsOn()
-    normals.ComputeCellNormalsOn()
-    normals.SplittingOff()  # Avoid unwanted artifacts
-    normals.Update()
+    stages = []
+
+    def add_stage(name, algorithm):
+        if stages:
+            algorithm.SetInputConnection(stages[-1][1].GetOutputPort())
+        else:
+            algorithm.SetInputData(mesh)
+        stages.append((name, algorithm))
+
+    # Step 1: Ensure the mesh is triangulated (surface extraction already outputs triangles only)
+    if not _is_triangle_mesh(mesh):
+        add_stage("triangulate", vtk.vtkTriangleFilter())
+
+    # Step 2: Reduce unnecessary complexity using DecimatePro (Limit reduction)
+    if target_reduction > 0:
+        decimate = vtk.vtkDecimatePro()
+        decimate.SetTargetReduction(target_reduction)  # Default reduces only 10% to preserve topology
+        decimate.PreserveTopologyOn()
+        add_stage("decimate", decimate)
+
+    # Step 3: Make the triangle winding consistent, which DecimatePro does not guarantee and the feature
+    # edge detection of the windowed sinc pass relies on. The smoothers do not read normals, so only
+    # the (cheaper) cell normals are computed, which is what triggers the reordering.
+    orient = vtk.vtkPolyDataNormals()
+    orient.ComputePointNormalsOff()
+    orient.ComputeCellNormalsOn()
+    orient.SplittingOff()  # Avoid unwanted artifacts
+    add_stage("orient", orient)
 
     # Step 4: First pass - Laplacian smoothing (gentle smoothing)
-    smoother1 = vtk.vtkSmoothPolyDataFilter()
-    smoother1.SetInputData(normals.GetOutput())
-    smoother1.SetNumberOfIterations(nbr_of_smoothing_iterations // 2)  # Less aggressive
-    smoother1.SetRelaxationFactor(relaxation_factor)  # Adjustable smoothing strength
-    smoother1.FeatureEdgeSmoothingOff()  # Keep edges intact
-    smoother1.BoundarySmoothingOn()
-    smoother1.Update()
+    if preset == "quality":
+        smoother1 = vtk.vtkSmoothPolyDataFilter()
+        smoother1.SetNumberOfIterations(nbr_of_smoothing_iterations // 2)  # Less aggressive
+        smoother1.SetRelaxationFactor(relaxation_factor)  # Adjustable smoothing strength
+        smoother1.FeatureEdgeSmoothingOff()  # Keep edges intact
+        smoother1.BoundarySmoothingOn()
+        add_stage("laplacian", smoother1)
 
     # Step 5: Second pass - Windowed Sinc smoothing (for finer details)
     smoother2 = vtk.vtkWindowedSincPolyDataFilter()
-    smoother2.SetInputData(smoother1.GetOutput())
     smoother2.SetNumberOfIterations(nbr_of_smoothing_iterations // 2)
     smoother2.BoundarySmoothingOn()
     smoother2.FeatureEdgeSmoothingOn()
     smoother2.SetFeatureAngle(feature_angle)  # Preserve sharper edges
     smoother2.SetPassBand(0.05)  # Reduced pass band for finer smoothing
     smoother2.NormalizeCoordinatesOn()
-    smoother2.Update()
+    add_stage("windowed_sinc", smoother2)
 
-    # Step 6: Recompute Normals (Final Refinement)
+    # Step 6: Compute Normals (Final Refinement)
     final_normals = vtk.vtkPolyDataNormals()
-    final_normals.SetInputData(smoother2.GetOutput())
     final_normals.ComputePointNormalsOn()
     final_normals.ComputeCellNormalsOn()
+    final_normals.ConsistencyOff()  # Smoothing moves points only, so the winding is still consistent
+    if not split_normals:
+        final_normals.SplittingOff()
+    add_stage("normals", final_normals)
+
+    timings, started = {}, {}
+    for name, algorithm in stages:
+        algorithm.AddObserver("StartEvent", lambda *_, name=name: started.__setitem__(name, time.perf_counter()))
+        algorithm.AddObserver("EndEvent",
+                              lambda *_, name=name: timings.__setitem__(name, time.perf_counter() - started[name]))
+    for _, algorithm in stages[:-1]:
+        algorithm.ReleaseDataFlagOn()
+    raise_progress_error = watch_progress(progress, [algorithm for _, algorithm in stages],
+                                          [SMOOTHING_STAGE_COSTS.get(name, 1.0) for name, _ in stages])
     final_normals.Update()
+    raise_progress_error()
 
-    # Copy back to original mesh
-    mesh.DeepCopy(final_normals.GetOutput())
+    # Hand the result over to the original mesh
+    mesh.ShallowCopy(final_normals.GetOutput())
 
-    print(f"Smoothing complete with feature angle: {feature_angle} and relaxation factor: {relaxation_factor}.")
+    print(f"Smoothing complete with feature angle: {feature_angle} and relaxation factor: {relaxation_factor} "
+          f"({', '.join(f'{name} {seconds:.2f}s' for name, seconds in timings.items())}).")
+    return timings
+
+
+def _is_triangle_mesh(mesh):
+    """True when every cell of the mesh is a triangle (no strips, quads or other polygons)."""
+    if mesh.GetNumberOfStrips() > 0 or mesh.GetNumberOfVerts() > 0 or mesh.GetNumberOfLines() > 0:
+        return False
+    offsets = numpy_support.vtk_to_numpy(mesh.GetPolys().GetOffsetsArray())
+    return bool(np.all(np.diff(offsets) == 3))
+
+
+def _sample_indices(count, max_samples, rng):
+    """Returns all indices below `count`, or a sorted random subset of `max_samples` of them."""
+    if max_samples is None or count <= max_samples:
+        return np.arange(count)
+    return np.sort(rng.choice(count, size=max_samples, replace=False))
+
+
+def _edge_vertex_pairs(mesh, max_samples, rng):
+    """
+    Returns an (n, 2) array of point ids, one row per mesh edge.
+    Exact mode uses vtkExtractEdges; sampling mode takes the edges of a random subset of
+    polygons directly from the cell connectivity, without building the edge set at all.
+    """
+    if max_samples is not None and mesh.GetNumberOfCells() > max_samples:
+        polys = mesh.GetPolys()
+        offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+        connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+        sizes = np.diff(offsets)
+        cells = np.flatnonzero(sizes >= 2)
+        cells = cells[_sample_indices(len(cells), max_samples // 3 or 1, rng)]
+        # First edge and the closing edge of every sampled polygon (all edges for triangles).
+        starts = offsets[cells]
+        ends = offsets[cells + 1] - 1
+        pairs = [np.stack([connectivity[starts], connectivity[starts + 1]], axis=1),
+                 np.stack([connectivity[ends], connectivity[starts]], axis=1)]
+        triangles = sizes[cells] == 3
+        pairs.append(np.stack([connectivity[starts[triangles] + 1], connectivity[starts[triangles] + 2]], axis=1))
+        return np.concatenate(pairs), mesh
 
-def compute_smoothing_params(mesh):
-    # Compute basic properties
-    num_points = mesh.GetNumberOfPoints()
-    num_faces = mesh.GetNumberOfCells()
-    
-    # Compute mean edge length
-    edge_lengths = []
     edges = vtk.vtkExtractEdges()
     edges.SetInputData(mesh)
     edges.Update()
     edge_poly = edges.GetOutput()
+    lines = edge_poly.GetLines()
+    offsets = numpy_support.vtk_to_numpy(lines.GetOffsetsArray())
+    connectivity = numpy_support.vtk_to_numpy(lines.GetConnectivityArray())
+    two_point = np.flatnonzero(np.diff(offsets) == 2)
+    starts = offsets[two_point]
+    return np.stack([connectivity[starts], connectivity[starts + 1]], axis=1), edge_poly
+
+
+def compute_smoothing_params(mesh, max_samples=None, seed=0):
+    """
+    Derives smoothing parameters from the mesh: iterations from the face count, feature angle
+    from the median normal variation and relaxation factor from the mean edge length.
+
+    All measurements run on NumPy views of the VTK arrays. With `max_samples` set, meshes with
+    more faces/points than that are measured on a random subset (`seed` makes it repeatable).
+    """
+    rng = np.random.default_rng(seed)
+
+    # Compute basic properties
+    num_points = mesh.GetNumberOfPoints()
+    num_faces = mesh.GetNumberOfCells()
     
-    for i in range(edge_poly.GetNumberOfCells()):
-        pts = edge_poly.GetCell(i).GetPoints()
-        if pts.GetNumberOfPoints() == 2:
-            p1 = pts.GetPoint(0)
-            p2 = pts.GetPoint(1)
-            edge_lengths.append(vtk.vtkMath.Distance2BetweenPoints(p1, p2) ** 0.5)
-    
-    avg_edge_length = sum(edge_lengths) / len(edge_lengths) if edge_lengths else 1.0
+    # Compute mean edge length
+    pairs, edge_poly = _edge_vertex_pairs(mesh, max_samples, rng)
+    if len(pairs):
+        points = numpy_support.vtk_to_numpy(edge_poly.GetPoints().GetData())
+        edge_vectors = points[pairs[:, 1]] - points[pairs[:, 0]]
+        avg_edge_length = float(np.sqrt(np.einsum("ij,ij->i", edge_vectors, edge_vectors)).mean())
+    else:
+        avg_edge_length = 1.0
     
     # Compute curvature by estimating normal variation
     normals = vtk.vtkPolyDataNormals()
     normals.SetInputData(mesh)
     normals.ComputePointNormalsOn()
-    normals.ComputeCellNormalsOn()
+    normals.ComputeCellNormalsOff()  # Only point normals are measured
     normals.Update()
     
     normal_poly = normals.GetOutput()
-    normal_data = normal_poly.GetPointData().GetNormals()
-    
-    curvature_values = []
-    for i in range(1, num_points):
-        n1 = normal_data.GetTuple3(i - 1)
-        n2 = normal_data.GetTuple3(i)
-        curvature_values.append(vtk.vtkMath.AngleBetweenVectors(n1, n2))
-    
-    median_curvature = sorted(curvature_values)[len(curvature_values) // 2] if curvature_values else 30.0
+    normal_data = numpy_support.vtk_to_numpy(normal_poly.GetPointData().GetNormals())
+
+    # Angle (vtkMath.AngleBetweenVectors) between the normals of consecutive points.
+    idx = _sample_indices(max(num_points - 1, 0), max_samples, rng) + 1
+    n1 = normal_data[idx - 1].astype(np.float64)
+    n2 = normal_data[idx].astype(np.float64)
+    curvature_values = np.arctan2(np.linalg.norm(np.cross(n1, n2), axis=1), np.einsum("ij,ij->i", n1, n2))
+
+    if len(curvature_values):
+        middle = len(curvature_values) // 2
+        median_curvature = float(np.partition(curvature_values, middle)[middle])
+    else:
+        median_curvature = 30.0
     '''
     If a mesh has a mix of flat and sharp areas, the median curvature reflects the dominant smooth regions while ignoring isolated sharp edges.
     '''
@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import os
+import time
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from blob_storage import StagedBlobUpload
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart before 0.0.13 is imported as `multipart`
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# Resumable uploads that have not received data for this long are discarded.
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", 3600))
+
+
+class UploadOffsetMismatch(Exception):
+    """Raised when a chunk does not start where the upload currently ends (HTTP 409)."""
+
+    def __init__(self, expected: int):
+        super().__init__(f"Upload is at offset {expected}")
+        self.expected = expected
+
+
+class InvalidMultipartBody(Exception):
+    """Raised when a request body is not multipart/form-data or is cut off (HTTP 400)."""
+
+
+async def iter_multipart_files(content_type: str, body: AsyncIterator[bytes],
+                               field: str) -> AsyncIterator[Tuple[str, object]]:
+    """
+    Parses a multipart/form-data body as it arrives and yields the files sent as `field`, as
+    ("begin", filename), then ("data", bytes) for every received chunk, then ("end", None).
+    Other parts are skipped. Unlike UploadFile, which spools the whole body to a temporary file
+    before the endpoint runs, nothing but the chunk being parsed is held.
+    """
+    mimetype, options = parse_options_header(content_type)
+    if mimetype != b"multipart/form-data" or not options.get(b"boundary"):
+        raise InvalidMultipartBody("Expected a multipart/form-data body.")
+
+    events = []
+    part: Dict[str, object] = {}
+    header = [b"", b""]
+    ended = []
+
+    def on_part_begin():
+        part.clear()
+        part["headers"], part["is_file"] = {}, False
+
+    def on_header_field(data, start, end):
+        header[0] += data[start:end]
+
+    def on_header_value(data, start, end):
+        header[1] += data[start:end]
+
+    def on_header_end():
+        part["headers"][header[0].lower()] = header[1]
+        header[0] = header[1] = b""
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        if disposition.get(b"name") == field.encode() and b"filename" in disposition:
+            part["is_file"] = True
+            events.append(("begin", disposition[b"filename"].decode("utf-8", "replace")))
+
+    def on_part_data(data, start, end):
+        if part.get("is_file"):
+            if events and events[-1][0] == "data":
+                events[-1][1].extend(data[start:end])  # One event per received chunk
+            else:
+                events.append(("data", bytearray(data[start:end])))
+
+    def on_part_end():
+        if part.get("is_file"):
+            events.append(("end", None))
+
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": on_part_begin, "on_header_field": on_header_field, "on_header_value": on_header_value,
+        "on_header_end": on_header_end, "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data, "on_part_end": on_part_end, "on_end": lambda: ended.append(True),
+    })
+    async for chunk in body:
+        try:
+            parser.write(chunk)
+        except ValueError as e:  # python-multipart's parse errors
+            raise InvalidMultipartBody(f"Malformed multipart body: {e}")
+        for event, value in events:
+            yield event, (bytes(value) if event == "data" else value)
+        events.clear()
+    parser.finalize()
+    if not ended:
+        raise InvalidMultipartBody("The multipart body ended early.")
+
+
+class UploadSession:
+    """
+    Single-pass ingest of an upload: every chunk is written to `path`, fed to a SHA-256
+    hasher and, when `blob_upload` is given, staged to blob storage, all as it arrives.
+
+    A session can receive its data over several requests (see `append`), which is what
+    makes uploads resumable: a client that lost its connection asks for `offset` and
+    continues from there.
+    """
+
+    def __init__(self, upload_id: str, filename: str, path: str, expected_size: Optional[int] = None,
+                 blob_upload: Optional[StagedBlobUpload] = None):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.path = path
+        self.expected_size = expected_size
+        self.blob_upload = blob_upload
+        self.offset = 0
+        self.blob_url: Optional[str] = None
+        self.updated_at = time.time()
+        self._hasher = hashlib.sha256()
+        self._file = open(path, "wb")
+        # Held from the offset check to the last chunk of a request, so concurrent requests cannot interleave.
+        self._lock = asyncio.Lock()
+
+    async def write(self, chunk: bytes):
+        if not chunk:
+            return
+        self._file.write(chunk)
+        self._hasher.update(chunk)
+        if self.blob_upload is not None:
+            await self.blob_upload.write(chunk)
+        self.offset += len(chunk)
+        self.updated_at = time.time()
+
+    async def append(self, chunks: AsyncIterator[bytes], offset: int):
+        """
+        Writes a request body that starts at `offset`. Whatever arrives before the connection
+        drops is kept, so the client can resume from the new `offset`. A request sent while
+        another one is still writing waits for it, then gets the offset it ended at.
+        """
+        async with self._lock:
+            if offset != self.offset:
+                raise UploadOffsetMismatch(self.offset)
+            async for chunk in chunks:
+                await self.write(chunk)
+            self._file.flush()
+
+    @property
+    def complete(self) -> bool:
+        return self.expected_size is None or self.offset >= self.expected_size
+
+    async def finish(self) -> str:
+        """Closes the local file, commits the blob and returns the SHA-256 of the upload."""
+        async with self._lock:  # Waits for a request that is still writing
+            self._file.close()
+        if self.blob_upload is not None:
+            self.blob_url = await self.blob_upload.commit()
+            if self.blob_url:
+                print(f"✅ Upload successful for {self.filename}")
+        return self._hasher.hexdigest()
+
+    async def discard(self):
+        self._file.close()
+        if self.blob_upload is not None:
+            await self.blob_upload.abort()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class UploadSessionStore:
+    """In-process registry of resumable uploads, keyed by upload id."""
+
+    def __init__(self, ttl: int = UPLOAD_SESSION_TTL):
+        self.ttl = ttl
+        self._sessions: Dict[str, UploadSession] = {}
+
+    def add(self, session: UploadSession):
+        self._sessions[session.upload_id] = session
+
+    def get(self, upload_id: str) -> Optional[UploadSession]:
+        return self._sessions.get(upload_id)
+
+    def pop(self, upload_id: str) -> Optional[UploadSession]:
+        return self._sessions.pop(upload_id, None)
+
+    async def expire(self):
+        now = time.time()
+        for upload_id, session in list(self._sessions.items()):
+            if now - session.updated_at > self.ttl:
+                del self._sessions[upload_id]
+                await session.discard()
+                print(f"Discarded stale upload {upload_id}")
@@ -1,19 +1,140 @@
-import nibabel as nib
 import numpy as np
 
+from volume_io import iter_slabs, load_nifti, read_volume, write_streamed
+
+def binarize_volume(data, bone_threshold=0, in_place=False):
+    """
+    Sets every voxel above `bone_threshold` to 1 and leaves the rest untouched.
+    The dtype of `data` is kept; with `in_place=True` `data` itself is modified and returned.
+    """
+    result = data if in_place else np.array(data, copy=True)
+    np.putmask(result, result > bone_threshold, 1)
+    return result
+
+
+def load_processed_volume(nii_path, bone_threshold=0, as_mask=False):
+    """
+    In-memory counterpart of `process_nifti`: loads the NIfTI file and returns
+    the processed voxel array together with its affine, without writing anything to disk.
+
+    The voxels are read slab by slab in their stored dtype and binarized in place, so the
+    volume is held in memory once. With `as_mask=True` the result is a uint8 mask
+    (voxel > `bone_threshold`) instead, which gives the same isosurface at iso value 1.
+    """
+    img = load_nifti(nii_path)
+    if as_mask:
+        shape = img.shape
+        while len(shape) > 3 and shape[-1] == 1:
+            shape = shape[:-1]
+        data = np.empty(shape, dtype=np.uint8, order="F")
+        for start, slab in iter_slabs(img):
+            np.greater(slab, bone_threshold, out=data[..., start:start + slab.shape[-1]].view(np.bool_))
+        return data, img.affine
+    return read_volume(img, lambda slab: binarize_volume(slab, bone_threshold, in_place=True)), img.affine
+
+
+def crop_to_foreground(data, affine, threshold, margin=2):
+    """
+    Crops the volume to the bounding box of the voxels at or above `threshold` (the inside of the
+    isosurface), padded by `margin` voxels on every side and clamped to the volume. The affine's
+    origin is moved to the first kept voxel, so world coordinates of the cropped volume are
+    exactly those of the full one.
+
+    The box comes from one `any` reduction of the mask per axis. The cropped array is a view of `data`.
+    :return: (cropped data, cropped affine, info) where info has "bbox_min", "bbox_max" (voxel indices
+             of the kept box, inclusive), "foreground_voxels", "sparsity" (fraction of voxels outside
+             the foreground), "crop_fraction" (kept voxels / all voxels) and "bytes_saved".
+             A volume without foreground is returned unchanged, with info None.
+    """
+    mask = np.asarray(data) >= threshold
+    foreground = int(np.count_nonzero(mask))
+    if foreground == 0:
+        return data, affine, None
+
+    lower, upper = [], []
+    for axis in range(3):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        occupied = np.flatnonzero(mask.any(axis=other_axes))
+        lower.append(max(int(occupied[0]) - margin, 0))
+        upper.append(min(int(occupied[-1]) + margin, mask.shape[axis] - 1))
+    del mask
+
+    cropped = data[lower[0]:upper[0] + 1, lower[1]:upper[1] + 1, lower[2]:upper[2] + 1]
+    cropped_affine = np.array(affine, dtype=float, copy=True)
+    cropped_affine[:3, 3] += cropped_affine[:3, :3] @ np.array(lower, dtype=float)
+
+    info = {
+        "bbox_min": lower,
+        "bbox_max": upper,
+        "foreground_voxels": foreground,
+        "sparsity": 1.0 - foreground / data.size,
+        "crop_fraction": cropped.size / data.size,
+        "bytes_saved": int(data.nbytes - cropped.size * data.itemsize),
+    }
+    return cropped, cropped_affine, info
+
+
+def load_label_volume(nii_path):
+    """
+    Loads a segmentation mask with its label values intact (no binarization), for the
+    multi-label pipeline. Integer masks keep their stored dtype; float-stored masks are
+    rounded to the nearest integer label.
+    :return: (labels, affine)
+    """
+    img = load_nifti(nii_path)
+    data = read_volume(img)
+    if not np.issubdtype(data.dtype, np.integer):
+        data = np.rint(data).astype(np.int32)
+    if data.size and data.min() < 0:
+        raise ValueError("Label volumes must not contain negative values.")
+    return data, img.affine
+
+
+def label_statistics(labels):
+    """
+    Voxel count and voxel-index bounding box of every non-zero label, in three passes of one
+    `np.bincount` per slice (one pass per axis) instead of one full-volume scan per label.
+    :return: {label: {"voxels": int, "bbox_min": [i, j, k], "bbox_max": [i, j, k]}}, ordered by label
+    """
+    labels = np.asarray(labels)
+    while labels.ndim > 3 and labels.shape[-1] == 1:
+        labels = labels[..., 0]
+    length = int(labels.max()) + 1 if labels.size else 1
+
+    counts = np.zeros(length, dtype=np.int64)
+    lower, upper = [], []
+    for axis in range(labels.ndim):
+        # present[i, l] is True when label l occurs in slice i along this axis
+        present = np.zeros((labels.shape[axis], length), dtype=bool)
+        slices = np.moveaxis(labels, axis, 0)  # A view; `take` would copy the whole volume per slice
+        for index in range(labels.shape[axis]):
+            slice_counts = np.bincount(slices[index].ravel(), minlength=length)
+            present[index] = slice_counts > 0
+            if axis == 0:
+                counts += slice_counts
+        lower.append(present.argmax(axis=0))
+        upper.append(labels.shape[axis] - 1 - present[::-1].argmax(axis=0))
+
+    stats = {}
+    for label in np.flatnonzero(counts[1:]) + 1:
+        stats[int(label)] = {
+            "voxels": int(counts[label]),
+            "bbox_min": [int(bound[label]) for bound in lower],
+            "bbox_max": [int(bound[label]) for bound in upper],
+        }
+    return stats
+
+
 def process_nifti(nii_path, output_path, bone_threshold=0):
-    # Load the NIfTI file
-    img = nib.load(nii_path)
-    data = img.get_fdata()
-    
-    # Identify bone regions and set them to 1
-    modified_data = np.where(data > bone_threshold, 1, data)
-    
-    # Create a new NIfTI image
-    new_img = nib.Nifti1Image(modified_data, img.affine, img.header)
-    
-    # Save the modified image
-    nib.save(new_img, output_path)
+    """
+    Writes a copy of the NIfTI file with every voxel above `bone_threshold` set to 1.
+    The volume is streamed slab by slab in its stored dtype, never loaded as a whole.
+    """
+    # Load the NIfTI header; the voxels are only read while writing
+    img = load_nifti(nii_path)
+
+    # Identify bone regions and set them to 1, slab by slab
+    write_streamed(img, output_path, transform=lambda slab: binarize_volume(slab, bone_threshold))
     print(f"Modified NIfTI file saved as: {output_path}")
 
 '''
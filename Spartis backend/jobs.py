@@ -0,0 +1,443 @@
+import asyncio
+import collections
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# --- Scheduler Configuration ---
+# Every pipeline runs in its own worker process, so VTK/NumPy work of different uploads
+# never shares an interpreter and the number of concurrent pipelines is bounded.
+PIPELINE_WORKERS = int(os.environ.get("PIPELINE_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+# Jobs waiting for a free worker. Further uploads are rejected with 429 until the queue drains.
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 32))
+# Address-space budget per job in MB (0 disables it). A job exceeding it fails with a MemoryError
+# instead of pushing the whole container into the OOM killer.
+JOB_MEMORY_LIMIT_MB = int(os.environ.get("JOB_MEMORY_LIMIT_MB", 0))
+# Running jobs whose progress has not advanced for this many seconds are flagged as stalled in their
+# status and progress record (0 disables the check). Long stages report sub-progress, so a healthy
+# job advances at least every few seconds; only filters without it (e.g. flying edges) stay silent.
+JOB_STALL_TIMEOUT = float(os.environ.get("JOB_STALL_TIMEOUT", 600))
+# Start every worker process with the scheduler instead of on the first jobs, and have each mesh a tiny
+# synthetic volume first (pipeline.warm_up), so the first uploads after a (cold) start find warm workers.
+WORKER_WARM_UP = os.environ.get("WORKER_WARM_UP", "1") == "1"
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED)
+
+# How many finished jobs are remembered for /api/jobs/{file_id}.
+_FINISHED_HISTORY = 1000
+# Seconds `shutdown` waits for running jobs to notice they were cancelled.
+_SHUTDOWN_GRACE = 10
+
+
+class QueueFullError(Exception):
+    """Raised by `JobScheduler.submit` when the queue has no room left (HTTP 429)."""
+
+
+class SchedulerUnavailableError(Exception):
+    """Raised by `JobScheduler.submit` when the scheduler is not accepting work (HTTP 503)."""
+
+
+class JobCancelledError(Exception):
+    """Raised inside a worker when its job has been cancelled."""
+
+
+class Job:
+    def __init__(self, file_id: str, input_path: str, params: Dict[str, Any], on_done=None):
+        self.file_id = file_id
+        self.input_path = input_path
+        self.params = params
+        self.on_done = on_done
+        self.status = QUEUED
+        self.error: Optional[str] = None
+        self.result: Any = None
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # Last progress update relayed from the worker and when it arrived, for stall detection.
+        self.last_progress: Dict[str, Any] = {}
+        self.last_progress_at: Optional[float] = None
+        self.stalled = False
+
+    def to_dict(self, queue_position: Optional[int] = None) -> Dict[str, Any]:
+        info = {
+            "file_id": self.file_id,
+            "status": self.status,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "last_progress_at": self.last_progress_at,
+        }
+        if self.stalled:
+            info["stalled"] = True
+        if queue_position is not None:
+            info["queue_position"] = queue_position
+        if self.error:
+            info["error"] = self.error
+        return info
+
+
+def _apply_memory_limit(memory_limit_mb: int):
+    if memory_limit_mb <= 0:
+        return
+    try:
+        import resource
+        limit = memory_limit_mb * 1024 * 1024
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    except (ImportError, ValueError, OSError) as e:
+        print(f"⚠️ Could not apply job memory limit: {e}")
+
+
+def _warm_worker(warm_up: bool):
+    """
+    Initializer of every worker process: imports the imaging stack (VTK, SimpleITK, nibabel, ...)
+    once when the process starts, so jobs do not pay for it and later jobs reuse the warm interpreter.
+    With `warm_up`, a tiny synthetic volume is meshed as well. The API process itself never imports it.
+    Ctrl-C reaches the whole process group; workers ignore it and leave shutting down to the parent.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import pipeline
+
+    if warm_up:
+        try:
+            pipeline.warm_up()
+        except Exception as e:
+            # The worker still takes jobs; they will report the actual error.
+            print(f"⚠️ Worker warm-up failed in process {os.getpid()}: {e}")
+
+
+def _run_job(file_id: str, input_path: str, output_dir: str, params: Dict[str, Any],
+             progress_queue, cancelled, memory_limit_mb: int):
+    """
+    Entry point executed in a worker process. Progress is sent back to the API process
+    through `progress_queue`; `cancelled` is a shared dict checked at every progress step.
+    """
+    _apply_memory_limit(memory_limit_mb)
+
+    # Imported here so the heavy imaging stack is only ever loaded in worker processes.
+    from pipeline import full_pipeline
+    from volume_io import discard_cached
+
+    # Extra fields (e.g. "lods") stay in every later update so they are not lost when the record is overwritten.
+    sticky: Dict[str, Any] = {}
+
+    def on_progress(step: str, percent: int, **extra):
+        if cancelled.get(file_id):
+            raise JobCancelledError(f"Job {file_id} was cancelled")
+        sticky.update(extra)
+        if step == "Completed":
+            # Not terminal yet: the job only completes once the API process has published its result,
+            # after reporting the upload at 99%
+            step, percent = "Finalizing", 98
+        progress_queue.put((file_id, {**sticky, "step": step, "progress": percent}))
+
+    try:
+        return full_pipeline(input_path, output_dir, file_id=file_id, progress_callback=on_progress, **params)
+    except MemoryError:
+        raise MemoryError(f"Job exceeded its memory budget of {memory_limit_mb} MB")
+    finally:
+        discard_cached(input_path)  # Every upload is processed once
+
+
+class JobScheduler:
+    """
+    Runs pipeline jobs on a bounded process pool.
+
+    Jobs wait in a FIFO queue (their position is published through the progress store),
+    at most `workers` of them run at once, and `submit` refuses work once `queue_size`
+    jobs are waiting. `progress_sink(file_id, data)` is awaited for every progress update,
+    both the ones produced here and the ones relayed from worker processes (each of which is
+    also printed unless `log_progress` is False). Worker processes are reused for every job
+    and import the imaging stack once, when they start.
+
+    Running jobs whose progress has not advanced for `stall_timeout` seconds are flagged as
+    stalled: their status and progress record get `"stalled": true` until the next update.
+    Workers cannot be stopped individually, so a stalled job is only reported, not killed.
+
+    With `warm_up`, all worker processes are started (and warmed up) by `start` in the background
+    rather than by the first jobs; `warm_up_seconds` tells how long that took once it is done.
+    """
+
+    def __init__(self, output_dir: str, progress_sink: Callable[[str, Dict[str, Any]], Awaitable[None]],
+                 workers: int = PIPELINE_WORKERS, queue_size: int = PIPELINE_QUEUE_SIZE,
+                 memory_limit_mb: int = JOB_MEMORY_LIMIT_MB, stall_timeout: float = JOB_STALL_TIMEOUT,
+                 log_progress: bool = True, warm_up: bool = WORKER_WARM_UP):
+        self.output_dir = str(output_dir)
+        self.progress_sink = progress_sink
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self.memory_limit_mb = memory_limit_mb
+        self.stall_timeout = stall_timeout
+        self.log_progress = log_progress
+        self.warm_up = warm_up
+        self.warm_up_seconds: Optional[float] = None
+
+        self._jobs: "collections.OrderedDict[str, Job]" = collections.OrderedDict()
+        self._pending: "collections.deque[Job]" = collections.deque()
+        self._running: Dict[str, Job] = {}
+        self._wakeup: Optional[asyncio.Condition] = None
+        self._tasks = []
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._manager = None
+        self._progress_queue = None
+        self._cancelled = None
+        self._flush_waiters: Dict[str, asyncio.Future] = {}
+        self._accepting = False
+
+    # --- Lifecycle ---
+    async def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self._manager = ctx.Manager()
+        self._progress_queue = self._manager.Queue()
+        self._cancelled = self._manager.dict()
+        self._executor = self._new_executor()
+        self._wakeup = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._dispatch_loop()) for _ in range(self.workers)]
+        if self.stall_timeout > 0:
+            self._tasks.append(asyncio.create_task(self._watch_stalls()))
+        if self.warm_up:
+            self._tasks.append(asyncio.create_task(self._prefork()))
+        self._relay_thread = threading.Thread(target=self._relay_progress, args=(asyncio.get_running_loop(),),
+                                              daemon=True)
+        self._relay_thread.start()
+        self._accepting = True
+        print(f"✅ Job scheduler started with {self.workers} worker(s), queue size {self.queue_size}")
+
+    async def shutdown(self):
+        self._accepting = False
+        for job in list(self._pending):
+            await self._finish(job, CANCELLED, error="Server shutting down")
+        self._pending.clear()
+        running = list(self._running)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._executor:
+            # Running jobs stop at their next progress step; give them a moment before the progress
+            # queue they report to goes away.
+            for file_id in running:
+                self._cancelled[file_id] = True
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            try:
+                await asyncio.wait_for(asyncio.to_thread(self._executor.shutdown, wait=True), _SHUTDOWN_GRACE)
+            except asyncio.TimeoutError:
+                print(f"⚠️ Workers still busy after {_SHUTDOWN_GRACE}s, stopping anyway")
+        if self._progress_queue is not None:
+            await asyncio.to_thread(self._progress_queue.put, None)
+            await asyncio.to_thread(self._relay_thread.join, 5)
+        if self._manager:
+            self._manager.shutdown()
+        print("Job scheduler stopped.")
+
+    # --- Public API ---
+    async def submit(self, file_id: str, input_path: str, on_done=None, **params) -> Job:
+        """
+        Queues a pipeline run. `on_done(job)` is awaited once the job has finished (in any state).
+        :raises SchedulerUnavailableError: if the scheduler is not running
+        :raises QueueFullError: if `queue_size` jobs are already waiting
+        """
+        if not self._accepting:
+            raise SchedulerUnavailableError("Job scheduler is not accepting work")
+        if len(self._pending) >= self.queue_size:
+            raise QueueFullError(f"Job queue is full ({self.queue_size} waiting)")
+
+        job = Job(file_id, input_path, params, on_done)
+        self._remember(job)
+        self._pending.append(job)
+        await self._publish_queue_position(job, len(self._pending))
+        async with self._wakeup:
+            self._wakeup.notify()
+        return job
+
+    async def wait_for_room(self, poll_interval: float = 0.5):
+        """Waits until `submit` would accept another job, so batches can be fed in as the queue drains."""
+        while self._accepting and len(self._pending) >= self.queue_size:
+            await asyncio.sleep(poll_interval)
+
+    async def cancel(self, file_id: str) -> Optional[Job]:
+        """Cancels a queued job immediately, or asks a running job to stop at its next progress step."""
+        job = self._jobs.get(file_id)
+        if job is None or job.status in FINISHED_STATES:
+            return job
+        if job.status == QUEUED:
+            self._pending.remove(job)
+            await self._finish(job, CANCELLED)
+            await self._publish_queue_positions()
+        else:
+            self._cancelled[file_id] = True
+            await self.progress_sink(file_id, {"step": "Cancelling", "progress": 0})
+        return job
+
+    def status(self, file_id: str) -> Optional[Dict[str, Any]]:
+        job = self._jobs.get(file_id)
+        if job is None:
+            return None
+        return job.to_dict(self.queue_position(file_id))
+
+    def queue_position(self, file_id: str) -> Optional[int]:
+        """1-based position of a waiting job, or None if it is not waiting."""
+        for position, job in enumerate(self._pending, start=1):
+            if job.file_id == file_id:
+                return position
+        return None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    @property
+    def active_jobs(self) -> int:
+        return len(self._running)
+
+    @property
+    def stalled_jobs(self) -> int:
+        return sum(1 for job in self._running.values() if job.stalled)
+
+    # --- Internals ---
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_warm_worker, initargs=(self.warm_up,))
+
+    async def _prefork(self):
+        """Starts every worker process now; the pool would otherwise start one per job as they arrive."""
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            # One trivial task per worker: each one that cannot go to an idle worker starts a new process.
+            await asyncio.gather(*(loop.run_in_executor(self._executor, os.getpid) for _ in range(self.workers)))
+        except BrokenProcessPool as e:
+            print(f"❌ Worker processes failed to start: {e}")
+            return
+        self.warm_up_seconds = round(time.perf_counter() - started, 2)
+        print(f"✅ {self.workers} worker(s) started and warmed up in {self.warm_up_seconds}s")
+
+    def _remember(self, job: Job):
+        self._jobs[job.file_id] = job
+        while len(self._jobs) > _FINISHED_HISTORY + self.queue_size + self.workers:
+            oldest_id, oldest = next(iter(self._jobs.items()))
+            if oldest.status not in FINISHED_STATES:
+                break
+            del self._jobs[oldest_id]
+
+    async def _publish_queue_position(self, job: Job, position: int):
+        await self.progress_sink(job.file_id, {"step": "Queued", "progress": 0, "queue_position": position})
+
+    async def _publish_queue_positions(self):
+        for position, job in enumerate(list(self._pending), start=1):
+            await self._publish_queue_position(job, position)
+
+    async def _dispatch_loop(self):
+        while True:
+            async with self._wakeup:
+                await self._wakeup.wait_for(lambda: bool(self._pending))
+                job = self._pending.popleft()
+            await self._publish_queue_positions()
+            await self._run(job)
+
+    async def _run(self, job: Job):
+        loop = asyncio.get_running_loop()
+        job.status = RUNNING
+        job.started_at = job.last_progress_at = time.time()
+        self._running[job.file_id] = job
+        await self.progress_sink(job.file_id, {"step": "Starting", "progress": 0})
+        status, error = COMPLETED, None
+        executor = self._executor
+        try:
+            job.result = await loop.run_in_executor(
+                executor, _run_job, job.file_id, job.input_path, self.output_dir, job.params,
+                self._progress_queue, self._cancelled, self.memory_limit_mb,
+            )
+        except JobCancelledError:
+            status = CANCELLED
+        except BrokenProcessPool as e:
+            # A worker died (e.g. killed by the OOM killer); replace the pool so later jobs still run.
+            # Every job of the broken pool fails together; only the first one replaces it.
+            if self._executor is executor:
+                print(f"❌ Worker process died while running {job.file_id}, restarting pool")
+                executor.shutdown(wait=False, cancel_futures=False)
+                self._executor = self._new_executor()
+            status, error = FAILED, f"Worker process died: {e}"
+        except Exception as e:
+            status, error = FAILED, str(e)
+        finally:
+            self._running.pop(job.file_id, None)
+            self._cancelled.pop(job.file_id, None)
+
+        # Make sure every update the worker sent has reached the sink before the final one is written.
+        await self._flush_progress()
+        await self._finish(job, status, error)
+
+    async def _watch_stalls(self):
+        while True:
+            await asyncio.sleep(min(30.0, self.stall_timeout / 4))
+            now = time.time()
+            for job in list(self._running.values()):
+                idle = now - (job.last_progress_at or now)
+                if job.stalled or idle < self.stall_timeout:
+                    continue
+                job.stalled = True
+                print(f"⚠️ Job {job.file_id} has not made progress for {idle:.0f}s "
+                      f"(last step: {job.last_progress.get('step', 'Starting')})")
+                await self.progress_sink(job.file_id, {"step": "Starting", "progress": 0, **job.last_progress,
+                                                       "stalled": True})
+
+    async def _flush_progress(self):
+        waiter = asyncio.get_running_loop().create_future()
+        token = f"flush-{id(waiter)}"
+        self._flush_waiters[token] = waiter
+        await asyncio.to_thread(self._progress_queue.put, (token, None))
+        await waiter
+
+    async def _finish(self, job: Job, status: str, error: Optional[str] = None):
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        if status == CANCELLED:
+            await self.progress_sink(job.file_id, {"step": "Cancelled", "progress": 0})
+        elif status == FAILED:
+            print(f"❌ Pipeline failed for {job.file_id}: {error}")
+            await self.progress_sink(job.file_id, {"step": "Error", "progress": 0, "error": error})
+        if job.on_done is not None:
+            try:
+                await job.on_done(job)
+            except Exception as e:
+                print(f"❌ Completion handler failed for {job.file_id}: {e}")
+
+    def _relay_progress(self, loop: asyncio.AbstractEventLoop):
+        """Forwards progress updates from worker processes to `progress_sink` on the event loop."""
+        while True:
+            try:
+                item = self._progress_queue.get()
+            except (EOFError, OSError):
+                return
+            if item is None:
+                return
+            file_id, data = item
+            if data is None:
+                waiter = self._flush_waiters.pop(file_id)
+                loop.call_soon_threadsafe(waiter.set_result, None)
+                continue
+            if self.log_progress:
+                print(f"[{file_id}] Progress: {data['step']} - {data['progress']}%")
+            job = self._running.get(file_id)
+            if job is not None:
+                if job.stalled:
+                    print(f"✅ Job {file_id} is making progress again")
+                job.last_progress, job.last_progress_at, job.stalled = data, time.time(), False
+            try:
+                # Wait for each write so updates for a job are stored in the order they were sent.
+                asyncio.run_coroutine_threadsafe(self.progress_sink(file_id, data), loop).result()
+            except Exception as e:
+                print(f"❌ Failed to store progress for {file_id}: {e}")
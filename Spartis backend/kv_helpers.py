@@ -1,46 +1,249 @@
-import os
+import asyncio
 import json
-from redis import asyncio as aioredis
-from redis import Redis
-from typing import Dict, Any
-
-# --- Connection Pooling for Performance ---
-# Create the pool once when the module is loaded.
-# Serverless functions may reuse this instance across invocations.
-def get_redis_pool(sync: bool = False):
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Every progress update is also published on the Redis channel "<prefix><file_id>" (see progress_stream).
+PROGRESS_CHANNEL_PREFIX = "progress:"
+# Progress entries expire this many seconds after their last update.
+PROGRESS_TTL = int(os.environ.get("PROGRESS_TTL", 3600))
+# Updates queued from worker threads are written at most this often, in one pipelined batch.
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get("PROGRESS_FLUSH_INTERVAL", 0.05))
+
+
+class OperationMetrics:
+    """Count, failures and latency of each kind of store operation (set, get, batch)."""
+
+    def __init__(self):
+        self._operations: Dict[str, Dict[str, float]] = {}
+
+    def record(self, operation: str, seconds: float, failed: bool = False, items: int = 1):
+        stats = self._operations.setdefault(operation, {"count": 0, "items": 0, "failures": 0, "seconds": 0.0,
+                                                        "max_latency_s": 0.0})
+        stats["count"] += 1
+        stats["items"] += items
+        stats["failures"] += int(failed)
+        stats["seconds"] += seconds
+        stats["max_latency_s"] = max(stats["max_latency_s"], seconds)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            operation: {
+                "count": int(stats["count"]),
+                "items": int(stats["items"]),
+                "failures": int(stats["failures"]),
+                "mean_latency_s": stats["seconds"] / stats["count"] if stats["count"] else 0.0,
+                "max_latency_s": stats["max_latency_s"],
+            }
+            for operation, stats in self._operations.items()
+        }
+
+
+class MemoryTTLStore:
+    """In-process stand-in for Redis SET/GET with expiry, used when KV_URL is not set."""
+
+    # Expired entries are dropped on access, and all of them at most this often.
+    PURGE_INTERVAL = 60.0
+
+    def __init__(self):
+        self._entries: Dict[str, Tuple[float, str]] = {}
+        self._next_purge = time.monotonic() + self.PURGE_INTERVAL
+
+    def set(self, key: str, value: str, ttl: int):
+        now = time.monotonic()
+        self._entries[key] = (now + ttl, value)
+        if now >= self._next_purge:
+            self.purge()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        return entry[1]
+
+    def purge(self):
+        now = time.monotonic()
+        self._next_purge = now + self.PURGE_INTERVAL
+        for key, (expires_at, _) in list(self._entries.items()):
+            if expires_at < now:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ProgressStore:
     """
-    Returns a Redis connection pool (sync or async) configured from Vercel KV env vars.
+    Job progress keyed by file id, stored in Redis (Vercel KV) or, without KV_URL, in memory.
+
+    One Redis client (and connection pool) serves the whole process. Every write is a pipelined
+    SET + PUBLISH in a single round trip. `set_sync` never blocks the calling thread: updates are
+    queued, coalesced per job (latest wins) and flushed from the event loop in one pipeline every
+    `flush_interval` seconds. Redis errors are printed and counted in `metrics`; progress is
+    best effort and never fails a job.
     """
-    try:
-        url = os.environ.get("KV_URL")
-        if not url:
-            print("⚠️ KV_URL environment variable not set. KV features will not work.")
+
+    def __init__(self, url: Optional[str] = None, ttl: int = PROGRESS_TTL,
+                 flush_interval: float = PROGRESS_FLUSH_INTERVAL):
+        self.url = url
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.metrics = OperationMetrics()
+        self.memory = MemoryTTLStore()
+        self._client = None
+        self._listeners: List[Callable[[str, Dict[str, Any]], None]] = []
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._pending_lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+
+    @property
+    def client(self):
+        """The shared Redis client, created on first use (no connection is opened before a command)."""
+        if self._client is None and self.url:
+            from redis import asyncio as aioredis  # Only imported when KV_URL is set
+
+            # `decode_responses=True` makes the client return strings instead of bytes.
+            self._client = aioredis.from_url(self.url, decode_responses=True)
+        return self._client
+
+    @property
+    def backend(self) -> str:
+        return "redis" if self.url else "memory"
+
+    async def start(self):
+        if self._writer is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._writer = asyncio.create_task(self._flush_pending())
+        if self._pending:
+            self._wake.set()
+        if not self.url:
+            print("⚠️ KV_URL environment variable not set. Progress is kept in memory (this process only).")
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            await asyncio.gather(self._writer, return_exceptions=True)
+            self._writer = None
+            await self._write_batch(self._take_pending())
+        self._loop = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def add_listener(self, listener: Callable[[str, Dict[str, Any]], None]):
+        """Registers a callback for every progress update set in this process (with or without KV)."""
+        self._listeners.append(listener)
+
+    def pubsub(self):
+        """A Redis pub/sub object for the progress channels, or None without KV."""
+        return self.client.pubsub() if self.client is not None else None
+
+    async def set(self, file_id: str, data: Dict[str, Any]):
+        with self._pending_lock:
+            self._pending.pop(file_id, None)  # Superseded by this update
+        await self._write_batch({file_id: data})
+
+    def set_sync(self, file_id: str, data: Dict[str, Any]):
+        """
+        Queues an update from any thread; it is written by the event loop shortly after (or once
+        the store is started).
+        """
+        with self._pending_lock:
+            self._pending[file_id] = data
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._wake.set)
+
+    async def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        started = time.perf_counter()
+        failed = False
+        try:
+            if self.client is None:
+                data = self.memory.get(file_id)
+            else:
+                data = await self.client.get(file_id)
+            return json.loads(data) if data else None
+        except Exception as e:
+            failed = True
+            print(f"❌ Could not read progress of {file_id}: {e}")
             return None
-        # The `decode_responses=True` argument makes the client return strings instead of bytes.
-        return Redis.from_url(url, decode_responses=True) if sync else aioredis.from_url(url, decode_responses=True)
-    except Exception as e:
-        print(f"❌ Could not create Redis pool: {e}")
-        return None
+        finally:
+            self.metrics.record("get", time.perf_counter() - started, failed)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._pending_lock:
+            pending = len(self._pending)
+        return {"backend": self.backend, "pending": pending, "operations": self.metrics.snapshot(),
+                **({"memory_entries": len(self.memory)} if self.client is None else {})}
+
+    def _take_pending(self) -> Dict[str, Dict[str, Any]]:
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    async def _flush_pending(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            await self._write_batch(self._take_pending())
+            await asyncio.sleep(self.flush_interval)  # Updates arriving meanwhile share the next batch
+
+    async def _write_batch(self, updates: Dict[str, Dict[str, Any]]):
+        if not updates:
+            return
+        for file_id, data in updates.items():
+            for listener in self._listeners:
+                listener(file_id, data)
+
+        started = time.perf_counter()
+        failed = False
+        try:
+            if self.client is None:
+                for file_id, data in updates.items():
+                    self.memory.set(file_id, json.dumps(data), self.ttl)
+            else:
+                async with self.client.pipeline(transaction=False) as pipe:
+                    for file_id, data in updates.items():
+                        payload = json.dumps(data)
+                        pipe.set(file_id, payload, ex=self.ttl)
+                        pipe.publish(f"{PROGRESS_CHANNEL_PREFIX}{file_id}", payload)
+                    await pipe.execute()
+        except Exception as e:
+            failed = True
+            print(f"❌ Could not store progress of {', '.join(updates)}: {e}")
+        finally:
+            self.metrics.record("set" if len(updates) == 1 else "batch", time.perf_counter() - started, failed,
+                                items=len(updates))
+
+
+# The process-wide store, started and closed by the API's lifespan.
+progress_store = ProgressStore(os.environ.get("KV_URL"))
 
-async_pool = get_redis_pool()
-sync_pool = get_redis_pool(sync=True)
 
 async def set_progress(file_id: str, data: Dict[str, Any]):
-    """Asynchronously sets progress data in KV."""
-    if async_pool:
-        async with aioredis.Redis(connection_pool=async_pool) as redis:
-            await redis.set(file_id, json.dumps(data), ex=3600) # Expire after 1 hour
+    """Asynchronously sets progress data in KV and publishes it to the job's progress channel."""
+    await progress_store.set(file_id, data)
 
 def set_progress_sync(file_id: str, data: Dict[str, Any]):
-    """Synchronously sets progress data in KV. Useful for non-async callbacks."""
-    if sync_pool:
-        with Redis(connection_pool=sync_pool) as redis:
-            redis.set(file_id, json.dumps(data), ex=3600)
+    """Sets progress data from a non-async callback or worker thread without blocking it."""
+    progress_store.set_sync(file_id, data)
 
 async def get_progress_from_kv(file_id: str):
     """Asynchronously gets progress data from KV."""
-    if async_pool:
-        async with aioredis.Redis(connection_pool=async_pool) as redis:
-            data = await redis.get(file_id)
-            return json.loads(data) if data else None
-    return None
\ No newline at end of file
+    return await progress_store.get(file_id)
+
+def add_progress_listener(listener: Callable[[str, Dict[str, Any]], None]):
+    progress_store.add_listener(listener)
+
+def progress_pubsub():
+    """A Redis pub/sub object for the progress channels, or None when KV is not configured."""
+    return progress_store.pubsub()
@@ -1,31 +1,41 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from fastapi import BackgroundTasks, Request
+from fastapi.responses import FileResponse, StreamingResponse, Response
+from fastapi import BackgroundTasks, Request, WebSocket, Body
 
-import shutil
+import asyncio
+import collections
+import json
+import time
 import uuid
 import os
+from contextlib import asynccontextmanager
 from pathlib import Path
 import mimetypes
-from typing import Dict, Union
-from azure.storage.blob.aio import BlobServiceClient
+from typing import Dict, List, Union, Optional
 
-from kv_helpers import set_progress, get_progress_from_kv, set_progress_sync
-from pipeline import full_pipeline
-from viewer import view_stl
-
-app = FastAPI(title="NIfTI to Mesh Pipeline API")
+from kv_helpers import progress_store, set_progress, get_progress_from_kv, set_progress_sync
+from jobs import JobScheduler, QueueFullError, SchedulerUnavailableError, COMPLETED
+from result_cache import ResultCache, cache_key
+from blob_storage import BlobStorage, StagedBlobUpload
+from ingest import UploadSession, UploadSessionStore, UploadOffsetMismatch, InvalidMultipartBody, iter_multipart_files
+from progress_stream import ProgressBroker, PROGRESS_STREAM_KEEPALIVE
+from telemetry import PipelineTelemetry
+from pipeline_options import MESH_FORMATS, DEFAULT_FORMATS, SMOOTHING_PRESETS, DECIMATION_METHODS
 
 # --- Azure Blob Storage Configuration ---
 BLOB_CONNECTION_STRING = os.environ.get("BLOB_CONNECTION_STRING")
 CONTAINER_NAME: str = "azureml-blobstore-d58bdc01-dd56-4b93-815a-7c70b6e606d6"
 UPLOAD_FOLDER_NAME: str = "app_uploaded_data"
+# Small JSON markers that map a result cache key to the completion payload of its outputs.
+RESULT_CACHE_FOLDER_NAME: str = "app_result_cache"
 
 # Ensure .stl files are served with the correct media type.
 # Some systems may not have this mimetype registered by default.
 mimetypes.add_type("model/stl", ".stl")
+mimetypes.add_type("application/ply", ".ply")
+mimetypes.add_type("model/gltf-binary", ".glb")
 
 # Define local directories for temporary file storage.
 # On Azure App Service, the local filesystem is writable but not ideal for persistent storage.
@@ -35,6 +45,95 @@ OUTPUT_DIR = BASE_DIR / "outputs"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Chunk size suggested to clients of the resumable upload endpoints.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+# --- Blob Storage ---
+# One client for the whole application lifetime (see blob_storage.py for the BLOB_BLOCK_SIZE,
+# BLOB_MAX_CONCURRENCY and BLOB_RETRY_* settings). Opened and closed in `lifespan`.
+blob_storage = BlobStorage(BLOB_CONNECTION_STRING, CONTAINER_NAME)
+
+
+async def find_cached_result_in_blob(key: str) -> Optional[dict]:
+    """
+    Remote lookup for the result cache: returns the completion payload stored for `key`
+    in blob storage, if any instance has produced it before.
+    """
+    if not blob_storage.enabled:
+        return None
+
+    data = await blob_storage.download_bytes(f"{RESULT_CACHE_FOLDER_NAME}/{key}.json")
+    return json.loads(data) if data else None
+
+
+async def publish_cached_result_to_blob(key: str, payload: dict):
+    """Stores the completion payload for `key` so other instances get cache hits for it."""
+    if not blob_storage.enabled or not payload.get("url"):
+        return
+
+    try:
+        await blob_storage.upload_bytes(f"{RESULT_CACHE_FOLDER_NAME}/{key}.json", json.dumps(payload).encode("utf-8"))
+    except Exception as e:
+        print(f"❌ Failed to publish cached result {key}: {e}")
+
+
+# --- Result Cache ---
+# Finished results keyed by upload hash + pipeline parameters (size cap: RESULT_CACHE_MAX_MB).
+result_cache = ResultCache(OUTPUT_DIR / "cache", remote_lookup=find_cached_result_in_blob)
+
+
+async def publish_progress(file_id: str, data: dict):
+    """
+    Stores progress for a job and mirrors it to identical uploads that are waiting on that job.
+    Preview meshes (LODs) announced while the job runs are served from /api/outputs until
+    the final result has been uploaded.
+    """
+    for lod in data.get("lods", []):
+        lod.setdefault("url", f"/api/outputs/{lod['filename']}")
+    await set_progress(file_id, data)
+    for follower_id in result_cache.followers(file_id):
+        await set_progress(follower_id, data)
+
+
+# --- Job Scheduler ---
+# Pipelines run in a bounded pool of worker processes (see jobs.py for the PIPELINE_WORKERS,
+# PIPELINE_QUEUE_SIZE and JOB_MEMORY_LIMIT_MB settings). Worker progress is relayed to set_progress.
+scheduler = JobScheduler(OUTPUT_DIR, progress_sink=publish_progress)
+
+# --- Progress Streaming ---
+# Pushes progress updates to SSE / WebSocket clients (see progress_stream.py for PROGRESS_STREAM_MAX_RATE).
+progress_broker = ProgressBroker()
+
+# --- Telemetry ---
+# Per-stage histograms of finished jobs plus live gauges, served on /metrics (see telemetry.py).
+telemetry = PipelineTelemetry()
+telemetry.bind(
+    queue_depth=lambda: scheduler.queue_depth,
+    active_jobs=lambda: scheduler.active_jobs,
+    stalled_jobs=lambda: scheduler.stalled_jobs,
+    blob=blob_storage.metrics.snapshot,
+    kv=progress_store.snapshot,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await blob_storage.start()
+    await progress_store.start()
+    await progress_broker.start()
+    await scheduler.start()
+    yield
+    for batch in batches.values():
+        batch["task"].cancel()
+    await scheduler.shutdown()
+    await progress_broker.stop()
+    await progress_store.close()
+    await blob_storage.close()
+
+
+app = FastAPI(title="NIfTI to Mesh Pipeline API", lifespan=lifespan)
+
 # --- CORS Configuration ---
 # Get allowed origins from environment variables. Default to allowing all for development.
 # For production on Azure, set this to your specific frontend URL, e.g., "https://my-frontend.azurewebsites.net"
@@ -50,123 +149,539 @@ app.add_middleware(
 )
 
 
-async def upload_input_to_blob(file_path: str, original_filename: str):
+def open_input_blob_upload(original_filename: str) -> Optional[StagedBlobUpload]:
     """
-    Uploads a file to Azure Blob Storage.
+    Starts a staged (block-by-block) upload of an input file to Azure Blob Storage,
+    or returns None when blob storage is not configured.
     """
-    if not BLOB_CONNECTION_STRING:
+    if not blob_storage.enabled:
         print("⚠️ BLOB_CONNECTION_STRING is not set. Skipping blob upload.")
-        return
+        return None
 
     blob_name = f"{UPLOAD_FOLDER_NAME}/{original_filename}"
-    
-    try:
-        blob_service_client = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING)
-        async with blob_service_client:
-            container_client = blob_service_client.get_container_client(CONTAINER_NAME)
-            
-            print(f"Uploading to Azure Blob Storage as blob:\n\t{blob_name}")
-            
-            with open(file_path, "rb") as data:
-                await container_client.upload_blob(name=blob_name, data=data, overwrite=True)
-                
-            print(f"✅ Upload successful for {original_filename}")
-
-    except Exception as e:
-        print(f"❌ Failed to upload to Azure Blob Storage: {e}")
+    print(f"Uploading to Azure Blob Storage as blob:\n\t{blob_name}")
+    return blob_storage.staged_upload(blob_name)
 
 async def upload_output_to_blob(file_path: str) -> str:
     """
     Uploads a generated output file to Azure Blob Storage and returns its public URL.
+    Pre-compressed files (.gz/.br) keep the media type of the original and get a Content-Encoding.
     """
-    if not BLOB_CONNECTION_STRING:
+    if not blob_storage.enabled:
         print("⚠️ BLOB_CONNECTION_STRING is not set. Skipping blob upload for output.")
         return ""
 
     blob_name = f"app_generated_outputs/{os.path.basename(file_path)}"
     
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING)
-        async with blob_service_client:
-            container_client = blob_service_client.get_container_client(CONTAINER_NAME)
-            
-            print(f"Uploading output to Azure Blob Storage as blob:\n\t{blob_name}")
-            
-            with open(file_path, "rb") as data:
-                blob_client = await container_client.upload_blob(name=blob_name, data=data, overwrite=True)
-                
-            print(f"✅ Output upload successful for {blob_name}")
-            return blob_client.url
+        print(f"Uploading output to Azure Blob Storage as blob:\n\t{blob_name}")
+        content_type, content_encoding = mimetypes.guess_type(file_path)
+        url = await blob_storage.upload_file(file_path, blob_name, content_type, content_encoding)
+        print(f"✅ Output upload successful for {blob_name}")
+        return url
 
     except Exception as e:
         print(f"❌ Failed to upload output to Azure Blob Storage: {e}")
         return ""
 
-@app.post("/api/process-nifti/")
-async def process_nifti_file(file: UploadFile = File(...), background_tasks: BackgroundTasks = BackgroundTasks(), request: Request = None):
-    if not file.filename.endswith(".nii.gz"):
+def pipeline_params(
+    # To segment bone from a CT scan, a higher threshold is needed.
+    # Common Hounsfield Unit (HU) values for bone are > 250.
+    # However, the error "No mesh could be created" indicates that for the current NIfTI file,
+    # a threshold of 250 is too high. This often happens with segmentation masks where the target value is 1.
+    threshold: float = Query(1),
+    smoothing_iterations: Optional[int] = Query(None, ge=0),
+    feature_angle: Optional[float] = Query(None, gt=0, le=180),
+    relaxation_factor: Optional[float] = Query(None, gt=0, le=1),
+    smoothing_preset: Optional[str] = Query(None, description="quality (default) or fast"),
+    target_reduction: float = Query(0.1, ge=0, lt=1),
+    target_triangles: Optional[int] = Query(None, ge=1, description="Decimate to at most this many triangles"),
+    target_bytes: Optional[int] = Query(None, ge=1, description="Decimate until every output file fits in this size"),
+    decimation: str = Query("quadric", description="Decimation method of the budgets: quadric or clustering (faster)"),
+    output_format: str = Query(",".join(DEFAULT_FORMATS), description="Comma-separated list of stl, ply, glb"),
+    lods: bool = Query(True, description="Publish coarse preview meshes before the full one"),
+    multi_label: bool = Query(False, description="One mesh per label value of a segmentation mask"),
+    crop: bool = Query(True, description="Crop the volume to the foreground bounding box before meshing"),
+    out_of_core: Optional[bool] = Query(None, description="Mesh slab by slab; chosen by volume size when omitted"),
+) -> dict:
+    """Pipeline parameters shared by the upload endpoints; they are also part of the result cache key."""
+    output_formats = [fmt.strip().lower() for fmt in output_format.split(",") if fmt.strip()]
+    unsupported = [fmt for fmt in output_formats if fmt not in MESH_FORMATS]
+    if unsupported or not output_formats:
+        raise HTTPException(status_code=400, detail=f"Unsupported output format: {output_format}")
+    if smoothing_preset is not None and smoothing_preset not in SMOOTHING_PRESETS:
+        raise HTTPException(status_code=400, detail=f"Unknown smoothing preset: {smoothing_preset}")
+    if decimation not in DECIMATION_METHODS:
+        raise HTTPException(status_code=400, detail=f"Unknown decimation method: {decimation}")
+
+    smoothing_params = {
+        name: value for name, value in (
+            ("iterations", smoothing_iterations),
+            ("feature_angle", feature_angle),
+            ("relaxation_factor", relaxation_factor),
+            ("preset", smoothing_preset),
+        ) if value is not None
+    }
+    return {
+        "threshold": threshold,
+        "smoothing_params": smoothing_params,
+        "target_reduction": target_reduction,
+        "target_triangles": target_triangles,
+        "target_bytes": target_bytes,
+        "decimation": decimation,
+        "output_formats": output_formats,
+        "lods": lods,
+        "multi_label": multi_label,
+        "crop": crop,
+        "out_of_core": out_of_core,
+    }
+
+
+def check_nifti_filename(filename: str):
+    if not filename or not filename.endswith(".nii.gz"):
         raise HTTPException(status_code=400, detail="Only .nii.gz files are supported.")
 
-    file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
-    
-    with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
 
-    # Initialize progress
-    await set_progress(file_id, {"step": "Uploading", "progress": 0})
+def multipart_upload_body(field: str, multiple: bool = False) -> dict:
+    """OpenAPI request body of the endpoints that parse their multipart upload themselves."""
+    schema = {"type": "string", "format": "binary"}
+    if multiple:
+        schema = {"type": "array", "items": schema}
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+        "type": "object", "properties": {field: schema}, "required": [field]}}}}}
+
+
+async def ingest_multipart(request: Request, field: str, max_files: Optional[int] = None) -> List[dict]:
+    """
+    Stores the files (at most `max_files`) of a multipart upload sent as `field` in UPLOAD_DIR, each
+    under a new file id, and returns them as [{"file_id", "filename", "path", "content_hash"}].
+
+    The body is parsed as it arrives (see ingest.iter_multipart_files): every chunk is written to
+    disk, hashed and staged to blob storage once, without being spooled to a temporary file first.
+    """
+    items, session = [], None
+    try:
+        async for event, value in iter_multipart_files(request.headers.get("content-type", ""), request.stream(), field):
+            if event == "begin":
+                if max_files is not None and len(items) >= max_files:
+                    raise HTTPException(status_code=400, detail=f"At most {max_files} file(s) can be uploaded here.")
+                check_nifti_filename(value)
+                file_id = str(uuid.uuid4())
+                input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{os.path.basename(value)}")
+                session = UploadSession(file_id, value, input_path, blob_upload=open_input_blob_upload(value))
+            elif event == "data":
+                await session.write(value)
+            else:
+                items.append({"file_id": session.upload_id, "filename": session.filename, "path": session.path,
+                              "content_hash": await session.finish()})
+                session = None
+        if not items:
+            raise HTTPException(status_code=400, detail=f"No file uploaded as '{field}'.")
+    except Exception as e:
+        if session is not None:
+            await session.discard()
+        for item in items:
+            os.remove(item["path"])
+        if isinstance(e, InvalidMultipartBody):
+            raise HTTPException(status_code=400, detail=str(e))
+        raise
+    return items
+
+
+@app.post("/api/process-nifti/", openapi_extra=multipart_upload_body("file"))
+async def process_nifti_file(request: Request, params: dict = Depends(pipeline_params)):
+    item = (await ingest_multipart(request, "file", max_files=1))[0]
+    return await start_processing(item["file_id"], item["path"], item["filename"], item["content_hash"], params)
+
+
+# --- Resumable uploads ---
+# POST /api/uploads creates an upload, PUT /api/uploads/{id} appends raw bytes starting at the
+# `Upload-Offset` header, GET /api/uploads/{id} tells a reconnecting client where to resume and
+# POST /api/uploads/{id}/complete hands the file to the pipeline.
+upload_sessions = UploadSessionStore()
+
+
+@app.post("/api/uploads")
+async def create_upload(filename: str = Query(...), size: Optional[int] = Query(None, ge=0)):
+    check_nifti_filename(filename)
+    await upload_sessions.expire()
+
+    upload_id = str(uuid.uuid4())
+    input_path = os.path.join(UPLOAD_DIR, f"{upload_id}_{os.path.basename(filename)}")
+    session = UploadSession(upload_id, filename, input_path, expected_size=size,
+                            blob_upload=open_input_blob_upload(filename))
+    upload_sessions.add(session)
+    return {"upload_id": upload_id, "offset": 0, "chunk_size": UPLOAD_CHUNK_SIZE}
+
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    session = upload_sessions.get(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload not found.")
+    return {"upload_id": upload_id, "offset": session.offset, "size": session.expected_size}
 
-    # --- Upload to Azure Blob Storage ---
-    # We add this as a background task so it doesn't block the initial response to the user.
-    background_tasks.add_task(upload_input_to_blob, input_path, file.filename)
 
-    background_tasks.add_task(run_pipeline_async, input_path, file_id)
+@app.put("/api/uploads/{upload_id}")
+async def append_upload(upload_id: str, request: Request, upload_offset: int = Header(0, ge=0)):
+    session = upload_sessions.get(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload not found.")
+    try:
+        await session.append(request.stream(), upload_offset)
+    except UploadOffsetMismatch as e:
+        raise HTTPException(status_code=409, detail=str(e), headers={"Upload-Offset": str(e.expected)})
+    return {"upload_id": upload_id, "offset": session.offset}
+
+
+@app.post("/api/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, params: dict = Depends(pipeline_params)):
+    session = upload_sessions.get(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload not found.")
+    if not session.complete:
+        raise HTTPException(status_code=409, detail=f"Upload is incomplete ({session.offset} of {session.expected_size} bytes)",
+                            headers={"Upload-Offset": str(session.offset)})
+    upload_sessions.pop(upload_id)
+    content_hash = await session.finish()
+    return await start_processing(upload_id, session.path, session.filename, content_hash, params)
+
+
+async def start_processing(file_id: str, input_path: str, filename: str, content_hash: str, params: dict,
+                           wait_for_room: bool = False) -> dict:
+    """
+    Hands an ingested upload to the pipeline: answers from the result cache when possible,
+    attaches to an identical upload that is already running, or queues a new job.
+    With `wait_for_room`, a full queue is waited out instead of answered with 429.
+    """
+    key = cache_key(content_hash, params)
 
-    return {"file_id": file_id}
+    cached = await result_cache.lookup(key)
+    if cached:
+        os.remove(input_path)
+        print(f"✅ Cache hit for {filename} ({key})")
+        await set_progress(file_id, {**cached, "cached": True})
+        return {"file_id": file_id, "queue_position": 0, "cached": True}
 
-async def run_pipeline_async(input_path: str, file_id: str) -> str:
-    from asyncio import to_thread
+    if not result_cache.join(key, file_id):
+        # An identical upload is already being processed; this one just waits for its result.
+        os.remove(input_path)
+        await set_progress(file_id, {"step": "Waiting for identical upload", "progress": 0})
+        return {"file_id": file_id, "queue_position": 0, "deduplicated": True}
+
+    # Initialize progress (batch volumes keep "Waiting in batch" until they are queued)
+    if not wait_for_room:
+        await set_progress(file_id, {"step": "Uploading", "progress": 0})
+
+    try:
+        if wait_for_room:
+            # Nothing may be awaited between this and `submit`, or another request could take the room.
+            await scheduler.wait_for_room()
+        await scheduler.submit(file_id, input_path, on_done=lambda job: publish_pipeline_result(job, key), **params)
+    except (QueueFullError, SchedulerUnavailableError) as e:
+        os.remove(input_path)
+        for follower_id in result_cache.release(key):
+            await set_progress(follower_id, {"step": "Error", "progress": 0, "error": str(e)})
+        if isinstance(e, QueueFullError):
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "30"})
+        raise HTTPException(status_code=503, detail=str(e))
+
+    return {"file_id": file_id, "queue_position": scheduler.queue_position(file_id) or 0}
+
+def describe_artifact(artifact: dict, url: str) -> dict:
+    """Public description of a generated file for the progress payload (no local paths)."""
+    return {
+        "format": artifact["format"],
+        "encoding": artifact["encoding"],
+        "bytes": artifact["bytes"],
+        "filename": os.path.basename(artifact["path"]),
+        "url": url,
+    }
+
+async def publish_pipeline_result(job, key: str) -> None:
+    """
+    Completion handler for scheduler jobs: uploads the generated STL, records the final progress,
+    stores the result in the cache and hands it to identical uploads that were waiting on it.
+    Failed and cancelled jobs have already been reported by the scheduler; waiting uploads
+    get the same final state.
+    """
+    file_id = job.file_id
+    try:
+        telemetry.record_job(job)
+    except Exception as e:
+        print(f"⚠️ Could not record telemetry for {file_id}: {e}")
+    if job.status != COMPLETED:
+        final = await get_progress_from_kv(file_id) or {"step": "Error", "progress": 0}
+        for follower_id in result_cache.release(key):
+            await set_progress(follower_id, final)
+        return
 
-    def on_progress(step: str, percent: int):
-        print(f"[{file_id}] Progress: {step} - {percent}%")  # Optional debug print
-        set_progress_sync(file_id, {"step": step, "progress": percent})
+    mesh_path = job.result["mesh_path"]
+    artifacts = job.result["artifacts"]
+    lods = job.result.get("lods", [])
 
     try:
-        stl_path = await to_thread(
-            # To segment bone from a CT scan, a higher threshold is needed.
-            # Common Hounsfield Unit (HU) values for bone are > 250.
-            # However, the error "No mesh could be created" indicates that for the current NIfTI file,
-            # a threshold of 250 is too high. This often happens with segmentation masks where the target value is 1.
-            lambda: full_pipeline(input_path, OUTPUT_DIR, threshold=1, file_id=file_id, progress_callback=on_progress)
-        )
-        print(f"✅ Pipeline generated STL file: {stl_path}")
-
-        # Upload the generated STL to blob storage and get the URL
-        await set_progress(file_id, {"step": "Uploading result", "progress": 99})
-        stl_url = await upload_output_to_blob(stl_path)
-
-        await set_progress(file_id, {
+        print(f"✅ Pipeline generated mesh file: {mesh_path}")
+
+        # Upload every generated artifact to blob storage concurrently and collect the URLs
+        await publish_progress(file_id, {"step": "Uploading result", "progress": 99})
+        files = [artifact["path"] for artifact in artifacts] + [lod["path"] for lod in lods]
+        urls = await asyncio.gather(*(upload_output_to_blob(path) for path in files))
+        # A failed upload leaves an empty URL: such a result is served from /api/outputs but not cached,
+        # or the cache would hand the missing file to every identical upload.
+        cacheable = not blob_storage.enabled or all(urls)
+        urls = [url or f"/api/outputs/{os.path.basename(path)}" for path, url in zip(files, urls)]
+
+        payload = {
             "step": "Completed",
             "progress": 100,
-            "url": stl_url,
-            "filename": os.path.basename(stl_path) # Keep for reference if needed
-        })
+            "url": urls[0],
+            "filename": os.path.basename(mesh_path), # Keep for reference if needed
+            "artifacts": [describe_artifact(artifact, url) for artifact, url in zip(artifacts, urls)],
+            "lods": [
+                {**{k: v for k, v in lod.items() if k != "path"}, "url": url}
+                for lod, url in zip(lods, urls[len(artifacts):])
+            ],
+        }
+        if job.result.get("memory_mb"):
+            payload["memory_mb"] = job.result["memory_mb"]
+        if job.result.get("roi"):
+            payload["roi"] = job.result["roi"]
+        if job.result.get("cleaning"):
+            payload["cleaning"] = job.result["cleaning"]
+        if job.result.get("decimation"):
+            payload["decimation"] = job.result["decimation"]
+        if "labels" in job.result:
+            # Multi-label runs: the first artifact is the manifest, each label lists its own files.
+            url_by_path = dict(zip(files, urls))
+            payload["labels"] = [
+                {
+                    **{k: v for k, v in entry.items() if k != "artifacts"},
+                    "artifacts": [describe_artifact(artifact, url_by_path[artifact["path"]])
+                                  for artifact in entry["artifacts"]],
+                }
+                for entry in job.result["labels"]
+            ]
+        if cacheable:
+            await result_cache.store(key, payload, files)
+            await publish_cached_result_to_blob(key, payload)
+        await set_progress(file_id, payload)
+        for follower_id in result_cache.release(key):
+            await set_progress(follower_id, {**payload, "cached": True})
     except Exception as e:
         # Ensure to await the async set_progress call
         await set_progress(file_id, {"step": "Error", "progress": 0})
+        for follower_id in result_cache.release(key):
+            await set_progress(follower_id, {"step": "Error", "progress": 0})
         print(f"❌ Pipeline failed for {file_id}: {e}")
 
 
+@app.get("/api/jobs/{file_id}")
+async def get_job(file_id: str):
+    status = scheduler.status(file_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return status
+
+
+@app.delete("/api/jobs/{file_id}")
+async def cancel_job(file_id: str):
+    job = await scheduler.cancel(file_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return scheduler.status(file_id)
+
+
+# --- Batches ---
+# POST /api/batches takes many .nii.gz files in one multipart request, POST /api/batches/manifest
+# a list of blob names in the storage container (for backfills of studies that are already there).
+# Every volume becomes a regular job with its own file id, progress record and result cache entry,
+# so /api/progress and /api/jobs work for it as well. Volumes are handed to the scheduler one by one
+# as its queue drains, so a batch can be larger than PIPELINE_QUEUE_SIZE; manifest volumes are only
+# downloaded when it is their turn. GET /api/batches/{id} sums up the state of every volume.
+# For headless runs over a directory without the API, see batch.py.
+BATCH_HISTORY = 100  # Batches remembered once all their volumes have been submitted
+batches: "collections.OrderedDict[str, dict]" = collections.OrderedDict()
+
+# Final progress steps of a volume and the batch status they map to.
+BATCH_FINAL_STEPS = {"Completed": "completed", "Error": "failed", "Cancelled": "cancelled"}
+
+
+def create_batch(items: List[dict], params: dict) -> dict:
+    batch_id = str(uuid.uuid4())
+    batch = {"batch_id": batch_id, "created_at": time.time(), "items": items}
+    batch["task"] = asyncio.create_task(feed_batch(batch, params))
+    batches[batch_id] = batch
+    while len(batches) > BATCH_HISTORY:
+        oldest_id, oldest = next(iter(batches.items()))
+        if not oldest["task"].done():
+            break
+        del batches[oldest_id]
+    print(f"✅ Batch {batch_id} created with {len(items)} volume(s)")
+    return {"batch_id": batch_id, "items": [{"file_id": item["file_id"], "filename": item["filename"]} for item in items]}
+
+
+async def feed_batch(batch: dict, params: dict):
+    """Submits the volumes of a batch in order, each as soon as the scheduler has room for it."""
+    items = batch["items"]
+    try:
+        for item in items:
+            try:
+                if "blob" in item:
+                    item["content_hash"] = await blob_storage.download_file(item["blob"], item["path"])
+                    if item["content_hash"] is None:
+                        raise FileNotFoundError(f"Blob not found: {item['blob']}")
+                await start_processing(item["file_id"], item["path"], item["filename"], item["content_hash"],
+                                       params, wait_for_room=True)
+                item["submitted"] = True
+            except Exception as e:
+                item["error"] = e.detail if isinstance(e, HTTPException) else str(e)
+                print(f"❌ Batch {batch['batch_id']}: could not submit {item['filename']}: {item['error']}")
+                if os.path.exists(item["path"]):
+                    os.remove(item["path"])
+                await set_progress(item["file_id"], {"step": "Error", "progress": 0, "error": item["error"]})
+    finally:
+        # Cancelled at shutdown: uploads that never reached the pipeline are not kept.
+        for item in items:
+            if not item.get("submitted") and os.path.exists(item["path"]):
+                os.remove(item["path"])
+
+
+@app.post("/api/batches", openapi_extra=multipart_upload_body("files", multiple=True))
+async def create_upload_batch(request: Request, params: dict = Depends(pipeline_params)):
+    items = await ingest_multipart(request, "files")
+    for item in items:
+        await set_progress(item["file_id"], {"step": "Waiting in batch", "progress": 0})
+    return create_batch(items, params)
+
+
+@app.post("/api/batches/manifest")
+async def create_manifest_batch(blobs: List[str] = Body(..., embed=True), params: dict = Depends(pipeline_params)):
+    if not blob_storage.enabled:
+        raise HTTPException(status_code=503, detail="Blob storage is not configured.")
+    if not blobs:
+        raise HTTPException(status_code=400, detail="The manifest lists no blobs.")
+    for blob_name in blobs:
+        check_nifti_filename(blob_name)
+
+    items = []
+    for blob_name in blobs:
+        file_id, filename = str(uuid.uuid4()), os.path.basename(blob_name)
+        items.append({"file_id": file_id, "filename": filename, "blob": blob_name,
+                      "path": os.path.join(UPLOAD_DIR, f"{file_id}_{filename}")})
+        await set_progress(file_id, {"step": "Waiting in batch", "progress": 0})
+    return create_batch(items, params)
+
+
+@app.get("/api/batches/{batch_id}")
+async def get_batch(batch_id: str):
+    batch = batches.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found.")
+
+    records = await asyncio.gather(*(get_progress_from_kv(item["file_id"]) for item in batch["items"]))
+    counts = collections.Counter()
+    items = []
+    for item, record in zip(batch["items"], records):
+        if item.get("error"):
+            status = "failed"
+        elif not item.get("submitted"):
+            status = "pending"
+        else:
+            status = BATCH_FINAL_STEPS.get((record or {}).get("step"), "processing")
+        counts[status] += 1
+        entry = {"file_id": item["file_id"], "filename": item["filename"], "status": status}
+        if "blob" in item:
+            entry["blob"] = item["blob"]
+        if record:
+            entry["progress"] = record
+        items.append(entry)
+    return {
+        "batch_id": batch_id,
+        "created_at": batch["created_at"],
+        "total": len(items),
+        "counts": dict(counts),
+        "submitting": not batch["task"].done(),
+        "items": items,
+    }
+
+
+@app.get("/api/storage/metrics")
+async def get_storage_metrics():
+    return blob_storage.metrics.snapshot()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics of the pipeline stages, job queue, blob storage and progress store."""
+    rendered = telemetry.render()
+    if rendered is None:
+        raise HTTPException(status_code=503, detail="prometheus_client is not installed.")
+    body, content_type = rendered
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/api/kv/metrics")
+async def get_kv_metrics():
+    """Backend, queued writes and per-operation latency of the progress store."""
+    return progress_store.snapshot()
+
+
 @app.get("/api/progress/{file_id}")
 async def get_progress(file_id: str):
     progress = await get_progress_from_kv(file_id)
     return progress or {"step": "Pending", "progress": 0}
 
+
+@app.get("/api/progress/{file_id}/stream")
+async def stream_progress(file_id: str):
+    """Server-Sent Events with every progress update of a job; the stream ends after the final step."""
+    async def events():
+        async for data in progress_broker.subscribe(file_id, keepalive=PROGRESS_STREAM_KEEPALIVE):
+            yield ": keepalive\n\n" if data is None else f"data: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.websocket("/api/progress/{file_id}/ws")
+async def progress_websocket(websocket: WebSocket, file_id: str):
+    """WebSocket variant of /api/progress/{file_id}/stream: one JSON message per progress update."""
+    await websocket.accept()
+
+    async def send_updates():
+        async for data in progress_broker.subscribe(file_id):
+            await websocket.send_json(data)
+
+    async def wait_for_disconnect():
+        # Client messages are ignored; reading them is what notices a closed socket while the job is idle
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    sender = asyncio.create_task(send_updates())
+    receiver = asyncio.create_task(wait_for_disconnect())
+    # Whichever ends first (final step sent or client gone) cancels the other, closing the subscription
+    try:
+        await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        sender.cancel()
+        receiver.cancel()
+        await asyncio.wait({sender, receiver})
+    if not receiver.cancelled():
+        receiver.exception()  # Retrieved so a failed read (socket already gone) is not logged
+    if not sender.cancelled() and sender.exception() is None:
+        await websocket.close()
+
 # This endpoint is no longer the primary way to get files but can be kept for debugging.
 # The frontend will now use the direct blob URL.
 @app.get("/api/outputs/{filename}")
 async def get_output_file(filename: str):
+    # Outputs of cached results have been moved into the result cache.
     file_path = os.path.join(OUTPUT_DIR, filename)
     if not os.path.isfile(file_path):
+        file_path = result_cache.find_file(filename)
+    if file_path is None:
         raise HTTPException(status_code=404, detail="File not found.")
-    return FileResponse(file_path, media_type="model/stl")
+    media_type, encoding = mimetypes.guess_type(file_path)
+    headers = {"Content-Encoding": encoding} if encoding else None
+    return FileResponse(file_path, media_type=media_type or "application/octet-stream", headers=headers)
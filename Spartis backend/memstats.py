@@ -0,0 +1,65 @@
+import sys
+from typing import Dict, Optional
+
+# Peak resident memory of the current process, per pipeline stage.
+# On Linux the peak (VmHWM) is read from /proc/self/status and can be reset between stages by
+# writing "5" to /proc/self/clear_refs. Elsewhere getrusage's ru_maxrss is used, which cannot be
+# reset, so every stage then reports the process peak so far.
+
+
+def _proc_status_kb(field: str) -> Optional[int]:
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def peak_rss_mb() -> float:
+    """Highest resident set size of this process since start (or since the last reset), in MB."""
+    kb = _proc_status_kb("VmHWM")
+    if kb is not None:
+        return kb / 1024
+    try:
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024  # bytes on macOS, KB elsewhere
+    except ImportError:
+        return 0.0
+
+
+def current_rss_mb() -> float:
+    kb = _proc_status_kb("VmRSS")
+    return kb / 1024 if kb is not None else peak_rss_mb()
+
+
+def reset_peak_rss() -> bool:
+    """Resets the peak to the current RSS. Returns False where that is not supported."""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class StageMemory:
+    """
+    Records the peak RSS of consecutive stages: `stage(name)` closes the running stage, storing
+    its peak in `peaks`, and starts `name`. Stages that run several times keep their highest peak.
+    """
+
+    def __init__(self):
+        self.peaks: Dict[str, float] = {}
+        self._current: Optional[str] = None
+        reset_peak_rss()
+
+    def stage(self, name: Optional[str]):
+        if self._current is not None:
+            peak = round(peak_rss_mb(), 1)
+            self.peaks[self._current] = max(peak, self.peaks.get(self._current, 0.0))
+        self._current = name
+        reset_peak_rss()
@@ -0,0 +1,194 @@
+import gzip
+import json
+import os
+import struct
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from dicomtomesh import save_mesh_as_stl
+from pipeline_options import DEFAULT_FORMATS, MESH_FORMATS
+
+try:
+    import brotli  # Optional: brotli variants are only written when it is installed
+except ImportError:
+    brotli = None
+
+# Pre-compressed siblings written next to each artifact ("<name>.gz", "<name>.br").
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+# Uncompressed size of each format as (bytes per file, per point, per triangle) for meshes with
+# point normals, used to fit a mesh to a byte budget. The header sizes are rounded up.
+FORMAT_SIZES = {"stl": (84, 0, 50), "ply": (512, 24, 13), "glb": (1024, 12, 12)}
+# GLB indices are 16-bit instead of 32-bit for meshes below 65536 points.
+GLB_SHORT_INDEX_MAX_POINTS = 65536
+
+
+def save_ply(mesh, output_path):
+    ply_writer = vtk.vtkPLYWriter()
+    ply_writer.SetFileName(output_path)
+    ply_writer.SetInputData(mesh)
+    ply_writer.SetFileTypeToBinary()
+    ply_writer.SetDataByteOrderToLittleEndian()
+    ply_writer.Write()
+
+
+def _triangles(mesh):
+    """Returns (points, normals or None, triangle indices) of a mesh as NumPy arrays."""
+    polys = mesh.GetPolys()
+    offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+    if len(offsets) > 1 and not np.all(np.diff(offsets) == 3):
+        triangulate = vtk.vtkTriangleFilter()
+        triangulate.SetInputData(mesh)
+        triangulate.Update()
+        mesh = triangulate.GetOutput()
+        polys = mesh.GetPolys()
+
+    points = numpy_support.vtk_to_numpy(mesh.GetPoints().GetData())
+    faces = numpy_support.vtk_to_numpy(polys.GetConnectivityArray()).reshape(-1, 3)
+    normal_array = mesh.GetPointData().GetNormals()
+    normals = numpy_support.vtk_to_numpy(normal_array) if normal_array is not None else None
+    return points, normals, faces
+
+
+def save_quantized_glb(mesh, output_path):
+    """
+    Writes the mesh as a single-mesh GLB using KHR_mesh_quantization:
+    positions as 16-bit integers (dequantized by the node's uniform scale and translation) and
+    normals as normalized 8-bit integers, which is about a third of float32 storage.
+    """
+    points, normals, faces = _triangles(mesh)
+    points = points.astype(np.float64)
+    lower = points.min(axis=0) if len(points) else np.zeros(3)
+    upper = points.max(axis=0) if len(points) else np.ones(3)
+    # One step for all axes: a non-uniform node scale would skew the normals, which viewers
+    # transform by its inverse transpose.
+    step = float((upper - lower).max()) / 65535.0 or 1.0
+
+    # Vertex attributes must be 4-byte aligned, so each VEC3 is padded to four components.
+    quantized = np.zeros((len(points), 4), dtype=np.uint16)
+    quantized[:, :3] = np.rint((points - lower) / step)
+    chunks = [quantized.tobytes()]
+    buffer_views = [{"buffer": 0, "byteOffset": 0, "byteLength": quantized.nbytes, "byteStride": 8, "target": 34962}]
+    accessors = [{
+        "bufferView": 0, "componentType": 5123, "count": len(points), "type": "VEC3",
+        "min": quantized[:, :3].min(axis=0).tolist() if len(points) else [0, 0, 0],
+        "max": quantized[:, :3].max(axis=0).tolist() if len(points) else [0, 0, 0],
+    }]
+    attributes = {"POSITION": 0}
+    offset = quantized.nbytes
+
+    if normals is not None:
+        packed = np.zeros((len(normals), 4), dtype=np.int8)
+        packed[:, :3] = np.clip(np.rint(normals * 127.0), -127, 127)
+        chunks.append(packed.tobytes())
+        buffer_views.append({"buffer": 0, "byteOffset": offset, "byteLength": packed.nbytes, "byteStride": 4,
+                             "target": 34962})
+        accessors.append({"bufferView": len(buffer_views) - 1, "componentType": 5120, "normalized": True,
+                          "count": len(normals), "type": "VEC3"})
+        attributes["NORMAL"] = len(accessors) - 1
+        offset += packed.nbytes
+
+    index_type, component_type = (np.uint16, 5123) if len(points) < 65536 else (np.uint32, 5125)
+    indices = faces.astype(index_type).ravel()
+    index_bytes = indices.tobytes()
+    index_bytes += b"\0" * (-len(index_bytes) % 4)
+    chunks.append(index_bytes)
+    buffer_views.append({"buffer": 0, "byteOffset": offset, "byteLength": indices.nbytes, "target": 34963})
+    accessors.append({"bufferView": len(buffer_views) - 1, "componentType": component_type,
+                      "count": len(indices), "type": "SCALAR"})
+    binary = b"".join(chunks)
+
+    gltf = {
+        "asset": {"version": "2.0", "generator": "Spartis backend"},
+        "extensionsUsed": ["KHR_mesh_quantization"],
+        "extensionsRequired": ["KHR_mesh_quantization"],
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0, "translation": lower.tolist(), "scale": [step] * 3}],
+        "meshes": [{"primitives": [{"attributes": attributes, "indices": len(accessors) - 1, "mode": 4}]}],
+        "accessors": accessors,
+        "bufferViews": buffer_views,
+        "buffers": [{"byteLength": len(binary)}],
+    }
+    json_bytes = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+    json_bytes += b" " * (-len(json_bytes) % 4)
+
+    with open(output_path, "wb") as f:
+        f.write(struct.pack("<III", 0x46546C67, 2, 12 + 8 + len(json_bytes) + 8 + len(binary)))
+        f.write(struct.pack("<II", len(json_bytes), 0x4E4F534A))
+        f.write(json_bytes)
+        f.write(struct.pack("<II", len(binary), 0x004E4942))
+        f.write(binary)
+
+
+def triangles_for_bytes(budget, formats=DEFAULT_FORMATS, points_per_triangle=0.5):
+    """
+    The largest triangle count whose file stays within `budget` bytes in every format of `formats`
+    (see FORMAT_SIZES), for a mesh with `points_per_triangle` points per triangle (about 1/2 for
+    closed surfaces).
+    """
+    counts = []
+    for fmt in formats:
+        fixed, per_point, per_triangle = FORMAT_SIZES[fmt]
+        count = (budget - fixed) / (per_triangle + per_point * points_per_triangle)
+        if fmt == "glb":
+            short_count = (budget - fixed) / (per_triangle / 2 + per_point * points_per_triangle)
+            if short_count * points_per_triangle < GLB_SHORT_INDEX_MAX_POINTS:
+                count = short_count
+        counts.append(count)
+    return max(0, int(min(counts)))
+
+
+_WRITERS = {"stl": save_mesh_as_stl, "ply": save_ply, "glb": save_quantized_glb}
+
+
+def precompress(path):
+    """
+    Writes gzip (and, when the brotli package is installed, brotli) compressed copies of a file
+    next to it. Returns a list of (encoding, path) pairs.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    variants = []
+    gz_path = f"{path}.gz"
+    with open(gz_path, "wb") as f:
+        f.write(gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0))
+    variants.append(("gzip", gz_path))
+    if brotli is not None:
+        br_path = f"{path}.br"
+        with open(br_path, "wb") as f:
+            f.write(brotli.compress(data, quality=BROTLI_QUALITY))
+        variants.append(("br", br_path))
+    return variants
+
+
+def export_mesh(mesh, output_dir, base_name, formats=DEFAULT_FORMATS, compress=True, progress=None):
+    """
+    Writes the mesh in every requested format (plus pre-compressed variants) as
+    `<output_dir>/<base_name>_mesh.<ext>[.gz|.br]`.
+    `progress(fraction)` is called as the files are written.
+    :return: list of artifact dicts with "format", "encoding" (None, "gzip" or "br"), "path" and "bytes"
+    """
+    artifacts = []
+    variants = (2 if brotli is not None else 1) if compress else 0
+    units = 1 + 2 * variants  # Compressing at these levels takes about twice as long as writing
+    for index, fmt in enumerate(formats):
+        if fmt not in _WRITERS:
+            raise ValueError(f"Unsupported output format: {fmt}")
+        path = os.path.join(str(output_dir), f"{base_name}_mesh{MESH_FORMATS[fmt]}")
+        _WRITERS[fmt](mesh, path)
+        artifacts.append({"format": fmt, "encoding": None, "path": path, "bytes": os.path.getsize(path)})
+        if progress is not None:
+            progress((index * units + 1) / (len(formats) * units))
+        if compress:
+            for encoding, variant_path in precompress(path):
+                artifacts.append({"format": fmt, "encoding": encoding, "path": variant_path,
+                                  "bytes": os.path.getsize(variant_path)})
+            if progress is not None:
+                progress((index + 1) / len(formats))
+        if fmt != "stl":
+            print(f"{fmt.upper()} file saved at: {path}")
+    return artifacts
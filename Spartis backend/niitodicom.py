@@ -1,108 +1,268 @@
 import os
+import collections
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
 import SimpleITK as sitk
 import pydicom
-from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_data_element, write_file_meta_info
+from pydicom.sequence import Sequence
 import datetime
 import numpy as np
 import uuid
-import nibabel as nib
 
+from volume_io import cached_path, load_nifti, write_with_affine
 
-def fix_nifti_orientation_nibabel(nii_path, fixed_nii_path):
-    # Load NIfTI using NiBabel
-    nifti = nib.load(nii_path)
-    
-    # Extract affine transformation matrix
-    affine = nifti.affine.copy()
+# Worker processes writing DICOM slices (1 writes them in the calling process).
+DICOM_WRITE_WORKERS = int(os.environ.get("DICOM_WRITE_WORKERS", os.cpu_count() or 1))
+# Slices queued per worker; pending slices are the only extra memory the parallel writer holds.
+DICOM_MAX_IN_FLIGHT = 4
+# Smaller series are written in-process: starting the pool would take longer than the writes.
+DICOM_MIN_PARALLEL_SLICES = 64
 
-    # Compute nearest orthonormal matrix using SVD
+
+def orthonormalize_affine(affine):
+    """
+    Returns a copy of the 4x4 affine whose rotation part is replaced by the
+    nearest orthonormal matrix (computed with SVD).
+    """
+    affine = np.array(affine, dtype=float, copy=True)
     U, _, Vt = np.linalg.svd(affine[:3, :3])
     affine[:3, :3] = np.dot(U, Vt)  # Enforce orthonormality
+    return affine
+
 
-    # Create new NIfTI image with corrected affine
-    fixed_nifti = nib.Nifti1Image(nifti.get_fdata(), affine, nifti.header)
+def fix_nifti_orientation_nibabel(nii_path, fixed_nii_path):
+    # Load NIfTI header using NiBabel (the voxels are not needed to fix the affine)
+    nifti = load_nifti(nii_path)
     
-    # Save the corrected image
-    nib.save(fixed_nifti, fixed_nii_path)
+    # Compute nearest orthonormal matrix using SVD
+    affine = orthonormalize_affine(nifti.affine)
+
+    # Save the corrected image: new header, voxel data copied through unchanged
+    write_with_affine(nifti, fixed_nii_path, affine)
 
 
 def generate_dicom_uid():
     return "2.25." + str(uuid.uuid4().int)
 
 
-def nii_to_dicom(nii_path, dicom_output_dir):
+def _series_template(spacing, row_cosines, col_cosines, rows, columns):
+    """
+    Dataset with every tag that is the same for all slices of a series. It is encoded once
+    (`_encode_template`); each slice then only encodes its own UID, position and pixels.
+    """
+    now = datetime.datetime.now()
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = pydicom.uid.CTImageStorage
+    file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    file_meta.ImplementationClassUID = generate_dicom_uid()
+
+    ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.PatientName = "Test^Patient"
+    ds.PatientID = "123456"
+    ds.StudyInstanceUID = generate_dicom_uid()
+    ds.SeriesInstanceUID = generate_dicom_uid()
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.Modality = "CT"
+    ds.StudyDate = now.strftime("%Y%m%d")
+    ds.StudyTime = now.strftime("%H%M%S")
+    ds.SeriesNumber = 1
+
+    # DICOM spatial tags
+    ds.Rows, ds.Columns = rows, columns
+    ds.PixelSpacing = [str(spacing[1]), str(spacing[0])]  # y, x
+    ds.SliceThickness = spacing[2]
+    ds.ImageOrientationPatient = [str(val) for val in np.concatenate([row_cosines, col_cosines])]
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.RescaleIntercept = 0
+    ds.RescaleSlope = 1
+    return ds
+
+
+def _encode_elements(dataset):
+    """Explicit VR little endian encoding of every element of `dataset`, as (tag, bytes) pairs."""
+    encoded = []
+    for elem in dataset:
+        fp = DicomBytesIO()
+        fp.is_little_endian = True
+        fp.is_implicit_VR = False
+        write_data_element(fp, elem)
+        encoded.append((elem.tag, fp.getvalue()))
+    return encoded
+
+
+def _encode_template(template):
+    """
+    Encodes the template once: (encoded data elements, file meta). Slices only encode their
+    own elements and are merged with these bytes in tag order.
+    """
+    return _encode_elements(template), template.file_meta
+
+
+def _write_slice(encoded_template, z, pixel_bytes, ipp, out_path):
+    """Writes slice `z` as its own file, reusing the pre-encoded template elements."""
+    template_elements, template_meta = encoded_template
+    file_meta = FileMetaDataset()
+    file_meta.update(template_meta)
+    file_meta.MediaStorageSOPInstanceUID = generate_dicom_uid()
+    meta_fp = DicomBytesIO()
+    meta_fp.is_little_endian = True
+    meta_fp.is_implicit_VR = False
+    write_file_meta_info(meta_fp, file_meta)
+
+    ds = Dataset()
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.InstanceNumber = z + 1
+    ds.ImagePositionPatient = [str(val) for val in ipp]
+    ds.SliceLocation = float(ipp[2])
+    ds.add_new(0x7FE00010, "OW", pixel_bytes)  # PixelData
+
+    with open(out_path, "wb") as f:
+        f.write(b"\0" * 128 + b"DICM")
+        f.write(meta_fp.getvalue())
+        for _, encoded in sorted(template_elements + _encode_elements(ds)):
+            f.write(encoded)
+    return len(pixel_bytes)
+
+
+# Encoded template of the series being written, set once per worker process by `_init_slice_worker`.
+_worker_template = None
+
+
+def _init_slice_worker(encoded_template):
+    global _worker_template
+    _worker_template = encoded_template
+
+
+def _write_slice_in_worker(z, pixel_bytes, ipp, out_path):
+    return _write_slice(_worker_template, z, pixel_bytes, ipp, out_path)
+
+
+def _write_multiframe(template, array, positions, out_path):
+    """
+    Writes the whole volume as one Enhanced CT object: the geometry shared by all frames goes into
+    the shared functional groups, each frame only carries its position.
+    """
+    file_meta = FileMetaDataset()
+    file_meta.update(template.file_meta)
+    file_meta.MediaStorageSOPClassUID = pydicom.uid.EnhancedCTImageStorage
+    file_meta.MediaStorageSOPInstanceUID = generate_dicom_uid()
+
+    ds = FileDataset(out_path, {}, file_meta=file_meta, preamble=template.preamble)
+    for keyword in ("PatientName", "PatientID", "StudyInstanceUID", "SeriesInstanceUID", "Modality",
+                    "StudyDate", "StudyTime", "SeriesNumber", "Rows", "Columns", "SamplesPerPixel",
+                    "PhotometricInterpretation", "BitsAllocated", "BitsStored", "HighBit", "PixelRepresentation"):
+        setattr(ds, keyword, getattr(template, keyword))
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.InstanceNumber = 1
+    ds.ImageType = ["DERIVED", "PRIMARY", "VOLUME", "NONE"]
+    ds.ContentDate, ds.ContentTime = template.StudyDate, template.StudyTime
+    ds.NumberOfFrames = array.shape[0]
+
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = template.PixelSpacing
+    pixel_measures.SliceThickness = template.SliceThickness
+    plane_orientation = Dataset()
+    plane_orientation.ImageOrientationPatient = template.ImageOrientationPatient
+    value_transformation = Dataset()
+    value_transformation.RescaleIntercept = template.RescaleIntercept
+    value_transformation.RescaleSlope = template.RescaleSlope
+    value_transformation.RescaleType = "HU"
+    shared = Dataset()
+    shared.PixelMeasuresSequence = Sequence([pixel_measures])
+    shared.PlaneOrientationSequence = Sequence([plane_orientation])
+    shared.PixelValueTransformationSequence = Sequence([value_transformation])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared])
+
+    frames = []
+    for z, ipp in enumerate(positions):
+        plane_position = Dataset()
+        plane_position.ImagePositionPatient = [str(val) for val in ipp]
+        frame_content = Dataset()
+        frame_content.InStackPositionNumber = z + 1
+        frame = Dataset()
+        frame.PlanePositionSequence = Sequence([plane_position])
+        frame.FrameContentSequence = Sequence([frame_content])
+        frames.append(frame)
+    ds.PerFrameFunctionalGroupsSequence = Sequence(frames)
+
+    ds.PixelData = np.ascontiguousarray(array, dtype="<i2").tobytes()
+    ds.save_as(out_path)
+    return len(ds.PixelData)
+
+
+def nii_to_dicom(nii_path, dicom_output_dir, workers=DICOM_WRITE_WORKERS, multiframe=False):
+    """
+    Converts a NIfTI volume into a CT DICOM series (`slice_<z>.dcm`), or with `multiframe=True`
+    into one Enhanced CT file (`volume.dcm`).
+
+    All slices are written from one template dataset, encoded once. With `workers > 1` (and enough slices)
+    the files are written by a pool of worker processes; at most DICOM_MAX_IN_FLIGHT slices per
+    worker are queued at a time, which bounds the memory held by pending writes.
+    :return: {"slices", "bytes", "seconds", "slices_per_s"}, or None when there is only one slice
+    """
     os.makedirs(dicom_output_dir, exist_ok=True)
+    started = time.perf_counter()
 
-    # Load image using SimpleITK (preserves spacing, direction, origin)
-    image = sitk.ReadImage(nii_path)
+    # Load image using SimpleITK (preserves spacing, direction, origin), from the raw copy if compressed
+    image = sitk.ReadImage(cached_path(nii_path))
     spacing = image.GetSpacing()
     direction = np.array(image.GetDirection()).reshape(3, 3)
     origin = np.array(image.GetOrigin())
     size = image.GetSize()  # (x, y, z)
     array = sitk.GetArrayFromImage(image)  # (z, y, x)
+    del image
 
     print(f"Image size: {size}, spacing: {spacing}")
     if array.shape[0] < 2:
         print("⚠️ ERROR: Only one slice in Z dimension. Mesh generation will fail.")
         return
 
-    # UID generation
-    study_uid = generate_dicom_uid()
-    series_uid = generate_dicom_uid()
-    now = datetime.datetime.now()
-
     # Orientation vectors
     row_cosines = direction[:, 0]
     col_cosines = direction[:, 1]
     normal_cosines = np.cross(row_cosines, col_cosines)
 
-    for z in range(array.shape[0]):
-        pixel_data = array[z].astype(np.int16)
-
-        # Compute ImagePositionPatient using direction cosines
-        ipp = origin + z * spacing[2] * normal_cosines
-
-        file_meta = FileMetaDataset()
-        file_meta.MediaStorageSOPClassUID = pydicom.uid.CTImageStorage
-        file_meta.MediaStorageSOPInstanceUID = generate_dicom_uid()
-        file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
-        file_meta.ImplementationClassUID = generate_dicom_uid()
-
-        ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
-        ds.PatientName = "Test^Patient"
-        ds.PatientID = "123456"
-        ds.StudyInstanceUID = study_uid
-        ds.SeriesInstanceUID = series_uid
-        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
-        ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
-        ds.Modality = "CT"
-        ds.StudyDate = now.strftime("%Y%m%d")
-        ds.StudyTime = now.strftime("%H%M%S")
-        ds.SeriesNumber = 1
-        ds.InstanceNumber = z + 1
-
-        # DICOM spatial tags
-        ds.Rows, ds.Columns = pixel_data.shape
-        ds.PixelSpacing = [str(spacing[1]), str(spacing[0])]  # y, x
-        ds.SliceThickness = spacing[2]
-        ds.ImagePositionPatient = [str(val) for val in ipp]
-        ds.ImageOrientationPatient = [str(val) for val in np.concatenate([row_cosines, col_cosines])]
-        ds.SliceLocation = float(ipp[2])
-        ds.SamplesPerPixel = 1
-        ds.PhotometricInterpretation = "MONOCHROME2"
-        ds.BitsAllocated = 16
-        ds.BitsStored = 16
-        ds.HighBit = 15
-        ds.PixelRepresentation = 1
-        ds.RescaleIntercept = 0
-        ds.RescaleSlope = 1
-        ds.PixelData = pixel_data.tobytes()
-
-        out_path = os.path.join(dicom_output_dir, f"slice_{z:04d}.dcm")
-        ds.save_as(out_path)
-        #print(f"✅ Saved: {out_path}")
-
-    print("\n✅ DICOM series conversion complete.")
+    template = _series_template(spacing, row_cosines, col_cosines, *array.shape[1:])
+    # Compute ImagePositionPatient using direction cosines
+    positions = [origin + z * spacing[2] * normal_cosines for z in range(array.shape[0])]
+
+    if multiframe:
+        written = _write_multiframe(template, array.astype(np.int16, copy=False), positions,
+                                    os.path.join(dicom_output_dir, "volume.dcm"))
+    else:
+        encoded = _encode_template(template)
+        slices = ((z, array[z].astype(np.int16).tobytes(), positions[z],
+                   os.path.join(dicom_output_dir, f"slice_{z:04d}.dcm")) for z in range(array.shape[0]))
+        if workers > 1 and array.shape[0] >= DICOM_MIN_PARALLEL_SLICES:
+            written = 0
+            pending = collections.deque()
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_slice_worker, initargs=(encoded,)) as executor:
+                for task in slices:
+                    pending.append(executor.submit(_write_slice_in_worker, *task))
+                    while len(pending) >= workers * DICOM_MAX_IN_FLIGHT:
+                        written += pending.popleft().result()
+                written += sum(future.result() for future in pending)
+        else:
+            written = sum(_write_slice(encoded, *task) for task in slices)
+
+    elapsed = time.perf_counter() - started
+    stats = {"slices": int(array.shape[0]), "bytes": int(written), "seconds": round(elapsed, 3),
+             "slices_per_s": round(array.shape[0] / max(elapsed, 1e-9), 1)}
+    print(f"\n✅ DICOM series conversion complete: {stats['slices']} slices in {elapsed:.2f}s "
+          f"({stats['slices_per_s']} slices/s).")
+    return stats
 
 
 # Example usage
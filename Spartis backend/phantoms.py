@@ -0,0 +1,88 @@
+"""
+Synthetic volumes for the benchmarks. Every generator returns a Fortran-ordered (x, y, z) array for
+a cubic volume of `size` voxels per side; `write_phantom` saves one as a NIfTI file.
+"""
+import nibabel as nib
+import numpy as np
+
+# Voxel spacing (mm) of the written phantoms: anisotropic like most CT series.
+PHANTOM_SPACING = (0.8, 0.8, 1.25)
+
+
+def _grid(size):
+    """Normalized coordinates in [-1, 1] along each axis."""
+    axis = np.linspace(-1.0, 1.0, size, dtype=np.float32)
+    return np.meshgrid(axis, axis, axis, indexing="ij")
+
+
+def sphere_mask(size):
+    """A uint8 mask of a sphere filling most of the volume."""
+    x, y, z = _grid(size)
+    return np.asfortranarray((x * x + y * y + z * z) < 0.8 ** 2).astype(np.uint8)
+
+
+def nested_shells(size, shells=4):
+    """A uint8 mask of concentric spherical shells: several closed surfaces nested in each other."""
+    x, y, z = _grid(size)
+    radius = np.sqrt(x * x + y * y + z * z)
+    band = np.floor(radius * shells * 2).astype(np.int32)
+    return np.asfortranarray((band % 2 == 1) & (radius < 0.95)).astype(np.uint8)
+
+
+def multi_label(size, labels=6):
+    """A uint8 label map of `labels` ellipsoids of different sizes, some of them touching."""
+    x, y, z = _grid(size)
+    data = np.zeros(x.shape, dtype=np.uint8)
+    rng = np.random.default_rng(1)
+    for label in range(1, labels + 1):
+        center = rng.uniform(-0.5, 0.5, 3)
+        radii = rng.uniform(0.15, 0.4, 3)
+        inside = (((x - center[0]) / radii[0]) ** 2 + ((y - center[1]) / radii[1]) ** 2
+                  + ((z - center[2]) / radii[2]) ** 2) < 1
+        data[inside] = label
+    return np.asfortranarray(data)
+
+
+def noisy_ct(size, seed=0):
+    """
+    int16 CT-like data in Hounsfield units: air (-1000), a soft tissue ellipsoid (~40) and a bone
+    shell (~700), all with Gaussian noise. Binarizing above 0 gives a noisy, fragmented surface.
+    """
+    x, y, z = _grid(size)
+    rng = np.random.default_rng(seed)
+    body = (x / 0.9) ** 2 + (y / 0.7) ** 2 + (z / 0.95) ** 2 < 1
+    bone = (x / 0.5) ** 2 + (y / 0.4) ** 2 + (z / 0.8) ** 2
+    data = np.full(x.shape, -1000.0, dtype=np.float32)
+    data[body] = 40.0
+    data[(bone < 1) & (bone > 0.7)] = 700.0
+    data += rng.normal(0.0, 30.0, data.shape).astype(np.float32)
+    return np.asfortranarray(np.clip(data, -1024, 3071).astype(np.int16))
+
+
+def noisy_field(size, seed=0):
+    """A float32 radial field with Gaussian noise, whose isosurfaces are bumpy spheres."""
+    x, y, z = _grid(size)
+    field = 1.0 - np.sqrt(x * x + y * y + z * z)
+    field += np.random.default_rng(seed).normal(0.0, 0.02, field.shape).astype(np.float32)
+    return np.asfortranarray(field)
+
+
+# Phantoms of the pipeline benchmark: generator and whether it is a label map (multi-label mode).
+PHANTOMS = {
+    "sphere": (sphere_mask, False),
+    "shells": (nested_shells, False),
+    "labels": (multi_label, True),
+    "noisy_ct": (noisy_ct, False),
+}
+
+
+def phantom_affine(spacing=PHANTOM_SPACING):
+    """RAS+ affine with the given spacing, like a NIfTI converted from an axial CT series."""
+    return np.diag(list(spacing) + [1.0])
+
+
+def write_phantom(name, size, path):
+    """Writes the phantom `name` of the given size to `path` (.nii or .nii.gz) and returns the path."""
+    generator, _ = PHANTOMS[name]
+    nib.save(nib.Nifti1Image(generator(size), phantom_affine()), str(path))
+    return path
@@ -1,12 +1,28 @@
+import contextlib
+import io
+import json
 import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from isoto1 import process_nifti
-from niitodicom import fix_nifti_orientation_nibabel, nii_to_dicom
+from isoto1 import (
+    process_nifti, load_processed_volume, load_label_volume, label_statistics, crop_to_foreground, binarize_volume
+)
+from niitodicom import fix_nifti_orientation_nibabel, nii_to_dicom, orthonormalize_affine
 from dicomtomesh import (
-    load_dicom_image, dicom_to_mesh,
-    compute_smoothing_params, smooth_mesh, save_mesh_as_stl
+    load_dicom_image, volume_to_image_data, dicom_to_mesh, slabs_to_mesh, downsample_volume, decimate_mesh,
+    extract_label_meshes, clean_mesh, surface_deviation,
+    compute_smoothing_params, smooth_mesh, SMOOTHING_PARAM_MAX_SAMPLES
 )
-import nibabel as nib
+from memstats import StageMemory
+from phantoms import write_phantom
+from tracing import StageSpans
+from progress_tracker import ProgressTracker
+from mesh_formats import export_mesh, save_quantized_glb, triangles_for_bytes
+from pipeline_options import MESH_FORMATS, DEFAULT_FORMATS, DECIMATION_METHODS
+from volume_io import iter_overlapping_slabs, load_nifti, stored_megabytes
+import numpy as np
 from nibabel.orientations import aff2axcodes
 
 
@@ -15,37 +31,483 @@ def not_affine_aligned(nii_path: str) -> bool:
     Checks if the NIfTI file is in standard RAS+ orientation (canonical).
     Returns True if no reorientation is needed.
     """
-    img = nib.load(nii_path)
-    axcodes = aff2axcodes(img.affine)
-    return axcodes == ("R", "A", "S")
+    img = load_nifti(nii_path)
+    return affine_is_canonical(img.affine)
+
+
+def affine_is_canonical(affine) -> bool:
+    """Same check as `not_affine_aligned`, on an affine that is already in memory."""
+    return aff2axcodes(affine) == ("R", "A", "S")
+
+
+# Level-of-detail pyramid published while the full mesh is still being built:
+# level 0 comes from the subsampled volume, level 1 is the raw mesh with at least this fraction of
+# triangles removed, but always at least LOD_REFINEMENT times finer than level 0.
+LOD_REDUCTION = 0.9
+LOD_REFINEMENT = 4
+# Meshes with fewer triangles than this are fast enough to skip the intermediate level.
+LOD_MIN_TRIANGLES = 100_000
+
+# Voxels of background kept around the foreground bounding box when cropping the volume.
+# At least one is needed so surfaces touching the box are still closed.
+ROI_MARGIN = 2
+
+# Volumes larger than this (in their stored dtype) are meshed out of core, one Z-slab at a time,
+# unless `out_of_core` is given explicitly. Slabs are NIFTI_SLAB_MB large (see volume_io.py).
+OUT_OF_CORE_MIN_MB = int(os.environ.get("OUT_OF_CORE_MIN_MB", 2048))
+# Slabs meshed concurrently in out-of-core mode; each one in flight holds a slab in memory.
+SLAB_WORKERS = int(os.environ.get("SLAB_WORKERS", min(4, os.cpu_count() or 1)))
+
+# Threads smoothing and exporting label meshes in multi-label mode (VTK filters release the GIL).
+LABEL_WORKERS = int(os.environ.get("LABEL_WORKERS", os.cpu_count() or 1))
+# Side (in voxels) of the synthetic sphere meshed by `warm_up`.
+WARM_UP_SIZE = 32
 
+# Triangle and byte budgets never decimate a mesh (or a label's mesh) below this many triangles.
+MIN_TARGET_TRIANGLES = 1000
 
-def full_pipeline(input_nifti_path: str, output_dir="outputs", threshold=1, file_id=None, progress_callback=None) -> str:
+
+def full_pipeline(input_nifti_path: str, output_dir="outputs", threshold=1, file_id=None, progress_callback=None,
+                  export_dicom=False, smoothing_params=None, target_reduction=0.1,
+                  output_formats=DEFAULT_FORMATS, precompress=True, lods=True, multi_label=False,
+                  crop=True, out_of_core=None, target_triangles=None, target_bytes=None,
+                  decimation="quadric") -> dict:
     """
-    Runs the entire NIfTI-to-STL pipeline.
-    Accepts a `progress_callback(step: str, percent: int)` to emit updates.
+    Runs the entire NIfTI-to-mesh pipeline.
+    Accepts a `progress_callback(step: str, percent: int, **extra)` to emit updates. Long stages
+    (meshing, decimation, smoothing, saving) report their own progress in between, and every
+    update carries `eta_s`, the estimated seconds left (None until it can be estimated).
+
+    The volume is handed to VTK straight from memory. With `export_dicom=True` the
+    processed NIfTI and its DICOM series are also written next to the STL
+    (`<file_id>_dicom/`) and the mesh is built from the DICOM series, as before.
+
+    `smoothing_params` may override any of "iterations", "feature_angle" and
+    "relaxation_factor"; the others are still computed from the mesh.
+    `target_reduction` is the fraction of triangles removed by decimation.
+
+    With `target_triangles` and/or `target_bytes` (the size of the largest uncompressed output file,
+    see mesh_formats.triangles_for_bytes), the mesh is instead decimated to that budget before
+    smoothing, with the `decimation` method of dicomtomesh.decimate_mesh, and the sampled distance
+    between the mesh and its decimated version is reported (see dicomtomesh.surface_deviation).
+    Normals are then not split along sharp edges, so that no point is duplicated.
+
+    The mesh is written in every format of `output_formats` (see pipeline_options.MESH_FORMATS),
+    each with gzip/brotli pre-compressed copies unless `precompress` is False.
+
+    With `lods=True`, coarser GLB previews are written first (`<file_id>_lod<level>.glb`) and
+    announced through the progress callback as `lods=[{"level", "triangles", "bytes", "filename"}]`,
+    so a viewer can show something long before the full mesh is ready.
+
+    With `crop=True` the volume is cropped to the voxels at or above `threshold` (plus ROI_MARGIN)
+    before meshing; the crop statistics are reported once as `roi={...}` (see
+    isoto1.crop_to_foreground). Only the in-memory path crops, not `export_dicom`.
+
+    With `out_of_core=True` the volume is never loaded as a whole: Marching Cubes runs on one
+    Z-slab at a time and the pieces are welded (same triangles as the in-memory path). There is
+    no cropping or volume preview in that mode. `out_of_core=None` picks it for volumes above
+    OUT_OF_CORE_MIN_MB.
+
+    Before the coarse level and smoothing, the extracted mesh is welded and stripped of small
+    islands and degenerate triangles (see dicomtomesh.clean_mesh).
+
+    With `multi_label=True` the input is treated as a label map instead: see `label_pipeline`.
+    :return: {"mesh_path": <first format, uncompressed>, "artifacts": [artifact dicts],
+              "lods": [level dicts, each also with its "path"], "roi": crop statistics or None,
+              "cleaning": clean_mesh statistics, "decimation": budget decimation statistics or None,
+              "memory_mb": {step: peak RSS in MB}, "spans": [per-stage spans, see tracing.StageSpans]}
     """
-    def report(step: str, percent: int):
-        if callable(progress_callback):
-            progress_callback(step, percent)
+    _check_options(output_formats, decimation)
+    if multi_label:
+        if export_dicom:
+            raise ValueError("export_dicom is not supported in multi-label mode")
+        return label_pipeline(input_nifti_path, output_dir, file_id, progress_callback, smoothing_params,
+                              target_reduction, output_formats, precompress, crop, target_triangles, target_bytes,
+                              decimation)
 
+    report = _reporter(progress_callback)
     os.makedirs(output_dir, exist_ok=True)
 
     if not file_id:
         from uuid import uuid4
-        file_id = str(uuid4()) 
-
-    input_path = Path(input_nifti_path)
-    #base_name = input_path.stem.replace('.nii', '')
-    base_name = file_id 
-    
-    modified_path = Path(output_dir) / f"{base_name}_processed.nii.gz"
-    fixed_path = Path(output_dir) / f"{base_name}_fixed.nii.gz"
+        file_id = str(uuid4())
+
+    if out_of_core is None:
+        out_of_core = not export_dicom and stored_megabytes(load_nifti(input_nifti_path)) > OUT_OF_CORE_MIN_MB
+
+    mesh, volume, roi = None, None, None
+    if export_dicom:
+        volume = _load_volume_via_dicom(input_nifti_path, output_dir, file_id, report)
+    elif out_of_core:
+        mesh = _mesh_out_of_core(input_nifti_path, threshold, report)
+    else:
+        volume, roi = _load_volume_in_memory(input_nifti_path, report, threshold, crop)
+
+    lod_levels = []
+
+    def publish_lod(lod_mesh, step: str, percent: int):
+        level = len(lod_levels)
+        path = Path(output_dir) / f"{file_id}_lod{level}.glb"
+        save_quantized_glb(lod_mesh, str(path))
+        lod_levels.append({"level": level, "triangles": lod_mesh.GetNumberOfCells(),
+                           "bytes": path.stat().st_size, "filename": path.name, "path": str(path)})
+        report(step, percent, lods=[{k: v for k, v in lod.items() if k != "path"} for lod in lod_levels])
+
+    if lods and volume is not None:
+        preview_volume, factor = downsample_volume(volume)
+        if factor > 1:
+            report("Generating preview", 55)
+            preview = dicom_to_mesh(preview_volume, threshold, progress=report.within("Generating preview", 55, 58))
+            report.annotate(voxels=int(np.prod(preview_volume.GetDimensions())), triangles=preview.GetNumberOfCells())
+            if preview.GetNumberOfCells() > 0:
+                publish_lod(preview, "Preview ready", 58)
+
+    if mesh is None:
+        report("Generating mesh", 60)
+        # smooth_mesh recomputes the normals and the decimated level drops them, so skip them here
+        mesh = dicom_to_mesh(volume, threshold, compute_normals=False,
+                             progress=report.within("Generating mesh", 60, 66))
+    if mesh.GetNumberOfCells() == 0:
+        raise RuntimeError("No mesh could be created. Check threshold.")
+    report.annotate(triangles=mesh.GetNumberOfCells())
+
+    # Islands and slivers are dropped before the coarse level and smoothing spend time on them
+    report("Cleaning mesh", 66)
+    cleaning = clean_mesh(mesh, progress=report.within("Cleaning mesh", 66, 68))
+    triangles = mesh.GetNumberOfCells()
+    report.annotate(triangles=triangles, removed_triangles=cleaning["triangles_before"] - triangles)
+    if lods and triangles >= LOD_MIN_TRIANGLES:
+        coarser = lod_levels[-1]["triangles"] if lod_levels else 0
+        reduction = 1.0 - max(1.0 - LOD_REDUCTION, LOD_REFINEMENT * coarser / triangles)
+        if reduction >= 0.5:  # Otherwise the level would be almost as heavy as the full mesh
+            report("Generating coarse mesh", 68)
+            coarse = decimate_mesh(mesh, reduction, progress=report.within("Generating coarse mesh", 68, 70))
+            publish_lod(coarse, "Coarse mesh ready", 70)
+
+    decimation_stats = None
+    budget = _triangle_budget(mesh, target_triangles, target_bytes, output_formats)
+    if budget is not None:
+        report("Decimating mesh", 70)
+        mesh, decimation_stats = _decimate_to_budget(mesh, budget, decimation,
+                                                     progress=report.within("Decimating mesh", 70, 75))
+        report.annotate(triangles=mesh.GetNumberOfCells())
+        target_reduction = 0  # The budget replaces the fixed reduction of smooth_mesh
+
+    report("Smoothing mesh", 75)
+    # Split normals duplicate the points along creases, which the byte budget does not account for
+    _smooth(mesh, smoothing_params, target_reduction, split_normals=budget is None,
+            progress=report.within("Smoothing mesh", 75, 90))
+    report.annotate(triangles=mesh.GetNumberOfCells())
+
+    report("Saving mesh", 90)
+    artifacts = export_mesh(mesh, output_dir, file_id, output_formats, compress=precompress,
+                            progress=report.within("Saving mesh", 90, 100))
+    report.annotate(output_bytes=sum(artifact["bytes"] for artifact in artifacts))
+
+    report("Completed", 100)
+    return {"mesh_path": artifacts[0]["path"], "artifacts": artifacts, "lods": lod_levels, "roi": roi,
+            "cleaning": cleaning, "decimation": decimation_stats, "memory_mb": report.memory_mb,
+            "spans": report.spans}
+
+
+def label_pipeline(input_nifti_path: str, output_dir="outputs", file_id=None, progress_callback=None,
+                   smoothing_params=None, target_reduction=0.1, output_formats=DEFAULT_FORMATS,
+                   precompress=True, crop=True, target_triangles=None, target_bytes=None, decimation="quadric") -> dict:
+    """
+    Multi-label variant of `full_pipeline`: every non-zero value of the NIfTI is a structure and
+    gets its own mesh. All surfaces are extracted in one pass over the volume (discrete flying
+    edges), then the label meshes are smoothed and exported in parallel on LABEL_WORKERS threads
+    as `<file_id>_label<value>_mesh.<ext>`.
+
+    A manifest (`<file_id>_labels.json`) lists every label with its voxel count, voxel bounding box,
+    world-space mesh bounds (LPS, mm), triangle count and files.
+
+    Triangle and byte budgets apply to all labels together: every label gets the share of its
+    triangles, and its decimation statistics are listed with it.
+    :return: {"mesh_path": <manifest path>, "artifacts": [manifest, then every label artifact],
+              "lods": [], "labels": [manifest entries, artifacts with their "path"], "roi": crop statistics or None, "memory_mb": {step: peak RSS in MB},
+              "spans": [per-stage spans]}
+    """
+    _check_options(output_formats, decimation)
+    report = _reporter(progress_callback)
+    os.makedirs(output_dir, exist_ok=True)
+
+    if not file_id:
+        from uuid import uuid4
+        file_id = str(uuid4())
+
+    report("Preprocessing NIfTI", 10)
+    report.annotate(input_bytes=os.path.getsize(input_nifti_path))
+    data, affine = load_label_volume(str(input_nifti_path))
+    stats = label_statistics(data)
+    if not stats:
+        raise RuntimeError("No labels found. The volume is empty.")
+    print(f"Found {len(stats)} labels")
+    volume, roi = _build_volume(data, affine, report, crop_threshold=1 if crop else None)
+    del data
+
+    report("Generating meshes", 60)
+    meshes = extract_label_meshes(volume, list(stats), progress=report.within("Generating meshes", 60, 65))
+    if not meshes:
+        raise RuntimeError("No mesh could be created for any label.")
+    report.annotate(triangles=sum(mesh.GetNumberOfCells() for mesh in meshes.values()))
+
+    report("Smoothing meshes", 65)
+    # Every label's share of the stage is proportional to its triangles; decimation takes about 1/4 of it,
+    # smoothing 1/2 (3/4 without a budget) and the export the rest.
+    stage_progress = report.within("Smoothing meshes", 65, 90)
+    total_triangles = sum(mesh.GetNumberOfCells() for mesh in meshes.values())
+    label_progress = {label: 0.0 for label in meshes}
+
+    def label_progress_callback(label, offset, share):
+        weight = meshes[label].GetNumberOfCells() / total_triangles
+
+        def progress(fraction):
+            label_progress[label] = weight * (offset + share * fraction)
+            stage_progress(sum(label_progress.values()))
+        return progress
+
+    def process_label(label, mesh):
+        share = mesh.GetNumberOfCells() / total_triangles
+        cleaning = clean_mesh(mesh)
+        decimation_stats, reduction, smoothing_from = None, target_reduction, 0.0
+        budget = _triangle_budget(mesh, target_triangles, target_bytes, output_formats, share)
+        if budget is not None:
+            mesh, decimation_stats = _decimate_to_budget(mesh, budget, decimation,
+                                                         progress=label_progress_callback(label, 0.0, 0.25))
+            reduction, smoothing_from = 0, 0.25
+        _smooth(mesh, smoothing_params, reduction, split_normals=budget is None,
+                progress=label_progress_callback(label, smoothing_from, 0.75 - smoothing_from))
+        artifacts = export_mesh(mesh, output_dir, f"{file_id}_label{label}", output_formats, compress=precompress,
+                                progress=label_progress_callback(label, 0.75, 0.25))
+        return {"label": label, **stats[label], "bounds": list(mesh.GetBounds()),
+                "triangles": mesh.GetNumberOfCells(), "cleaning": cleaning, "decimation": decimation_stats,
+                "artifacts": artifacts}
+
+    entries = []
+    with ThreadPoolExecutor(max_workers=max(1, min(LABEL_WORKERS, len(meshes)))) as executor:
+        futures = [executor.submit(process_label, label, mesh) for label, mesh in meshes.items()]
+        for future in as_completed(futures):
+            entries.append(future.result())
+    entries.sort(key=lambda entry: entry["label"])
+    report.annotate(triangles=sum(entry["triangles"] for entry in entries),
+                    output_bytes=sum(artifact["bytes"] for entry in entries for artifact in entry["artifacts"]))
+
+    report("Saving manifest", 95)
+    manifest_path = Path(output_dir) / f"{file_id}_labels.json"
+    manifest = {"labels": [
+        {**entry, "artifacts": [{**{k: v for k, v in artifact.items() if k != "path"},
+                                 "filename": os.path.basename(artifact["path"])}
+                                for artifact in entry["artifacts"]]}
+        for entry in entries
+    ]}
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    artifacts = [{"format": "json", "encoding": None, "path": str(manifest_path),
+                  "bytes": manifest_path.stat().st_size}]
+    artifacts += [artifact for entry in entries for artifact in entry["artifacts"]]
+
+    report("Completed", 100)
+    return {"mesh_path": str(manifest_path), "artifacts": artifacts, "lods": [], "labels": entries, "roi": roi,
+            "memory_mb": report.memory_mb, "spans": report.spans}
+
+
+def warm_up(size=WARM_UP_SIZE) -> float:
+    """
+    Runs a tiny synthetic sphere through `full_pipeline` (every output format) in a temporary
+    directory and returns the seconds it took. Worker processes call it once when they start (see
+    jobs.py), so a broken imaging stack shows up before the first upload rather than in it.
+    """
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="spartis-warm-up-") as workdir:
+        input_path = os.path.join(workdir, "warm_up.nii")
+        write_phantom("sphere", size, input_path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            full_pipeline(input_path, workdir, file_id="warm_up", lods=False)
+    return time.perf_counter() - started
+
+
+def _check_options(output_formats, decimation):
+    unsupported = [fmt for fmt in output_formats if fmt not in MESH_FORMATS]
+    if unsupported or not output_formats:
+        raise ValueError(f"Unsupported output formats: {unsupported or output_formats}")
+    if decimation not in DECIMATION_METHODS:
+        raise ValueError(f"Unknown decimation method: {decimation}")
+
+
+def _reporter(progress_callback):
+    """
+    Wraps the progress callback. Every step is also a memory stage: updates carry
+    `memory_mb={step: peak RSS in MB}` for the steps finished so far (see memstats).
+
+    Steps are traced as spans too (`report.spans`, see tracing.StageSpans); `report.annotate(...)`
+    adds sizes and counts to the running one. "Completed" ends the last span.
+
+    `report.within(step, start, end)` returns the throttled sub-progress callback of a long stage
+    and updates carry `eta_s` (see progress_tracker.ProgressTracker).
+    """
+    memory = StageMemory()
+    spans = StageSpans()
+
+    def report(step: str, percent: int, **extra):
+        memory.stage(step)
+        spans.stage(None if step == "Completed" else step, memory.peaks)
+        if callable(progress_callback):
+            eta = 0.0 if step == "Completed" else tracker.eta(step, percent)
+            progress_callback(step, percent, memory_mb=dict(memory.peaks), eta_s=eta, **extra)
+
+    tracker = ProgressTracker(report)
+    report.memory_mb = memory.peaks
+    report.spans = spans.spans
+    report.annotate = spans.annotate
+    report.within = tracker.within
+    return report
+
+
+def _triangle_budget(mesh, target_triangles, target_bytes, output_formats, share=1.0):
+    """
+    The triangle count to decimate the mesh to for its `share` of a triangle and/or byte budget
+    (at least MIN_TARGET_TRIANGLES), or None without a budget.
+    """
+    budgets = []
+    if target_triangles:
+        budgets.append(target_triangles * share)
+    if target_bytes:
+        points_per_triangle = mesh.GetNumberOfPoints() / max(mesh.GetNumberOfCells(), 1)
+        budgets.append(triangles_for_bytes(target_bytes * share, output_formats, points_per_triangle))
+    if not budgets:
+        return None
+    return max(MIN_TARGET_TRIANGLES, int(min(budgets)))
+
+
+def _decimate_to_budget(mesh, target_triangles, method, progress=None):
+    """
+    Decimates the mesh to `target_triangles` (see dicomtomesh.decimate_mesh) and measures the
+    distance between both versions (see dicomtomesh.surface_deviation).
+    :return: (decimated mesh, or the mesh itself when it is within the budget, statistics)
+    """
+    triangles = mesh.GetNumberOfCells()
+    stats = {"method": method, "target_triangles": target_triangles, "triangles_before": triangles,
+             "triangles_after": triangles, "seconds": 0.0, "deviation": None}
+    if triangles <= target_triangles:
+        return mesh, stats
+
+    started = time.perf_counter()
+    decimated = decimate_mesh(mesh, 1.0 - target_triangles / triangles, progress=progress, method=method)
+    stats["seconds"] = round(time.perf_counter() - started, 4)
+    stats["triangles_after"] = decimated.GetNumberOfCells()
+    stats["deviation"] = surface_deviation(mesh, decimated)
+    print(f"Decimated mesh from {triangles} to {stats['triangles_after']} triangles ({method}) in "
+          f"{stats['seconds']:.2f}s: Hausdorff {stats['deviation']['hausdorff']:.3f} mm, "
+          f"mean {stats['deviation']['mean']:.3f} mm.")
+    return decimated, stats
+
+
+def _smooth(mesh, smoothing_params, target_reduction, split_normals=True, progress=None):
+    """
+    Smooths the mesh in place with parameters computed from it, overridden by `smoothing_params`
+    (which may also name a preset). Returns the per-stage timings of `smooth_mesh`.
+    """
+    iterations, angle, factor = compute_smoothing_params(mesh, max_samples=SMOOTHING_PARAM_MAX_SAMPLES)
+    overrides = smoothing_params or {}
+    iterations = overrides.get("iterations", iterations)
+    angle = overrides.get("feature_angle", angle)
+    factor = overrides.get("relaxation_factor", factor)
+    return smooth_mesh(mesh, iterations, angle, factor, target_reduction=target_reduction,
+                       preset=overrides.get("preset"), split_normals=split_normals, progress=progress)
+
+
+def _load_volume_in_memory(input_nifti_path: str, report, threshold, crop=True):
+    """
+    Preprocesses the NIfTI and wraps it in a vtkImageData without touching the disk.
+    :return: (vtkImageData, crop statistics or None)
+    """
+    report("Preprocessing NIfTI", 10)
+    report.annotate(input_bytes=os.path.getsize(input_nifti_path))
+    # At iso value 1 a uint8 mask gives exactly the same surface as the binarized volume.
+    data, affine = load_processed_volume(str(input_nifti_path), as_mask=threshold == 1)
+    return _build_volume(data, affine, report, threshold if crop else None)
+
+
+def _build_volume(data, affine, report, crop_threshold=None):
+    """
+    Applies the orientation fix to the affine, optionally crops to the voxels at or above
+    `crop_threshold`, and wraps the voxels in a vtkImageData.
+    :return: (vtkImageData, crop statistics or None)
+    """
+    report("Checking orientation", 20)
+    if affine_is_canonical(affine):
+        report("Fixing orientation", 30)
+        affine = orthonormalize_affine(affine)
+    else:
+        report("Orientation already correct", 30)
+
+    if data.ndim < 3 or data.shape[2] < 2:
+        raise RuntimeError("Only one slice in Z dimension. Mesh generation will fail.")
+
+    roi = None
+    if crop_threshold is not None:
+        # Cropped after the orientation fix, so the origin shift uses the affine the mesh is built with.
+        data, affine, roi = crop_to_foreground(data, affine, crop_threshold, margin=ROI_MARGIN)
+        if roi is not None:
+            print(f"Cropped volume to {roi['crop_fraction']:.1%} of its voxels "
+                  f"(sparsity {roi['sparsity']:.1%}, {roi['bytes_saved'] / 1e6:.1f} MB saved)")
+            report("Cropping volume", 40, roi=roi)
+
+    report("Building volume", 50)
+    report.annotate(voxels=int(data.size), output_bytes=int(data.nbytes))
+    return volume_to_image_data(data, affine), roi
+
+
+def _mesh_out_of_core(input_nifti_path: str, threshold, report):
+    """
+    Builds the raw mesh without holding the volume in memory: slabs are streamed from the NIfTI,
+    preprocessed like `load_processed_volume` and meshed by `slabs_to_mesh`.
+    """
+    report("Preprocessing NIfTI", 10)
+    report.annotate(input_bytes=os.path.getsize(input_nifti_path))
+    img = load_nifti(input_nifti_path)
+    if len(img.shape) < 3 or img.shape[2] < 2:
+        raise RuntimeError("Only one slice in Z dimension. Mesh generation will fail.")
+    print(f"Meshing {stored_megabytes(img):.0f} MB volume out of core")
+
+    report("Checking orientation", 20)
+    affine = img.affine
+    if affine_is_canonical(affine):
+        report("Fixing orientation", 30)
+        affine = orthonormalize_affine(affine)
+    else:
+        report("Orientation already correct", 30)
+
+    def preprocessed_slabs():
+        for start, slab in iter_overlapping_slabs(img):
+            if threshold == 1:
+                yield start, np.greater(slab, 0).view(np.uint8)  # Same surface as the binarized slab
+            else:
+                yield start, binarize_volume(slab, in_place=True)
+
+    report("Generating mesh", 50)
+    depth = img.shape[2]
+    progress = report.within("Generating mesh", 50, 66)
+    return slabs_to_mesh(preprocessed_slabs(), affine, threshold, workers=SLAB_WORKERS,
+                         progress=lambda end: progress(end / depth))
+
+
+def _load_volume_via_dicom(input_nifti_path: str, output_dir, base_name: str, report):
+    """
+    The original file-based path: processed NIfTI -> DICOM series -> vtkDICOMImageReader.
+    Kept for when the DICOM series is wanted as an artifact.
+    """
+    # Intermediates are written uncompressed: they are read back right away and never served.
+    modified_path = Path(output_dir) / f"{base_name}_processed.nii"
+    fixed_path = Path(output_dir) / f"{base_name}_fixed.nii"
     dicom_dir = Path(output_dir) / f"{base_name}_dicom"
-    stl_path = Path(output_dir) / f"{base_name}_mesh.stl"
 
     report("Preprocessing NIfTI", 10)
-    process_nifti(str(input_path), str(modified_path))
+    report.annotate(input_bytes=os.path.getsize(input_nifti_path))
+    process_nifti(str(input_nifti_path), str(modified_path))
+    report.annotate(output_bytes=modified_path.stat().st_size)
 
     report("Checking orientation", 20)
     if not_affine_aligned(str(modified_path)):
@@ -55,26 +517,15 @@ def full_pipeline(input_nifti_path: str, output_dir="outputs", threshold=1, file
     else:
         report("Orientation already correct", 30)
         nii_path_to_use = str(modified_path)
-        
+
     report("Converting to DICOM", 40)
-    nii_to_dicom(nii_path_to_use, str(dicom_dir))
+    dicom_stats = nii_to_dicom(nii_path_to_use, str(dicom_dir))
+    if dicom_stats is None:
+        raise RuntimeError("Only one slice in Z dimension. A mesh needs at least two.")
+    report.annotate(output_bytes=dicom_stats["bytes"])
 
-    report("Loading DICOM volume", 50)
+    report("Loading DICOM volume", 50, dicom=dicom_stats)
     volume = load_dicom_image(str(dicom_dir))
     if not volume:
         raise RuntimeError("Failed to load DICOM volume")
-
-    report("Generating mesh", 60)
-    mesh = dicom_to_mesh(volume, threshold)
-    if mesh.GetNumberOfCells() == 0:
-        raise RuntimeError("No mesh could be created. Check threshold.")
-
-    report("Smoothing mesh", 75)
-    iterations, angle, factor = compute_smoothing_params(mesh)
-    smooth_mesh(mesh, iterations, angle, factor)
-
-    report("Saving STL", 90)
-    save_mesh_as_stl(mesh, str(stl_path))
-
-    report("Completed", 100)
-    return str(stl_path)
+    return volume
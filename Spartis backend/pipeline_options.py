@@ -0,0 +1,22 @@
+"""
+Choices of the pipeline parameters that the API and batch.py validate before a job is queued.
+They live here rather than in mesh_formats/dicomtomesh so that checking a request does not import
+VTK: the API process leaves the imaging stack to the worker processes (see jobs.py).
+"""
+
+# Output formats of mesh_formats.export_mesh and their file extensions.
+MESH_FORMATS = {
+    "stl": ".stl",  # Binary STL, one triangle per record (vertices repeated)
+    "ply": ".ply",  # Binary little-endian PLY with an indexed vertex list
+    "glb": ".glb",  # glTF binary with quantized positions/normals (KHR_mesh_quantization)
+}
+DEFAULT_FORMATS = ("stl", "ply", "glb")
+
+# Smoothing presets of dicomtomesh.smooth_mesh: "quality" runs a Laplacian and a windowed sinc pass,
+# "fast" only the windowed sinc pass (half the passes, far less shrinkage per pass).
+SMOOTHING_PRESETS = ("quality", "fast")
+
+# Decimation backends of dicomtomesh.decimate_mesh, used to bring a mesh down to a triangle or byte
+# budget: "quadric" collapses edges by quadric error (vtkQuadricDecimation), "clustering" merges the
+# points of every cell of a grid in one pass (vtkQuadricClustering): 15-50x faster, less faithful.
+DECIMATION_METHODS = ("quadric", "clustering")
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import os
+import time
+from typing import Any, AsyncIterator, Dict, Optional, Set
+
+from kv_helpers import PROGRESS_CHANNEL_PREFIX, add_progress_listener, get_progress_from_kv, progress_pubsub
+
+# Each streaming client receives at most this many progress updates per second; intermediate
+# updates are coalesced into the latest one.
+PROGRESS_STREAM_MAX_RATE = float(os.environ.get("PROGRESS_STREAM_MAX_RATE", 4))
+# An SSE comment is sent after this many seconds without an update, so proxies keep the stream open.
+PROGRESS_STREAM_KEEPALIVE = float(os.environ.get("PROGRESS_STREAM_KEEPALIVE", 15))
+
+# Steps after which a job's progress does not change any more; streams end after sending them.
+TERMINAL_STEPS = ("Completed", "Error", "Cancelled")
+
+
+def is_terminal(data: Optional[Dict[str, Any]]) -> bool:
+    return bool(data) and data.get("step") in TERMINAL_STEPS
+
+
+class _Subscription:
+    """The latest undelivered update of one client. Newer updates replace older ones."""
+
+    def __init__(self):
+        self.latest: Optional[Dict[str, Any]] = None
+        self.changed = asyncio.Event()
+
+    def offer(self, data: Dict[str, Any]):
+        # A terminal update is never replaced by a late intermediate one.
+        if not is_terminal(self.latest):
+            self.latest = data
+            self.changed.set()
+
+    def take(self) -> Optional[Dict[str, Any]]:
+        data, self.latest = self.latest, None
+        self.changed.clear()
+        return data
+
+
+class ProgressBroker:
+    """
+    Fans progress updates out to streaming clients (SSE and WebSocket).
+
+    With KV configured, `set_progress` publishes every update on the Redis channel
+    `progress:<file_id>` and the broker holds a single pattern subscription for all of them, so
+    updates reach clients connected to any API instance. Without KV, the broker registers itself
+    as a listener of `set_progress` and relays updates within this process.
+
+    Clients get the current progress first, then at most `max_rate` updates per second (the most
+    recent one wins), and the stream ends after a terminal step.
+    """
+
+    def __init__(self, max_rate: float = PROGRESS_STREAM_MAX_RATE):
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self._subscriptions: Dict[str, Set[_Subscription]] = {}
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._pubsub = progress_pubsub()
+        if self._pubsub is None:
+            add_progress_listener(self.dispatch)
+            print("✅ Progress streaming uses the in-process broker")
+            return
+        await self._pubsub.psubscribe(f"{PROGRESS_CHANNEL_PREFIX}*")
+        self._listener = asyncio.create_task(self._listen())
+        print("✅ Progress streaming subscribed to Redis pub/sub")
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+
+    async def _listen(self):
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    if message.get("type") != "pmessage":
+                        continue
+                    file_id = message["channel"][len(PROGRESS_CHANNEL_PREFIX):]
+                    self.dispatch(file_id, json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Progress pub/sub connection failed, reconnecting: {e}")
+                await asyncio.sleep(1)
+
+    def dispatch(self, file_id: str, data: Dict[str, Any]):
+        for subscription in self._subscriptions.get(file_id, ()):
+            subscription.offer(data)
+
+    async def subscribe(self, file_id: str, keepalive: Optional[float] = None) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """
+        Yields the progress of a job as it changes, rate limited, until a terminal step.
+        When `keepalive` is given, None is yielded after that many idle seconds.
+        """
+        subscription = _Subscription()
+        self._subscriptions.setdefault(file_id, set()).add(subscription)
+        try:
+            # Registered before reading the current state, so no update can fall in between.
+            current = await get_progress_from_kv(file_id)
+            if current is not None and subscription.latest is None:
+                subscription.offer(current)
+            last_sent = 0.0
+            while True:
+                try:
+                    await asyncio.wait_for(subscription.changed.wait(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                delay = last_sent + self.min_interval - time.monotonic()
+                if delay > 0 and not is_terminal(subscription.latest):
+                    await asyncio.sleep(delay)  # Updates arriving meanwhile replace the pending one
+                data = subscription.take()
+                if data is None:
+                    continue
+                last_sent = time.monotonic()
+                yield data
+                if is_terminal(data):
+                    return
+        finally:
+            subscribers = self._subscriptions.get(file_id)
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscriptions[file_id]
+
+    @property
+    def subscriber_count(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscriptions.values())
@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+# Sub-progress of long stages (VTK ProgressEvents, exported files) is forwarded at most this often
+# (in seconds) and only when the integer percentage changes, so the progress store is not flooded.
+PROGRESS_MIN_INTERVAL = float(os.environ.get("PROGRESS_MIN_INTERVAL", 0.5))
+# No ETA is given before the running stage has reached this fraction or the run this age (too noisy).
+ETA_MIN_FRACTION = 0.02
+ETA_MIN_ELAPSED = 1.0
+
+
+class ProgressTracker:
+    """
+    Sub-progress and remaining time of one pipeline run.
+
+    `within(step, start, end)` returns a `progress(fraction)` callback that maps the running
+    stage's own progress (0 to 1) onto the percentages `start` to `end` and forwards it as
+    `report(step, percent)`, throttled by `min_interval`. It may be called from several threads.
+
+    `eta(step, percent)` estimates the seconds left: the rest of a stage with sub-progress from its
+    measured throughput, the stages after it from the throughput of the run before it. Without
+    sub-progress, the whole remainder is estimated from the throughput of the run so far.
+    """
+
+    def __init__(self, report: Callable[[str, int], None], min_interval: float = PROGRESS_MIN_INTERVAL):
+        self.report = report
+        self.min_interval = min_interval
+        self.started = time.perf_counter()
+        self._stage: Optional[dict] = None
+        self._lock = threading.Lock()
+
+    def within(self, step: str, start: int, end: int) -> Callable[[float], None]:
+        now = time.perf_counter()
+        stage = {"step": step, "start": start, "end": end, "started": now, "fraction": 0.0,
+                 "percent": start, "reported_at": now}
+        self._stage = stage
+
+        def progress(fraction: float):
+            fraction = min(max(fraction, 0.0), 1.0)
+            percent = start + int((end - start) * fraction)
+            with self._lock:
+                stage["fraction"] = max(stage["fraction"], fraction)
+                now = time.perf_counter()
+                if percent <= stage["percent"] or now - stage["reported_at"] < self.min_interval:
+                    return
+                stage["percent"], stage["reported_at"] = percent, now
+                self.report(step, percent)
+
+        return progress
+
+    def eta(self, step: str, percent: int) -> Optional[float]:
+        now = time.perf_counter()
+        stage = self._stage
+        if stage is not None and stage["step"] != step:
+            self._stage = stage = None  # The stage with sub-progress has ended
+        if stage is None:
+            elapsed = now - self.started
+            if percent <= 0 or elapsed < ETA_MIN_ELAPSED:
+                return None
+            return round(elapsed * (100 - percent) / percent, 1)
+
+        fraction, before = stage["fraction"], stage["started"] - self.started
+        if fraction < ETA_MIN_FRACTION or stage["start"] <= 0:
+            return None
+        remaining = (now - stage["started"]) * (1 - fraction) / fraction
+        remaining += before * (100 - stage["end"]) / stage["start"]
+        return round(remaining, 1)
@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+# Bump whenever a pipeline change makes previously cached meshes stale.
+CACHE_VERSION = 3
+# Size cap of the local cache. Least recently used entries are evicted beyond it.
+RESULT_CACHE_MAX_MB = int(os.environ.get("RESULT_CACHE_MAX_MB", 2048))
+
+
+def cache_key(content_hash: str, params: Dict[str, Any]) -> str:
+    """
+    Builds the cache key of a pipeline run from the SHA-256 of the uploaded file and the
+    parameters the pipeline is run with. Parameter order does not matter.
+    """
+    payload = json.dumps({"version": CACHE_VERSION, "input": content_hash, "params": params},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed store of finished pipeline results.
+
+    Each entry keeps the completion payload that was sent to the client (blob URL, filename, ...)
+    and owns the generated files, which are moved under `<root>/<key>/` (see `find_file`).
+    Entries and their files are evicted least recently used first once the files exceed
+    `max_bytes`. When `remote_lookup(key)` is given it is awaited on a local miss, so results
+    published to blob storage by other instances are found too.
+
+    It also coalesces identical uploads that arrive while the first one is still running:
+    the first upload becomes the leader and later ones are attached to it as followers.
+    """
+
+    def __init__(self, root, max_bytes: int = RESULT_CACHE_MAX_MB * 1024 * 1024,
+                 remote_lookup: Optional[Callable[[str], Awaitable[Optional[Dict[str, Any]]]]] = None):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.remote_lookup = remote_lookup
+        self.index_path = self.root / "index.json"
+        os.makedirs(self.root, exist_ok=True)
+        self._index: Dict[str, Dict[str, Any]] = self._load_index()
+        # File name -> cache key. Output names start with the job's file id, so they are unique.
+        self._keys_by_filename: Dict[str, str] = {
+            os.path.basename(path): key for key, entry in self._index.items() for path in entry["files"]}
+        self._inflight: Dict[str, List[str]] = {}
+        self._leader_keys: Dict[str, str] = {}
+
+    # --- Lookup / store ---
+    async def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._index.get(key)
+        if entry is not None:
+            if all(os.path.isfile(path) for path in entry["files"]):
+                entry["last_used"] = time.time()
+                self._save_index()
+                return entry["payload"]
+            self._evict(key)
+            self._save_index()
+
+        if self.remote_lookup is not None:
+            try:
+                return await self.remote_lookup(key)
+            except Exception as e:
+                print(f"⚠️ Remote cache lookup failed for {key}: {e}")
+        return None
+
+    async def store(self, key: str, payload: Dict[str, Any], files: Iterable[str]):
+        """
+        Records a finished result. `files` are moved into the cache directory, so evicting the
+        entry frees their space; find them again with `find_file`.
+        """
+        entry_dir = self.root / key
+        os.makedirs(entry_dir, exist_ok=True)
+        cached_files, size = [], 0
+        for path in files:
+            target = entry_dir / os.path.basename(path)
+            try:
+                os.replace(path, target)
+            except OSError:  # Another file system: copy off the event loop
+                await asyncio.to_thread(shutil.move, path, target)
+            cached_files.append(str(target))
+            size += target.stat().st_size
+            self._keys_by_filename[target.name] = key
+
+        self._index[key] = {"payload": payload, "files": cached_files, "bytes": size, "last_used": time.time()}
+        self._enforce_size_cap()
+        self._save_index()
+
+    def find_file(self, filename: str) -> Optional[str]:
+        """The path of an output file owned by a cache entry, or None."""
+        key = self._keys_by_filename.get(filename)
+        path = self.root / key / filename if key else None
+        return str(path) if path is not None and path.is_file() else None
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(entry["bytes"] for entry in self._index.values())
+
+    # --- Coalescing of identical uploads ---
+    def join(self, key: str, file_id: str) -> bool:
+        """
+        Registers `file_id` for `key`. Returns True if it is the leader and should run the
+        pipeline, or False if an identical upload is already running and it has to wait on it.
+        """
+        waiting = self._inflight.get(key)
+        if waiting is None:
+            self._inflight[key] = [file_id]
+            self._leader_keys[file_id] = key
+            return True
+        waiting.append(file_id)
+        return False
+
+    def followers(self, leader_id: str) -> List[str]:
+        key = self._leader_keys.get(leader_id)
+        return list(self._inflight.get(key, [])[1:]) if key else []
+
+    def release(self, key: str) -> List[str]:
+        """Ends the in-flight run of `key` and returns the followers that were waiting on it."""
+        waiting = self._inflight.pop(key, [])
+        if waiting:
+            self._leader_keys.pop(waiting[0], None)
+        return waiting[1:]
+
+    # --- Internals ---
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _enforce_size_cap(self):
+        total = self.total_bytes
+        for key in sorted(self._index, key=lambda k: self._index[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= self._index[key]["bytes"]
+            self._evict(key)
+
+    def _evict(self, key: str):
+        entry = self._index.pop(key, None)
+        for path in entry["files"] if entry else []:
+            if self._keys_by_filename.get(os.path.basename(path)) == key:
+                del self._keys_by_filename[os.path.basename(path)]
+        shutil.rmtree(self.root / key, ignore_errors=True)
+        print(f"Evicted cached result {key}")
@@ -0,0 +1,178 @@
+import json
+import os
+from typing import Any, Callable, Dict
+
+try:
+    import prometheus_client  # Optional: /metrics is only served when it is installed
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+# Spans of finished jobs are exported over OTLP when this (standard OpenTelemetry) variable is set
+# and the opentelemetry-sdk and opentelemetry-exporter-otlp packages are installed.
+OTEL_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+# Print one JSON line per pipeline stage of every finished job.
+SPAN_LOG = os.environ.get("SPAN_LOG", "1") == "1"
+
+# Histogram buckets. Durations in seconds, sizes in bytes, meshes in triangles.
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+MEMORY_BUCKETS = tuple(2 ** power * 1024 * 1024 for power in range(5, 16))  # 32 MB to 32 GB
+SIZE_BUCKETS = tuple(4 ** power * 1024 for power in range(0, 12))  # 1 KB to 4 GB
+TRIANGLE_BUCKETS = tuple(10 ** power for power in range(3, 9))
+
+
+class _StateCollector:
+    """Gauges read at scrape time from the callbacks given to `PipelineTelemetry.bind`."""
+
+    def __init__(self, telemetry: "PipelineTelemetry"):
+        self.telemetry = telemetry
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        sources = self.telemetry.sources
+        if "queue_depth" in sources:
+            yield GaugeMetricFamily("spartis_queue_depth", "Jobs waiting for a pipeline worker",
+                                    value=sources["queue_depth"]())
+        if "active_jobs" in sources:
+            yield GaugeMetricFamily("spartis_active_jobs", "Jobs running in pipeline workers",
+                                    value=sources["active_jobs"]())
+        if "stalled_jobs" in sources:
+            yield GaugeMetricFamily("spartis_stalled_jobs", "Running jobs whose progress has stalled",
+                                    value=sources["stalled_jobs"]())
+        if "blob" in sources:
+            blob = sources["blob"]()
+            throughput = GaugeMetricFamily("spartis_blob_upload_bytes_per_second",
+                                           "Blob upload throughput", labels=["window"])
+            throughput.add_metric(["mean"], blob.get("mean_bytes_per_s", 0.0))
+            throughput.add_metric(["last"], blob.get("last_bytes_per_s", 0.0))
+            yield throughput
+            yield GaugeMetricFamily("spartis_blob_upload_latency_seconds", "Mean blob upload latency",
+                                    value=blob.get("mean_latency_s", 0.0))
+            yield GaugeMetricFamily("spartis_blob_upload_failures", "Failed blob uploads",
+                                    value=blob.get("failures", 0))
+        if "kv" in sources:
+            operations = sources["kv"]().get("operations", {})
+            latency = GaugeMetricFamily("spartis_kv_latency_seconds", "Progress store latency per operation",
+                                        labels=["operation", "statistic"])
+            for operation, stats in operations.items():
+                latency.add_metric([operation, "mean"], stats["mean_latency_s"])
+                latency.add_metric([operation, "max"], stats["max_latency_s"])
+            yield latency
+
+
+class PipelineTelemetry:
+    """
+    Metrics and traces of the pipeline, fed by the spans that `full_pipeline` returns with every
+    job (see tracing.py) and by gauges read from the scheduler, blob storage and progress store.
+
+    Stage spans become Prometheus histograms labelled by stage (duration, peak RSS, input/output
+    bytes, triangles) and, when configured, OpenTelemetry spans under one "pipeline" span per job.
+    Without prometheus_client, `render` returns None and only the span log and traces remain.
+    """
+
+    def __init__(self, registry=None, tracer=None):
+        self.sources: Dict[str, Callable[[], Any]] = {}
+        self.tracer = tracer if tracer is not None else _otlp_tracer()
+        self.registry = None
+        if prometheus_client is None:
+            return
+        self.registry = registry if registry is not None else prometheus_client.CollectorRegistry()
+        histogram = prometheus_client.Histogram
+        self.job_duration = histogram("spartis_job_duration_seconds", "Pipeline job duration", ["status"],
+                                      buckets=DURATION_BUCKETS, registry=self.registry)
+        self.stage_duration = histogram("spartis_stage_duration_seconds", "Pipeline stage duration", ["stage"],
+                                        buckets=DURATION_BUCKETS, registry=self.registry)
+        self.stage_memory = histogram("spartis_stage_peak_rss_bytes", "Peak resident memory of a pipeline stage",
+                                      ["stage"], buckets=MEMORY_BUCKETS, registry=self.registry)
+        # Histograms of the span attributes of the same name
+        self.stage_values = {
+            "input_bytes": histogram("spartis_stage_input_bytes", "Bytes read by a pipeline stage", ["stage"],
+                                     buckets=SIZE_BUCKETS, registry=self.registry),
+            "output_bytes": histogram("spartis_stage_output_bytes", "Bytes written by a pipeline stage", ["stage"],
+                                      buckets=SIZE_BUCKETS, registry=self.registry),
+            "triangles": histogram("spartis_stage_triangles", "Triangles produced by a pipeline stage", ["stage"],
+                                   buckets=TRIANGLE_BUCKETS, registry=self.registry),
+        }
+        self.registry.register(_StateCollector(self))
+
+    @property
+    def enabled(self) -> bool:
+        return self.registry is not None
+
+    def bind(self, **sources: Callable[[], Any]):
+        """
+        Registers gauge sources: `queue_depth`, `active_jobs` and `stalled_jobs` (numbers), `blob` (a
+        TransferMetrics snapshot) and `kv` (a ProgressStore snapshot).
+        """
+        self.sources.update(sources)
+
+    def record_job(self, job):
+        """Records a finished scheduler job: its duration and, when it completed, its stage spans."""
+        spans = job.result.get("spans", []) if isinstance(job.result, dict) else []
+        if self.enabled and job.started_at and job.finished_at:
+            self.job_duration.labels(job.status).observe(job.finished_at - job.started_at)
+        for span in spans:
+            if SPAN_LOG:
+                print(f"span {json.dumps({'job_id': job.file_id, **span}, separators=(',', ':'))}")
+            if not self.enabled:
+                continue
+            stage = span["stage"]
+            self.stage_duration.labels(stage).observe(span["duration_s"])
+            if "peak_rss_mb" in span:
+                self.stage_memory.labels(stage).observe(span["peak_rss_mb"] * 1024 * 1024)
+            for attribute, metric in self.stage_values.items():
+                if attribute in span:
+                    metric.labels(stage).observe(span[attribute])
+        if self.tracer is not None and spans:
+            self._export_trace(job, spans)
+
+    def render(self):
+        """(body, content type) of the Prometheus exposition, or None without prometheus_client."""
+        if not self.enabled:
+            return None
+        return prometheus_client.generate_latest(self.registry), prometheus_client.CONTENT_TYPE_LATEST
+
+    def _export_trace(self, job, spans):
+        from opentelemetry import trace
+
+        first, last = spans[0], spans[-1]
+        root = self.tracer.start_span("pipeline", start_time=_ns(first["start"]),
+                                      attributes={"job.id": job.file_id, "job.status": job.status})
+        try:
+            context = trace.set_span_in_context(root)
+            for span in spans:
+                attributes = {"job.id": job.file_id, "stage": span["stage"]}
+                attributes.update({key: value for key, value in span.items()
+                                   if key not in ("stage", "start") and isinstance(value, (int, float, str, bool))})
+                child = self.tracer.start_span(span["stage"], context=context, start_time=_ns(span["start"]),
+                                               attributes=attributes)
+                child.end(end_time=_ns(span["start"] + span["duration_s"]))
+        finally:
+            root.end(end_time=_ns(last["start"] + last["duration_s"]))
+
+
+def _ns(seconds: float) -> int:
+    return int(seconds * 1e9)
+
+
+def _otlp_tracer():
+    """An OpenTelemetry tracer exporting to OTEL_EXPORTER_OTLP_ENDPOINT, or None when not configured."""
+    if not OTEL_ENDPOINT:
+        return None
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+    except ImportError as e:
+        print(f"⚠️ OTEL_EXPORTER_OTLP_ENDPOINT is set but OpenTelemetry is not installed: {e}")
+        return None
+    provider = TracerProvider(resource=Resource.create({"service.name": "spartis-backend"}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    print(f"✅ Exporting pipeline traces to {OTEL_ENDPOINT}")
+    return provider.get_tracer("spartis.pipeline")
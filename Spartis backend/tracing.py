@@ -0,0 +1,36 @@
+import time
+from typing import Any, Dict, List, Optional
+
+# Per-stage spans of a pipeline run. They are plain dicts so they can travel from the worker
+# process back to the API with the job result, where telemetry.py turns them into metrics.
+
+
+class StageSpans:
+    """
+    Records consecutive stages as spans: `stage(name)` closes the running span and opens `name`
+    (calling it again with the running stage's name only continues it). Closed spans are in `spans`:
+    {"stage", "start" (epoch seconds), "duration_s", "peak_rss_mb", plus any annotated attributes}.
+    """
+
+    def __init__(self):
+        self.spans: List[Dict[str, Any]] = []
+        self._current: Optional[Dict[str, Any]] = None
+        self._started = 0.0
+
+    def stage(self, name: Optional[str], peaks: Optional[Dict[str, float]] = None):
+        if self._current is not None:
+            if name == self._current["stage"]:
+                return
+            self._current["duration_s"] = round(time.perf_counter() - self._started, 4)
+            if peaks and self._current["stage"] in peaks:
+                self._current["peak_rss_mb"] = peaks[self._current["stage"]]
+            self.spans.append(self._current)
+            self._current = None
+        if name is not None:
+            self._current = {"stage": name, "start": time.time()}
+            self._started = time.perf_counter()
+
+    def annotate(self, **attributes):
+        """Adds attributes (e.g. input_bytes, output_bytes, voxels, triangles) to the running span."""
+        if self._current is not None:
+            self._current.update(attributes)
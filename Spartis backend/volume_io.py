@@ -0,0 +1,329 @@
+import gzip
+import hashlib
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import nibabel as nib
+import numpy as np
+from nibabel.openers import ImageOpener
+
+try:
+    from isal import igzip, igzip_threaded  # Optional: ISA-L inflates gzip 2-3x faster than zlib
+except ImportError:
+    igzip = igzip_threaded = None
+
+# Voxel data is streamed through memory in slabs of whole slices of roughly this size.
+NIFTI_SLAB_MB = int(os.environ.get("NIFTI_SLAB_MB", 64))
+
+# Compressed volumes are inflated once into raw .nii files here, which are then memory-mapped by
+# every later reader. Least recently used files are evicted beyond NIFTI_CACHE_MAX_MB (0 disables
+# the cache, so .nii.gz files are decompressed by every reader again).
+NIFTI_CACHE_DIR = os.environ.get("NIFTI_CACHE_DIR", os.path.join(tempfile.gettempdir(), "spartis-nifti-cache"))
+NIFTI_CACHE_MAX_MB = int(os.environ.get("NIFTI_CACHE_MAX_MB", 4096))
+# Threads inflating BGZF blocks (and the pigz / ISA-L reader thread count).
+DECOMPRESS_THREADS = int(os.environ.get("DECOMPRESS_THREADS", os.cpu_count() or 1))
+
+_COPY_BUFFER = 16 * 1024 * 1024
+_BGZF_BATCH = 256  # BGZF blocks (at most 64 KB each) inflated per batch
+
+
+def load_nifti(path, mmap=True):
+    """
+    Opens a NIfTI image for reading. Compressed files are read from their raw copy in the volume
+    cache (see `cached_path`), so the voxels are memory-mapped instead of decompressed again.
+    This is the loader every module should use instead of `nib.load`.
+    """
+    return nib.load(cached_path(path), mmap=mmap)
+
+
+def cached_path(path) -> str:
+    """
+    Path of an uncompressed copy of a NIfTI file: the file itself unless it is gzip-compressed,
+    otherwise its entry in NIFTI_CACHE_DIR, inflated on first use (see `inflate`). Entries are
+    keyed by the source's path, size and modification time.
+    """
+    path = os.fspath(path)
+    if not path.endswith(".gz") or NIFTI_CACHE_MAX_MB <= 0:
+        return path
+    target = _cache_entry(path)
+    try:
+        os.utime(target)  # Marks the entry as recently used
+        return target
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(NIFTI_CACHE_DIR, exist_ok=True)
+    partial = f"{target}.{os.getpid()}.partial"
+    try:
+        method = inflate(path, partial)
+        os.replace(partial, target)  # Atomic, so concurrent readers never see a partial file
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    print(f"Inflated {os.path.basename(path)} into the volume cache ({method}, "
+          f"{os.path.getsize(target) / 1e6:.0f} MB)")
+    _evict_cache(keep=target)
+    return target
+
+
+def discard_cached(path):
+    """Removes the cache entry of a compressed file (e.g. an upload that has been processed), if any."""
+    path = os.fspath(path)
+    if path.endswith(".gz") and os.path.exists(path):
+        try:
+            os.remove(_cache_entry(path))
+        except OSError:
+            pass
+
+
+def _cache_entry(path) -> str:
+    stat = os.stat(path)
+    key = hashlib.sha1(f"{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+    return os.path.join(NIFTI_CACHE_DIR, f"{key}.nii")
+
+
+def inflate(path, output_path, threads=DECOMPRESS_THREADS) -> str:
+    """
+    Decompresses a gzip file with the fastest method available and returns its name:
+    BGZF files (blocked gzip, as written by bgzip) are inflated block-parallel on `threads`
+    threads; other gzip streams have to be inflated sequentially, by ISA-L (python-isal) or
+    pigz when installed (pigz reads, inflates and checksums on separate threads), else by zlib.
+    """
+    blocks = _bgzf_blocks(path)
+    if blocks and threads > 1:
+        _inflate_bgzf(path, output_path, blocks, threads)
+        return f"bgzf, {threads} threads"
+    if igzip is not None:
+        # With spare cores, a reader thread inflates ahead while this one writes
+        src = igzip_threaded.open(path, "rb", threads=1) if threads > 1 else igzip.open(path, "rb")
+        with src, open(output_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, _COPY_BUFFER)
+        return "isal"
+    pigz = shutil.which("pigz")
+    if pigz is not None:
+        with open(output_path, "wb") as dst:
+            subprocess.run([pigz, "-dc", "-p", str(max(1, threads)), path], stdout=dst, check=True)
+        return "pigz"
+    with gzip.open(path, "rb") as src, open(output_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, _COPY_BUFFER)
+    return "zlib"
+
+
+def _bgzf_blocks(path) -> Optional[List[Tuple[int, int]]]:
+    """
+    (offset, size) of every gzip member of a BGZF file, read from the "BC" extra field each
+    member carries, or None when the file is not BGZF.
+    """
+    blocks = []
+    with open(path, "rb") as f:
+        offset = 0
+        while True:
+            header = f.read(18)
+            if not header:
+                return blocks or None
+            if len(header) < 18 or header[:4] != b"\x1f\x8b\x08\x04" or header[12:16] != b"BC\x02\x00":
+                return None
+            size = struct.unpack("<H", header[16:18])[0] + 1
+            blocks.append((offset, size))
+            offset += size
+            f.seek(offset)
+
+
+def _inflate_bgzf(path, output_path, blocks, threads):
+    """Inflates BGZF members in parallel (zlib releases the GIL) and writes them in order."""
+    def inflate_block(block: bytes) -> bytes:
+        xlen = struct.unpack("<H", block[10:12])[0]
+        data = zlib.decompress(block[12 + xlen:-8], wbits=-15)
+        crc, size = struct.unpack("<II", block[-8:])
+        if len(data) != size or zlib.crc32(data) != crc:
+            raise ValueError(f"{path} is corrupt: BGZF block checksum mismatch")
+        return data
+
+    with open(path, "rb") as src, open(output_path, "wb") as dst, ThreadPoolExecutor(threads) as executor:
+        for first in range(0, len(blocks), _BGZF_BATCH):
+            batch = blocks[first:first + _BGZF_BATCH]
+            src.seek(batch[0][0])
+            raw = src.read(batch[-1][0] + batch[-1][1] - batch[0][0])
+            base = batch[0][0]
+            for data in executor.map(inflate_block, [raw[o - base:o - base + n] for o, n in batch]):
+                dst.write(data)
+
+
+def _evict_cache(keep: str):
+    """Removes the least recently used cache entries until the cache fits NIFTI_CACHE_MAX_MB."""
+    entries = []
+    for name in os.listdir(NIFTI_CACHE_DIR):
+        entry = os.path.join(NIFTI_CACHE_DIR, name)
+        if name.endswith(".nii") and entry != keep:
+            try:
+                stat = os.stat(entry)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+    total = sum(size for _, size, _ in entries) + os.path.getsize(keep)
+    for _, size, entry in sorted(entries):
+        if total <= NIFTI_CACHE_MAX_MB * 1024 * 1024:
+            break
+        try:
+            os.remove(entry)  # Readers that still have it memory-mapped keep their mapping
+        except OSError:
+            continue
+        total -= size
+
+
+def _stored_layout(img) -> Tuple[Tuple[int, ...], np.dtype, float, float]:
+    """Shape (trailing singleton axes dropped), on-disk dtype and scaling of a NIfTI image."""
+    shape = tuple(img.shape)
+    while len(shape) > 3 and shape[-1] == 1:
+        shape = shape[:-1]
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    return shape, img.header.get_data_dtype(), slope, inter
+
+
+def is_scaled(img) -> bool:
+    """True when the stored voxels have to be rescaled (scl_slope/scl_inter) to get their values."""
+    _, _, slope, inter = _stored_layout(img)
+    return not (slope == 1 and inter == 0)
+
+
+def volume_dtype(img) -> np.dtype:
+    """
+    The dtype voxels are read in: the stored dtype in native byte order, or float32 for scaled images.
+    """
+    _, dtype, _, _ = _stored_layout(img)
+    return np.dtype(np.float32) if is_scaled(img) else dtype.newbyteorder("=")
+
+
+def iter_slabs(img, slab_mb: int = NIFTI_SLAB_MB) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Yields `(start, slab)` pairs covering the volume along its last axis, each slab being a
+    read-only (x, y, n) array in `volume_dtype(img)`.
+
+    Single-file NIfTI is read front to back in one sequential pass (a gzip stream is decompressed
+    exactly once); uncompressed files (e.g. from `load_nifti`) are memory-mapped and their slabs
+    are views of the map. Other formats fall back to slicing `img.dataobj`.
+    """
+    shape, stored_dtype, slope, inter = _stored_layout(img)
+    dtype = volume_dtype(img)
+    slice_shape = shape[:-1]
+    slice_bytes = int(np.prod(slice_shape)) * stored_dtype.itemsize
+    depth = max(1, (slab_mb * 1024 * 1024) // max(slice_bytes, 1))
+
+    filename = img.get_filename()
+    single_file = isinstance(img, (nib.Nifti1Image, nib.Nifti2Image)) and img.header.is_single
+    if not filename or not single_file:
+        for start in range(0, shape[-1], depth):
+            stop = min(start + depth, shape[-1])
+            index = (slice(None),) * (len(shape) - 1) + (slice(start, stop),)
+            slab = np.asanyarray(img.dataobj[index]).reshape(slice_shape + (stop - start,), order="F")
+            yield start, slab.astype(dtype, copy=False)
+        return
+
+    if not filename.endswith((".gz", ".bz2", ".zst")):
+        voxels = np.memmap(filename, dtype=stored_dtype, mode="r", offset=int(img.dataobj.offset), shape=shape,
+                           order="F")
+        for start in range(0, shape[-1], depth):
+            slab = voxels[..., start:start + depth]
+            if not (slope == 1 and inter == 0):
+                slab = slab * np.float32(slope) + np.float32(inter)
+            yield start, slab.astype(dtype, copy=False)
+        return
+
+    with ImageOpener(filename, "rb") as f:
+        f.seek(int(img.dataobj.offset))
+        for start in range(0, shape[-1], depth):
+            count = min(depth, shape[-1] - start)
+            buffer = f.read(slice_bytes * count)
+            if len(buffer) != slice_bytes * count:
+                raise ValueError(f"{filename} is truncated: expected {shape} voxels of {stored_dtype}")
+            slab = np.frombuffer(buffer, dtype=stored_dtype).reshape(slice_shape + (count,), order="F")
+            if not (slope == 1 and inter == 0):
+                slab = slab * np.float32(slope) + np.float32(inter)
+            yield start, slab.astype(dtype, copy=False)
+
+
+def iter_overlapping_slabs(img, slab_mb: int = NIFTI_SLAB_MB) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Like `iter_slabs`, but every slab after the first starts with the last slice of the previous
+    one, so the cells between two slabs belong to exactly one of them. Slabs are writable copies.
+    """
+    previous = None
+    for start, slab in iter_slabs(img, slab_mb):
+        if previous is None:
+            yield start, np.array(slab, order="F")
+        else:
+            yield start - 1, np.concatenate([previous, slab], axis=-1)
+        previous = np.array(slab[..., -1:], order="F")
+
+
+def stored_megabytes(img) -> float:
+    """Size of the voxel data of an image in its stored dtype, in MB."""
+    shape, dtype, _, _ = _stored_layout(img)
+    return int(np.prod(shape)) * dtype.itemsize / (1024 * 1024)
+
+
+def read_volume(img, transform: Optional[Callable[[np.ndarray], None]] = None) -> np.ndarray:
+    """
+    Reads the voxels of a NIfTI image into one Fortran-ordered array in `volume_dtype(img)`,
+    slab by slab, so the only full-size allocation is the result (no float64 upcast as with
+    `get_fdata`). `transform(slab)` may modify each slab of the result in place as it is filled.
+    """
+    shape, _, _, _ = _stored_layout(img)
+    data = np.empty(shape, dtype=volume_dtype(img), order="F")
+    for start, slab in iter_slabs(img):
+        target = data[..., start:start + slab.shape[-1]]
+        target[...] = slab
+        if transform is not None:
+            transform(target)
+    return data
+
+
+def write_streamed(img, output_path: str, header=None,
+                   transform: Optional[Callable[[np.ndarray], np.ndarray]] = None):
+    """
+    Writes `img` to `output_path` with `header` (default: a copy of the image's header), streaming
+    the voxels slab by slab. `transform(slab)` may return a modified copy of each slab; it must
+    keep its shape. Scaled images are written as float32 with the scaling applied.
+    """
+    header = (header if header is not None else img.header).copy()
+    if is_scaled(img):
+        header.set_data_dtype(np.float32)
+        header.set_slope_inter(1, 0)
+    header["vox_offset"] = 0  # Recomputed by write_to for the header and its extensions
+    out_dtype = header.get_data_dtype()
+
+    with ImageOpener(output_path, "wb") as f:
+        header.write_to(f)
+        f.write(b"\0" * (int(header.get_data_offset()) - f.tell()))
+        for _, slab in iter_slabs(img):
+            if transform is not None:
+                slab = transform(slab)
+            f.write(np.asarray(slab, dtype=out_dtype).tobytes(order="F"))
+
+
+def write_with_affine(img, output_path: str, affine):
+    """
+    Writes a copy of `img` with a new affine (qform and sform). The voxel bytes are copied
+    unchanged, without being decoded, so no volume-sized array is ever allocated.
+    """
+    header = img.header.copy()
+    header.set_qform(affine)
+    header.set_sform(affine)
+    header["vox_offset"] = 0
+
+    single_file = isinstance(img, (nib.Nifti1Image, nib.Nifti2Image)) and img.header.is_single
+    if not img.get_filename() or not single_file:
+        nib.save(nib.Nifti1Image(np.asanyarray(img.dataobj), affine, header), output_path)
+        return
+
+    with ImageOpener(img.get_filename(), "rb") as src, ImageOpener(output_path, "wb") as dst:
+        header.write_to(dst)
+        dst.write(b"\0" * (int(header.get_data_offset()) - dst.tell()))
+        src.seek(int(img.dataobj.offset))
+        shutil.copyfileobj(src, dst, NIFTI_SLAB_MB * 1024 * 1024)